@@ -12,6 +12,10 @@ from prometheus_client.twisted import MetricsResource
 
 from warp.iwarp import IWarpService
 from warp import runtime, command
+from warp.common import events
+from warp.common.outbox import makeRelay
+from warp.common.sweeper import makeSweeper
+from warp.webserver import comet
 
 class WarpServiceMaker(object):
     implements(IServiceMaker, IPlugin, IWarpService)
@@ -67,6 +71,22 @@ class WarpServiceMaker(object):
 
         command.doStartup(options)
 
+        sweeper = makeSweeper()
+        if sweeper is not None:
+            sweeper.setServiceParent(svc)
+
+        events.dispatcher.configure(config.get('eventThreads', 4),
+                                    config.get('eventBatchSize', 100))
+        events.dispatcher.setServiceParent(svc)
+
+        relay = makeRelay()
+        if relay is not None:
+            relay.setServiceParent(svc)
+
+        backplane = comet.installBackplane()
+        if backplane is not None:
+            backplane.setServiceParent(svc)
+
         return svc
 
 serviceMaker = WarpServiceMaker()
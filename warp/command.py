@@ -5,11 +5,11 @@ from inspect import getargspec
 from twisted.python import usage, reflect
 from twisted.python.filepath import FilePath
 
-from warp.webserver import resource, site
-from warp.common import store, translate
+from warp.webserver import resource, site, backplane
+from warp.common import store, translate, assets, sweeper, outbox
 from warp import runtime
 from warp.common import schema
-from warp.tools import skeleton, adduser, autocrud
+from warp.tools import skeleton, adduser, autocrud, compiletemplates
 
 
 class Options(usage.Options):
@@ -236,3 +236,71 @@ def migrate(options):
     Migrate the DB
     """
     schema.migrate(dryRun=True if options.subOptions['dryRun'] else False)
+
+@register()
+def bundle(options):
+    """
+    Build the static asset bundles into siteDir/static
+    """
+    print("Building bundles...")
+    assets.buildBundles()
+
+class SweepOptions(usage.Options):
+    optParameters = [
+        ['batchSize', 'b', None, "Sessions to delete per batch", int],
+    ]
+
+@register(needStartup=True, optionsParser=SweepOptions)
+def sweepSessions(options):
+    """
+    Delete all expired non-persistent sessions now
+    """
+    if not runtime.config.get('sessionMaxAge'):
+        print("sessionMaxAge is not set in config, sessions don't expire")
+        raise SystemExit(1)
+    sessionSweeper = sweeper.SessionSweeper(batchSize=options.subOptions['batchSize'])
+    print("Deleting sessions idle for more than %d seconds..." % sessionSweeper.maxAge)
+    print("Deleted %d sessions" % sessionSweeper.sweepAll(verbose=True))
+
+@register(needStartup=True)
+def eventworker(options):
+    """
+    Run outbox event handlers (set outboxRelay to False in config to keep
+    them out of the web processes)
+    """
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    log.startLogging(sys.stdout)
+    relay = outbox.OutboxRelay()
+    relay.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', relay.stopService)
+    print("Running outbox events every %ss" % relay.interval)
+    reactor.run()
+
+@register()
+def cometBroker(options):
+    """
+    Run the broker passing comet messages between worker processes
+    """
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    path = backplane.getBrokerSocket()
+    log.startLogging(sys.stdout)
+    backplane.listenBroker(path)
+    print("Comet broker listening on %s" % path)
+    reactor.run()
+
+class PrecompileOptions(usage.Options):
+    optParameters = [
+        ['processes', 'j', None, "Number of worker processes (default: one per CPU)", int],
+    ]
+
+@register(optionsParser=PrecompileOptions)
+def precompile(options):
+    """
+    Compile all templates into the template cache directory
+    """
+    if compiletemplates.precompile(options.subOptions['processes']):
+        raise SystemExit(1)
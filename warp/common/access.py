@@ -1,20 +1,84 @@
+import types
+
 from warp import runtime
 
+# Objects whose decisions can be kept: they live as long as the process
+_staticTargets = (types.ModuleType, type, types.ClassType)
+
+# (roles, obj, facetName) -> decision, for decisions made by static rules
+# only. Filled as decisions are first made.
+decisions = {}
 
-def allowed(avatar, obj, **kwargs):
 
+def getRoles(avatar):
     if avatar is None:
-        roles = (runtime.config['roles'][x]
-                 for x in runtime.config.get('defaultRoles', []))
-    else:
-        roles = avatar.roles
+        return tuple(runtime.config['roles'][x]
+                     for x in runtime.config.get('defaultRoles', []))
+    return tuple(avatar.roles)
+
+
+def allowed(avatar, obj, **kwargs):
+    roles = getRoles(avatar)
 
+    if not isinstance(obj, _staticTargets):
+        return evaluate(roles, obj, avatar, kwargs)[0]
+
+    key = (roles, obj, kwargs.get('facetName'))
+    decision = decisions.get(key)
+    if decision is not None:
+        return decision
+
+    decision, static = evaluate(roles, obj, avatar, kwargs)
+    if static:
+        decisions[key] = decision
+    return decision
+
+
+def evaluate(roles, obj, avatar, kwargs):
+    """
+    Evaluate the rules of C{roles} for C{obj}.
+
+    @return: C{(decision, static)}, where C{static} says whether only
+        static rules were needed to decide
+    """
+    static = True
     for role in roles:
-        opinion = role.allows(obj, avatar=avatar, **kwargs)
-        if opinion is not None:
-            return opinion
+        for rule in role.rulesFor(obj):
+            static = static and isStatic(rule)
+            opinion = rule.allows(obj, avatar=avatar, **kwargs)
+            if opinion is not None:
+                return (opinion, static)
+    return (False, static)
 
-    return False
+
+def requestAllowed(request, obj, **kwargs):
+    """
+    Like L{allowed} for C{request.avatar}, but remembers decisions for the
+    rest of the request, so templates can check the same links repeatedly.
+    """
+    try:
+        key = (request.avatar, obj, tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for (k, v) in kwargs.iteritems())))
+        hash(key)
+    except TypeError:
+        return allowed(request.avatar, obj, **kwargs)
+
+    memo = getattr(request, 'accessDecisions', None)
+    if memo is None:
+        memo = request.accessDecisions = {}
+
+    decision = memo.get(key)
+    if decision is None:
+        decision = memo[key] = allowed(request.avatar, obj, **kwargs)
+    return decision
+
+
+def clearDecisions():
+    """
+    Forget stored decisions, after changing C{roles} in config.
+    """
+    decisions.clear()
 
 
 # ---------------------------
@@ -26,15 +90,15 @@ class Role(object):
         self.default = default
         self.name = name
 
-    def allows(self, obj, **kwargs):
+    def rulesFor(self, obj):
         if obj in self.ruleMap:
-            rules = self.ruleMap[obj]
+            return self.ruleMap[obj]
         elif obj.__class__ in self.ruleMap:
-            rules = self.ruleMap[obj.__class__]
-        else:
-            rules = self.default
+            return self.ruleMap[obj.__class__]
+        return self.default
 
-        for rule in rules:
+    def allows(self, obj, **kwargs):
+        for rule in self.rulesFor(obj):
             opinion = rule.allows(obj, **kwargs)
             if opinion is not None:
                 return opinion
@@ -43,9 +107,19 @@ class Role(object):
 # ---------------------------
 
 
+def isStatic(*rules):
+    """
+    Whether the opinion of all C{rules} depends only on the object and the
+    facet name, so it can be kept in the decision table. Rules without a
+    C{static} attribute are assumed not to be static.
+    """
+    return all(getattr(rule, 'static', False) for rule in rules)
+
+
 class All(object):
     def __init__(self, *checkers):
         self.checkers = checkers
+        self.static = isStatic(*checkers)
 
     def allows(self, other, **kwargs):
         for checker in self.checkers:
@@ -57,6 +131,7 @@ class All(object):
 class Any(object):
     def __init__(self, *checkers):
         self.checkers = checkers
+        self.static = isStatic(*checkers)
 
     def allows(self, other, **kwargs):
         for checker in self.checkers:
@@ -68,6 +143,7 @@ class Any(object):
 class Each(object):
     def __init__(self, *checkers):
         self.checkers = checkers
+        self.static = isStatic(*checkers)
 
     def allows(self, other, **kwargs):
         for checker in self.checkers:
@@ -81,6 +157,7 @@ class Each(object):
 class Not(object):
     def __init__(self, checker):
         self.checker = checker
+        self.static = isStatic(checker)
 
     def allows(self, other, **kwargs):
         return not self.checker.allows(other, **kwargs)
@@ -90,6 +167,7 @@ class If(object):
     def __init__(self, conditionChecker, bodyChecker):
         self.conditionChecker = conditionChecker
         self.bodyChecker = bodyChecker
+        self.static = isStatic(conditionChecker, bodyChecker)
 
     def allows(self, other, **kwargs):
         if not self.conditionChecker.allows(other, **kwargs):
@@ -102,6 +180,7 @@ class If(object):
 
 
 class Equals(object):
+    static = True
 
     def __init__(self, key):
         self.key = key
@@ -111,6 +190,7 @@ class Equals(object):
 
 
 class Callback(object):
+    static = False
 
     def __init__(self, callback):
         self.callback = callback
@@ -124,16 +204,21 @@ class Callback(object):
 
 
 class Allow(object):
+    static = True
+
     def allows(self, other, **kwargs):
         return True
 
 
 class Deny(object):
+    static = True
+
     def allows(self, other, **kwargs):
         return False
 
 
 class AllowFacets(object):
+    static = True
 
     def __init__(self, facets):
         self.facets = facets
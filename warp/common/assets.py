@@ -0,0 +1,138 @@
+"""
+Static asset bundles.
+
+A bundle concatenates (and, if a minifier is installed, minifies) several
+static files into one file under C{siteDir/static}. The static index
+fingerprints it like any other file, so pages fetch one long-cacheable
+URL instead of a dozen separate ones.
+
+Sources are URL paths relative to the site root, so C{_warp/json2.js} is
+Warp's own copy and C{js/site.js} is the site's.
+"""
+from __future__ import print_function
+import os
+import re
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+from warp.runtime import config
+
+BUNDLES = {
+    'warp.css': [
+        '_warp/reset.css',
+        '_warp/markitup/skins/markitup/style.css',
+        '_warp/markitup/sets/default/style.css',
+    ],
+    'warp.js': [
+        '_warp/json2.js',
+        '_warp/jquery-1.6.1.min.js',
+        '_warp/jqueryui/js/jquery-ui-1.7.2.custom.min.js',
+        '_warp/jquery.comet.js',
+        '_warp/jquery.warpform.js',
+        '_warp/jquery.warpref.js',
+        '_warp/markitup/jquery.markitup.js',
+        '_warp/markitup/sets/default/set.js',
+    ],
+    'jqgrid.css': [
+        '_warp/jqueryui/css/ui-lightness/jquery-ui-1.7.2.custom.css',
+        '_warp/jqgrid/css/ui.jqgrid.css',
+    ],
+    'jqgrid.js': [
+        '_warp/jqgrid/js/i18n/grid.locale-en.js',
+        '_warp/jqgrid/js/jquery.jqGrid.min.js',
+    ],
+}
+
+_cssURLExp = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def getBundles():
+    """
+    Warp's bundles plus any defined in config under C{'bundles'}.
+    """
+    bundles = dict(BUNDLES)
+    bundles.update(config.get('bundles', {}))
+    return bundles
+
+
+def getBundleDir():
+    """
+    Name of the bundle directory, relative to C{siteDir/static}.
+    """
+    return config.get('bundleDir', '_bundles')
+
+
+def sourcePath(source):
+    """
+    Filesystem path of a bundle source.
+    """
+    if source.startswith('_warp/'):
+        return os.path.join(config['warpDir'].child('static').path, *source[6:].split('/'))
+    return os.path.join(config['siteDir'].child('static').path, *source.split('/'))
+
+
+def buildBundle(name, sources):
+    """
+    Concatenate and minify the sources of one bundle.
+
+    @return: Bundle content, C{str}
+    """
+    parts = []
+    for source in sources:
+        with open(sourcePath(source), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = rewriteCSSURLs(content, source)
+        parts.append(content)
+
+    if name.endswith('.js'):
+        # Guard against sources without a trailing semicolon
+        content = ';\n'.join(parts)
+        if rjsmin is not None:
+            content = rjsmin.jsmin(content)
+    else:
+        content = '\n'.join(parts)
+        if rcssmin is not None:
+            content = rcssmin.cssmin(content)
+    return content
+
+
+def rewriteCSSURLs(content, source):
+    """
+    Make relative C{url()} references in a stylesheet absolute, since the
+    bundle is served from a different directory than the source.
+    """
+    base = '%s/%s' % (config.get('baseURL', ''), source.rsplit('/', 1)[0])
+
+    def rewrite(match):
+        quote, url = match.groups()
+        if url.startswith(('/', 'data:', 'http:', 'https:', '#')):
+            return match.group(0)
+        return 'url(%s%s/%s%s)' % (quote, base, url, quote)
+
+    return _cssURLExp.sub(rewrite, content)
+
+
+def buildBundles():
+    """
+    Write all bundles into the bundle directory.
+    """
+    bundle_dir = config['siteDir'].child('static').preauthChild(getBundleDir())
+    if not bundle_dir.exists():
+        bundle_dir.makedirs()
+
+    if rjsmin is None or rcssmin is None:
+        print("rjsmin/rcssmin not installed, bundles will not be minified")
+
+    for (name, sources) in sorted(getBundles().iteritems()):
+        content = buildBundle(name, sources)
+        bundle_dir.child(name).setContent(content)
+        print("  %s: %d files, %d bytes" % (name, len(sources), len(content)))
@@ -1,13 +1,32 @@
 import time
 import random
+import base64
+import hashlib
+import hmac
+from collections import OrderedDict
 from datetime import datetime
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken as InvalidTokenError
+except ImportError:
+    Fernet = None
+    InvalidTokenError = ValueError
+
 from storm.locals import *
+from storm.expr import LeftJoin, Update
 
 from twisted.python.hashlib import md5
-from twisted.python import components
+from twisted.python import components, log
+from twisted.internet import reactor
 
-from warp import runtime
+from warp import runtime, metrics
+from warp.common import flash
+from warp.common.events import changeHandler
 from warp.common.schema import stormSchema
 
 # Default session lang
@@ -22,31 +41,188 @@ class Avatar(Storm):
     email = Unicode()
     password = Unicode()
 
-    _roles = None
     def _getRoles(self):
-        if self._roles is None:
-            roleLookup = runtime.config['roles']
+        roles = roleCache.get(self.id)
+        if roles is None:
             avatar_roles = runtime.avatar_store.find(
                 AvatarRole, AvatarRole.avatar == self).order_by(AvatarRole.position)
-            self._roles = tuple(
-                [roleLookup[ar.role_name] for ar in avatar_roles if ar.role_name in roleLookup] +
-                [roleLookup[r] for r in runtime.config['defaultRoles']]
-            )
-
-        return self._roles
+            roles = roleCache.set(self.id, [ar.role_name for ar in avatar_roles])
+        return roles
     roles = property(_getRoles)
 
     def __repr__(self):
         return "<Avatar '%s'>" % self.email.encode("utf-8")
 
 
-# Store flash messages
-_MESSAGES = {}
+class RoleCache(object):
+    """
+    Roles of recently seen avatars, shared by all requests in the process.
+
+    Entries are dropped when C{AvatarRole} rows of the avatar are committed
+    through the avatar store, and in any case after C{roleCacheTTL}
+    seconds, which bounds how long other processes see stale roles.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        # avatar id -> (expires, roles)
+        self.entries = OrderedDict()
+
+    def get(self, avatar_id):
+        entry = self.entries.get(avatar_id)
+        if entry is None or entry[0] < time.time():
+            metrics.roleCacheMisses.inc()
+            return None
+        metrics.roleCacheHits.inc()
+        return entry[1]
+
+    def set(self, avatar_id, role_names):
+        """
+        Cache roles of an avatar, given the names of its own roles.
+
+        @return: Role objects, including the C{defaultRoles}
+        """
+        roleLookup = runtime.config['roles']
+        roles = tuple(
+            [roleLookup[name] for name in role_names if name in roleLookup] +
+            [roleLookup[name] for name in runtime.config['defaultRoles']])
+
+        self.entries.pop(avatar_id, None)
+        self.entries[avatar_id] = (
+            time.time() + runtime.config.get('roleCacheTTL', 60), roles)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return roles
+
+    def invalidate(self, avatar_id=None):
+        """
+        Forget the roles of one avatar, or of all avatars.
+        """
+        if avatar_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(avatar_id, None)
+
+roleCache = RoleCache()
+
+
+def loadAvatar(avatar_id):
+    """
+    Get avatar by id, with its roles cached.
+
+    If the roles aren't cached, the avatar and its roles are loaded with a
+    single query.
+    """
+    store = runtime.avatar_store
+    if roleCache.get(avatar_id) is not None:
+        return store.get(Avatar, avatar_id)
+
+    rows = list(store.using(
+        LeftJoin(Avatar, AvatarRole, AvatarRole.avatar_id == Avatar.id)
+    ).find((Avatar, AvatarRole), Avatar.id == avatar_id).order_by(AvatarRole.position))
+    if not rows:
+        return None
+
+    roleCache.set(avatar_id, [ar.role_name for (avatar, ar) in rows if ar is not None])
+    return rows[0][0]
+
 
 def nowstamp():
     return int(time.mktime(datetime.utcnow().timetuple()))
 
-class Session(components.Componentized):
+
+class LazySession(object):
+    """
+    Mixin for sessions which aren't stored until they hold something.
+
+    Session managers create sessions with C{isMaterialized} false. Nothing
+    is written, and no cookie is sent, until the session gets a flash
+    message, an avatar, a language, an C{afterLogin} URL or is made
+    persistent. Clients which never do any of that, like crawlers and
+    health checks, don't cost a database write.
+    """
+    isMaterialized = True
+
+    # Whether the session cookie has to be sent again, see CookieSession
+    dirty = False
+
+    _language = DEFAULT_LANG
+    _afterLogin = None
+    _materializeCallbacks = ()
+
+    def materialize(self):
+        """
+        Store the session, if it isn't stored yet.
+        """
+        if self.isMaterialized:
+            return
+        self.isMaterialized = True
+        self._saveNew()
+
+        callbacks, self._materializeCallbacks = self._materializeCallbacks, ()
+        for callback in callbacks:
+            callback(self)
+
+    def notifyMaterialized(self, callback):
+        """
+        Call C{callback(session)} once the session is stored, or right away
+        if it already is.
+        """
+        if self.isMaterialized:
+            callback(self)
+        else:
+            self._materializeCallbacks = list(self._materializeCallbacks) + [callback]
+
+    def _saveNew(self):
+        """
+        Write a new session to its backend. Called once, by L{materialize}.
+        """
+
+    def _saveState(self):
+        """
+        Write the language and C{afterLogin} of a stored session after they
+        change.
+        """
+
+    def cookieValue(self):
+        """
+        Value of the session cookie.
+        """
+        return self.uid
+
+    def getAvatar(self):
+        """
+        The session's avatar, loaded as cheaply as the backend allows.
+        """
+        return self.avatar
+
+    def _getLanguage(self):
+        return self._language or DEFAULT_LANG
+
+    def _setLanguage(self, language):
+        if language != self.language:
+            self._language = unicode(language)
+            if self.isMaterialized:
+                self._saveState()
+            else:
+                self.materialize()
+
+    language = property(_getLanguage, _setLanguage)
+
+    def _getAfterLogin(self):
+        return self._afterLogin
+
+    def _setAfterLogin(self, url):
+        if url != self._afterLogin:
+            self._afterLogin = unicode(url) if url is not None else None
+            if self.isMaterialized:
+                self._saveState()
+            elif url is not None:
+                self.materialize()
+
+    afterLogin = property(_getAfterLogin, _setAfterLogin)
+
+
+class Session(LazySession, components.Componentized):
     """
     Base interface for session.
 
@@ -64,7 +240,6 @@ class Session(components.Componentized):
     This implements methods and properties from C{twisted.web.server.Session},
     and C{DBSession}. It doesn't implement session timeouts or require a database.
     """
-    language = DEFAULT_LANG
     isPersistent = False
 
     # sessionTimeout = 900
@@ -72,8 +247,8 @@ class Session(components.Componentized):
     # Don't update session age if it is less than this
     # _touch_granularity = 10
 
-    # Class variable which stores flash messages
-    _MESSAGES = {}
+    # Flash messages, when kept by flash.SessionFlashStore
+    messages = None
 
     def __init__(self, uid):
         """
@@ -97,9 +272,8 @@ class Session(components.Componentized):
         These are messages which should be displayed to the user for a single
         page load, e.g. to indicate that an action has succeeded.
         """
-        if self.uid not in self._MESSAGES:
-            self._MESSAGES[self.uid] = []
-        self._MESSAGES[self.uid].append((msg, args, kwargs))
+        self.materialize()
+        flash.getStore().add(self, (msg, args, kwargs))
 
     def getFlashMessages(self, clear=True):
         """
@@ -108,12 +282,12 @@ class Session(components.Componentized):
         @param clear: Whether to clear messages after reading, default True
         @type  clear: C{bool}
         """
-        if self.uid not in self._MESSAGES:
-            return []
-        messages = self._MESSAGES[self.uid][:]
-        if clear:
-            del self._MESSAGES[self.uid]
-        return messages
+        return flash.getStore().get(self, clear)
+
+    def saveMessages(self):
+        """
+        Store C{messages} after a change by L{flash.SessionFlashStore}.
+        """
 
 
     def hasAvatar(self):
@@ -206,15 +380,15 @@ class SessionManager(object):
 
     def createSession(self):
         """
-        Create initial session.
+        Create initial session. It is only added to the database once it
+        materializes, see L{LazySession}.
 
         @return:  Session object
         """
         uid = self._mkuid()
         session = DBSession()
         session.uid = uid
-        runtime.avatar_store.add(session)
-        runtime.avatar_store.commit()
+        session.isMaterialized = False
         return session
 
     def getSession(self, uid):
@@ -237,10 +411,8 @@ class SessionManager(object):
 
 
 @stormSchema.versioned
-class DBSession(Storm):
-    # FIXME HXP: This breaks integration with MySQL and SQLite, but those are
-    # not working anyway due to the missing touched column.
-    __version__ = "hxp_2"
+class DBSession(LazySession, Storm):
+    __version__ = "warp_3"
     __storm_table__ = "warp_session"
 
     uid = RawStr(primary=True)
@@ -250,15 +422,21 @@ class DBSession(Storm):
 
     isPersistent = Bool(default=False)
 
-    language = u"en_US"
-    messages = None
-    afterLogin = None
+    messages = JSON()
+
+    # Behind LazySession's language and afterLogin properties
+    _language = Unicode(name="language")
+    _afterLogin = Unicode(name="after_login")
 
     _touch_granularity = 10
 
+    def getAvatar(self):
+        # Avatar and roles in one query, unlike the avatar reference
+        if self.avatar_id is None:
+            return None
+        return loadAvatar(self.avatar_id)
+
     def __storm_loaded__(self):
-        if self.language is None:
-            self.language = u"en_US"
         if self.touched is None:
             self.touched = nowstamp()
             runtime.avatar_store.commit()
@@ -271,9 +449,8 @@ class DBSession(Storm):
         These are messages which should be displayed to the user for a single
         page load, e.g. to indicate that an action has succeeded.
         """
-        if self.uid not in _MESSAGES:
-            _MESSAGES[self.uid] = []
-        _MESSAGES[self.uid].append((msg, args, kwargs))
+        self.materialize()
+        flash.getStore().add(self, (msg, args, kwargs))
 
     def getFlashMessages(self, clear=True):
         """
@@ -282,12 +459,11 @@ class DBSession(Storm):
         @type  clear: C{boolean}
         @param clear: Whether to clear messages after reading, default True
         """
-        if self.uid not in _MESSAGES:
-            return []
-        messages = _MESSAGES[self.uid][:]
-        if clear:
-            del _MESSAGES[self.uid]
-        return messages
+        return flash.getStore().get(self, clear)
+
+    def saveMessages(self):
+        if self.isMaterialized:
+            runtime.avatar_store.commit()
 
 
     def hasAvatar(self):
@@ -295,24 +471,395 @@ class DBSession(Storm):
 
     def setAvatarID(self, avatar_id):
         self.avatar_id = avatar_id
-        runtime.avatar_store.commit()
+        if avatar_id is not None:
+            self.materialize()
+        if self.isMaterialized:
+            runtime.avatar_store.commit()
 
 
     def setPersistent(self, is_persistent):
         self.isPersistent = is_persistent
-        runtime.avatar_store.commit()
+        if is_persistent:
+            self.materialize()
+        if self.isMaterialized:
+            runtime.avatar_store.commit()
 
     def age(self):
         return nowstamp() - self.touched
 
     def touch(self):
-        if self.age() > self._touch_granularity:
+        if self.isMaterialized and self.age() > self._touch_granularity:
             self.touched = nowstamp()
             runtime.avatar_store.commit()
 
+    def _saveNew(self):
+        runtime.avatar_store.add(self)
+        runtime.avatar_store.commit()
+
+    def _saveState(self):
+        runtime.avatar_store.commit()
+
     def __repr__(self):
         return "<Session '%s'>" % self.uid
 
+
+class CachedSession(Session):
+    """
+    Session kept in memory by L{CachedSessionManager}, backed by a
+    C{warp_session} row.
+
+    Changes to the avatar or persistence are written through immediately;
+    C{touched} is written later, in batches.
+    """
+    _touch_granularity = 10
+
+    def __init__(self, manager, uid, avatar_id=None, touched=None,
+                 isPersistent=False, messages=None, language=None,
+                 afterLogin=None):
+        components.Componentized.__init__(self)
+
+        self.manager = manager
+        self.uid = uid
+        self.avatar_id = avatar_id
+        self.touched = touched if touched is not None else nowstamp()
+        self.isPersistent = isPersistent
+        self.messages = messages
+        self._language = language
+        self._afterLogin = afterLogin
+
+    @property
+    def avatar(self):
+        if self.avatar_id is None:
+            return None
+        return loadAvatar(self.avatar_id)
+
+    def setAvatarID(self, avatar_id):
+        self.avatar_id = avatar_id
+        if self.isMaterialized:
+            self.manager.save(self)
+        elif avatar_id is not None:
+            self.materialize()
+
+    def _saveState(self):
+        self.manager.save(self)
+
+    def setPersistent(self, is_persistent):
+        self.isPersistent = is_persistent
+        if self.isMaterialized:
+            self.manager.save(self)
+        elif is_persistent:
+            self.materialize()
+
+    def saveMessages(self):
+        if self.isMaterialized:
+            self.manager.save(self)
+
+    def touch(self):
+        now = nowstamp()
+        if now - self.touched > self._touch_granularity:
+            self.touched = now
+            if self.isMaterialized:
+                self.manager.markTouched(self)
+
+    def _saveNew(self):
+        self.manager.insert(self)
+
+
+class CachedSessionManager(SessionManager):
+    """
+    Handle sessions using database, keeping recently used sessions in an
+    in-process LRU cache.
+
+    Repeat requests for a cached session don't touch the database. Touches
+    are collected and written every C{sessionFlushInterval} seconds in one
+    UPDATE, which stamps the whole batch with its latest time, so
+    C{touched} in the database is only accurate to within that interval.
+
+    The cache is per process: with several workers, a change made by one
+    worker is seen by the others only once the session drops out of their
+    caches.
+    """
+    def __init__(self, size=None, flushInterval=None):
+        self.size = size or runtime.config.get('sessionCacheSize', 10000)
+        self.flushInterval = (flushInterval or
+                              runtime.config.get('sessionFlushInterval', 10))
+        self.cache = OrderedDict()
+        self.pendingTouches = {}
+        self.flushCall = None
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def createSession(self):
+        session = CachedSession(self, self._mkuid())
+        session.isMaterialized = False
+        return session
+
+    def getSession(self, uid):
+        session = self.cache.pop(uid, None)
+        if session is not None:
+            metrics.sessionCacheHits.inc()
+            self.cache[uid] = session
+            return session
+
+        metrics.sessionCacheMisses.inc()
+        row = runtime.avatar_store.get(DBSession, uid)
+        if row is None:
+            return None
+
+        touched = max(row.touched, self.pendingTouches.get(uid, 0))
+        session = CachedSession(self, row.uid, row.avatar_id, touched,
+                                row.isPersistent, row.messages,
+                                row._language, row._afterLogin)
+        self._remember(session)
+        return session
+
+    def insert(self, session):
+        """
+        Add the row for a newly materialized session.
+        """
+        row = DBSession()
+        row.uid = session.uid
+        row.avatar_id = session.avatar_id
+        row.touched = session.touched
+        row.isPersistent = session.isPersistent
+        row.messages = session.messages
+        row._language = session._language
+        row._afterLogin = session._afterLogin
+        runtime.avatar_store.add(row)
+        runtime.avatar_store.commit()
+
+        self._remember(session)
+
+    def save(self, session):
+        """
+        Write avatar, persistence, flash messages, language and
+        C{afterLogin} of a session immediately.
+
+        If the row is gone, because the sweeper of another process deleted
+        it while the session was cached here, it is added again.
+        """
+        values = [(DBSession.avatar_id, session.avatar_id),
+                  (DBSession.isPersistent, session.isPersistent),
+                  (DBSession.messages, session.messages),
+                  (DBSession._language, session._language),
+                  (DBSession._afterLogin, session._afterLogin)]
+        result = runtime.avatar_store.execute(Update(
+            dict((column, column.variable_factory(value=value))
+                 for (column, value) in values),
+            DBSession.uid == session.uid, DBSession))
+        if result.rowcount == 0:
+            self.insert(session)
+            return
+        runtime.avatar_store.commit()
+
+    def forget(self, uids):
+        """
+        Drop sessions whose rows were deleted from the cache.
+        """
+        for uid in uids:
+            self.cache.pop(uid, None)
+            self.pendingTouches.pop(uid, None)
+
+    def markTouched(self, session):
+        self.pendingTouches[session.uid] = session.touched
+        if self.flushCall is None:
+            self.flushCall = reactor.callLater(self.flushInterval, self.flush)
+
+    def flush(self):
+        """
+        Write pending touches in a single UPDATE.
+        """
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+
+        if not self.pendingTouches:
+            return
+
+        pending = self.pendingTouches
+        self.pendingTouches = {}
+
+        start = time.time()
+        try:
+            runtime.avatar_store.find(
+                DBSession, DBSession.uid.is_in(pending.keys())).set(
+                touched=max(pending.itervalues()))
+            runtime.avatar_store.commit()
+        except Exception:
+            log.err(None, "Failed to write %d session touches" % len(pending))
+            runtime.avatar_store.rollback()
+            return
+
+        metrics.sessionFlushSeconds.observe(time.time() - start)
+        metrics.sessionsFlushed.inc(len(pending))
+
+    def _remember(self, session):
+        self.cache[session.uid] = session
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+
+class CookieSession(Session):
+    """
+    Session kept entirely in a signed cookie by L{CookieSessionManager}.
+
+    Any change marks the session C{dirty}, and C{WarpRequest} sends the
+    updated cookie before the response starts. With the C{'session'} flash
+    store, flash messages are part of the cookie too.
+    """
+    _touch_granularity = 10
+
+    def __init__(self, manager, uid, avatar_id=None, touched=None,
+                 isPersistent=False, language=DEFAULT_LANG, afterLogin=None,
+                 messages=None):
+        components.Componentized.__init__(self)
+
+        self.manager = manager
+        self.uid = uid
+        self.avatar_id = avatar_id
+        self.touched = touched if touched is not None else nowstamp()
+        self.isPersistent = isPersistent
+        self._language = language
+        self._afterLogin = afterLogin
+        self.messages = messages
+        self.dirty = False
+
+    @property
+    def avatar(self):
+        if self.avatar_id is None:
+            return None
+        return loadAvatar(self.avatar_id)
+
+    def materialize(self):
+        self.dirty = True
+        Session.materialize(self)
+
+    def saveMessages(self):
+        if self.isMaterialized:
+            self.dirty = True
+
+    def _saveState(self):
+        self.dirty = True
+
+    def setAvatarID(self, avatar_id):
+        if avatar_id != self.avatar_id:
+            self.avatar_id = avatar_id
+            self.materialize()
+
+    def setPersistent(self, is_persistent):
+        if is_persistent != self.isPersistent:
+            self.isPersistent = is_persistent
+            self.materialize()
+
+    def touch(self):
+        now = nowstamp()
+        if now - self.touched > self._touch_granularity:
+            self.touched = now
+            if self.isMaterialized:
+                self.dirty = True
+
+    def cookieValue(self):
+        return self.manager.encode(self)
+
+    def __repr__(self):
+        return "<CookieSession '%s'>" % self.uid
+
+
+class CookieSessionManager(SessionManager):
+    """
+    Handle sessions without server-side state.
+
+    The session is serialized as JSON into the cookie itself, signed with
+    HMAC-SHA256 using the C{sessionSecret} config key. If
+    C{sessionEncryptionKey} is set (a Fernet key, needs the C{cryptography}
+    package), the payload is also encrypted, otherwise it is readable, but
+    not changeable, by the client.
+
+    Logging out only changes the cookie, so a copy of an older cookie stays
+    valid until C{sessionMaxAge} runs out.
+    """
+    # Browsers drop cookies larger than about 4kB
+    maxCookieSize = 4000
+
+    def __init__(self, secret=None, encryptionKey=None):
+        secret = secret or runtime.config.get('sessionSecret')
+        if not secret:
+            raise ValueError("The 'cookie' session backend needs 'sessionSecret' in config")
+        self.secret = secret
+
+        encryptionKey = encryptionKey or runtime.config.get('sessionEncryptionKey')
+        self.fernet = None
+        if encryptionKey:
+            if Fernet is None:
+                raise ValueError("'sessionEncryptionKey' needs the cryptography package")
+            self.fernet = Fernet(encryptionKey)
+
+    def createSession(self):
+        session = CookieSession(self, self._mkuid())
+        session.isMaterialized = False
+        return session
+
+    def getSession(self, value):
+        """
+        Decode session from cookie value, or return C{None} if it isn't
+        validly signed.
+        """
+        data = self.decode(value)
+        if data is None:
+            return None
+        try:
+            return CookieSession(
+                self, str(data['id']), data.get('avatar_id'), data['touched'],
+                data.get('persistent', False), data.get('language', DEFAULT_LANG),
+                data.get('afterLogin'), data.get('messages'))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def encode(self, session):
+        data = {
+            'id': session.uid,
+            'touched': session.touched,
+        }
+        if session.avatar_id is not None:
+            data['avatar_id'] = session.avatar_id
+        if session.isPersistent:
+            data['persistent'] = True
+        if session.language != DEFAULT_LANG:
+            data['language'] = session.language
+        if session.afterLogin is not None:
+            data['afterLogin'] = session.afterLogin
+        if session.messages:
+            data['messages'] = session.messages
+
+        payload = json.dumps(data, separators=(',', ':'))
+        if self.fernet is not None:
+            body = self.fernet.encrypt(payload)
+        else:
+            body = base64.urlsafe_b64encode(payload)
+        value = "%s.%s" % (body, self._sign(body))
+
+        if len(value) > self.maxCookieSize:
+            log.msg("Session cookie for %s is %d bytes, browsers may drop it"
+                    % (session.uid, len(value)))
+        return value
+
+    def decode(self, value):
+        body, _, signature = value.rpartition('.')
+        if not body or not hmac.compare_digest(self._sign(body), signature):
+            return None
+        try:
+            if self.fernet is not None:
+                payload = self.fernet.decrypt(body)
+            else:
+                payload = base64.urlsafe_b64decode(body)
+            return json.loads(payload)
+        except (InvalidTokenError, TypeError, ValueError):
+            return None
+
+    def _sign(self, body):
+        return base64.urlsafe_b64encode(
+            hmac.new(self.secret, body, hashlib.sha256).digest()).rstrip('=')
+
 # ---------------------------
 
 @stormSchema.versioned
@@ -325,3 +872,29 @@ class AvatarRole(Storm):
     avatar = Reference(avatar_id, "Avatar.id")
     role_name = RawStr()
     position = Int()
+
+
+@changeHandler(AvatarRole)
+def _roleChanged(avatar_role, change):
+    roleCache.invalidate(avatar_role.avatar_id)
+
+@changeHandler(Avatar)
+def _avatarChanged(avatar, change):
+    roleCache.invalidate(avatar.id)
+
+
+# Session managers selectable with the 'sessionBackend' config key
+sessionBackends = {
+    'db': SessionManager,
+    'cached': CachedSessionManager,
+    'memory': SessionManagerBase,
+    'cookie': CookieSessionManager,
+}
+
+def makeSessionManager(backend):
+    try:
+        return sessionBackends[backend]()
+    except KeyError:
+        raise ValueError("Unknown session backend %r (choose from %s)"
+                         % (backend, ", ".join(sorted(sessionBackends))))
+
@@ -1,21 +1,138 @@
-from collections import defaultdict
+"""
+Events emitted by models, run once the store commits.
+
+Handlers registered with L{handler} run synchronously after the commit by
+default. With C{mode=QUEUE} they run in a later reactor turn, after the
+response has been written, and with C{mode=THREAD} on a thread pool of
+C{eventThreads} threads (they mustn't use the store there: take the ids
+and other values they need from the object, and open their own store if
+they must). Queued and threaded handlers registered with C{batch=True}
+are called once with a list of up to C{eventBatchSize} pending events
+instead of once per event.
+
+Handlers with C{mode=OUTBOX} survive the process dying: the event is
+written to the C{warp_outbox} table in the transaction that emitted it,
+and run by the relay in L{warp.common.outbox}, at least once.
+"""
+import time
+from collections import defaultdict, deque
 
 from storm.locals import Store, Storm
 from storm.info import get_obj_info
+from storm.store import PENDING_ADD, PENDING_REMOVE
 
+from twisted.application.service import Service
+from twisted.internet import reactor, defer
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThreadPool
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+from warp import metrics
 
+# How event handlers are run
+SYNC, QUEUE, THREAD, OUTBOX = 'sync', 'queue', 'thread', 'outbox'
+
+# (model name or None, event) -> list of EventHandlers
 handlers = defaultdict(list)
 
-def handler(event, *models):
+# (model name, event) -> tuple of EventHandlers for it, built on first use
+_handlerTable = {}
+
+# Model name -> class, for models with handlers
+eventModels = {}
+
+# Model name -> functions called with each committed changed object
+changeHandlers = defaultdict(list)
+
+# What happened to an object, as passed to change handlers
+ADDED, CHANGED, REMOVED = 'added', 'changed', 'removed'
+
+class EventHandler(object):
+    def __init__(self, fun, mode=SYNC, batch=False):
+        if mode not in (SYNC, QUEUE, THREAD, OUTBOX):
+            raise ValueError("Unknown event handler mode %r" % mode)
+        if batch and mode not in (QUEUE, THREAD):
+            raise ValueError("Only queued or threaded handlers can be batched")
+        self.fun = fun
+        self.mode = mode
+        self.batch = batch
+        self.name = "%s.%s" % (fun.__module__, fun.__name__)
+
+
+def handler(event, *models, **options):
+    """
+    Register a function to be called as C{fun(obj, **kwargs)} when an object
+    of one of C{models} (or any object, if none are given) emits C{event}.
+
+    @keyword mode: L{SYNC} (the default), L{QUEUE}, L{THREAD} or L{OUTBOX}.
+        Outbox handlers need C{models}, to load the object again.
+    @keyword batch: Call C{fun} with a list of L{PendingEvent}s instead
+    """
     if not models:
+        if options.get('mode') == OUTBOX:
+            raise ValueError("Outbox handlers must name their models")
         models = [None]
     else:
+        for model in models:
+            eventModels[model.__name__] = model
         models = [model.__name__ for model in models]
 
     def decorate(fun):
+        eventHandler = EventHandler(fun, **options)
         for modelName in models:
-            handlers[(modelName, event)].append(fun)
+            handlers[(modelName, event)].append(eventHandler)
+        _handlerTable.clear()
+        return fun
+
+    return decorate
+
+def getHandlers(modelName, event):
+    """
+    @return: The handlers for C{event} emitted by objects of C{modelName}:
+        those registered for the model, then those for any model
+    """
+    try:
+        return _handlerTable[(modelName, event)]
+    except KeyError:
+        pass
+
+    found, funs = [], set()
+    for eventHandler in handlers.get((modelName, event), []) + handlers.get((None, event), []):
+        if eventHandler.fun not in funs:
+            funs.add(eventHandler.fun)
+            found.append(eventHandler)
+    table = _handlerTable[(modelName, event)] = tuple(found)
+    return table
+
+def hasOutboxHandlers():
+    return any(eventHandler.mode == OUTBOX
+               for eventHandlers in handlers.itervalues()
+               for eventHandler in eventHandlers)
+
+def isDurable(modelName, event):
+    """
+    Whether C{event} has outbox handlers for C{modelName}.
+    """
+    for eventHandler in getHandlers(modelName, event):
+        if eventHandler.mode == OUTBOX:
+            return True
+    return False
+
+
+def changeHandler(*models):
+    """
+    Register a function to be called with every object of the given models
+    which was added, changed or removed, once the change is committed. It
+    is called as C{fun(obj, change)}, C{change} being one of L{ADDED},
+    L{CHANGED} or L{REMOVED}, once for each time the object was flushed.
+
+    Only changes flushed from objects are seen, not bulk changes made with
+    C{ResultSet.set} or C{ResultSet.remove}.
+    """
+    def decorate(fun):
+        for model in models:
+            changeHandlers[model.__name__].append(fun)
         return fun
 
     return decorate
@@ -24,15 +141,38 @@ def handler(event, *models):
 class CommitEventStore(Store):
     def __init__(self, database, cache=None):
         self.events = []
+        self.changed = []
         super(CommitEventStore, self).__init__(database, cache)
 
     def rollback(self):
         self.events = []
+        self.changed = []
         super(CommitEventStore, self).rollback()
 
+    def _flush_one(self, obj_info):
+        if obj_info.cls_info.cls.__name__ in changeHandlers:
+            pending = obj_info.get("pending")
+            if pending is PENDING_ADD:
+                change = ADDED
+            elif pending is PENDING_REMOVE:
+                change = REMOVED
+            else:
+                change = CHANGED
+            self.changed.append((obj_info.get_obj(), change))
+        super(CommitEventStore, self)._flush_one(obj_info)
+
     def commit(self):
+        self._writeOutbox(self.events)
         super(CommitEventStore, self).commit()
 
+        changed, self.changed = self.changed, []
+        for (obj, change) in changed:
+            for fun in changeHandlers.get(obj.__class__.__name__, ()):
+                try:
+                    fun(obj, change)
+                except Exception:
+                    log.err()
+
         # Event handlers can emit new events, which will run after
         # all existing events are handled. Do a little dance here
         # to make this clean.
@@ -41,6 +181,24 @@ class CommitEventStore(Store):
             self.events = []
             for event in events:
                 event.run()
+            # Commit outbox rows for events emitted by the handlers
+            if self._writeOutbox(self.events):
+                super(CommitEventStore, self).commit()
+
+    def _writeOutbox(self, events):
+        durable = [event for event in events
+                   if isDurable(event.obj.__class__.__name__, event.event)]
+        if not durable:
+            return False
+
+        # warp.common.outbox imports this module
+        from warp.common.outbox import OutboxEvent
+
+        # New objects need their primary keys
+        self.flush()
+        for event in durable:
+            self.add(OutboxEvent.fromEvent(event))
+        return True
 
 
 class EventModel(Storm):
@@ -59,12 +217,115 @@ class PendingEvent(object):
         self.kwargs = kwargs
 
     def run(self):
-        modelName = self.obj.__class__.__name__
-        eventHandlers = (set(handlers.get((modelName, self.event), []))
-                         | set(handlers.get((None, self.event), [])))
-
-        for handler in eventHandlers:
-            try:
-                handler(self.obj, **self.kwargs)
-            except Exception:
-                log.err()
+        dispatcher.dispatch(self)
+
+
+class EventDispatcher(Service):
+    """
+    Runs event handlers in their modes.
+
+    Each queued or threaded handler has its own queue. Queues are drained in
+    a later reactor turn, at most C{batchSize} events per handler at a time,
+    which batched handlers get in one call. At most C{maxThreads} threaded
+    batches run at once; the rest wait in their queues.
+    """
+    def __init__(self, maxThreads=4, batchSize=100):
+        self.maxThreads = maxThreads
+        self.batchSize = batchSize
+        # EventHandler -> deque of PendingEvents
+        self.queues = {}
+        self.depth = 0
+        self.threadsBusy = 0
+        self.pool = None
+        self._drainCall = None
+
+    def configure(self, maxThreads, batchSize):
+        self.maxThreads = maxThreads
+        self.batchSize = batchSize
+
+    def dispatch(self, event):
+        for eventHandler in getHandlers(event.obj.__class__.__name__, event.event):
+            if eventHandler.mode == OUTBOX:
+                continue
+            elif eventHandler.mode == SYNC:
+                self._call(eventHandler, [event])
+            else:
+                self.queues.setdefault(eventHandler, deque()).append(event)
+                self.depth += 1
+                self._scheduleDrain()
+        metrics.eventQueueDepth.set(self.depth)
+
+    def _scheduleDrain(self):
+        if self._drainCall is None:
+            self._drainCall = reactor.callLater(0, self.drain)
+
+    def drain(self):
+        """
+        Run one batch from each queue which has events waiting.
+        """
+        self._drainCall = None
+        for (eventHandler, queue) in self.queues.items():
+            if eventHandler.mode == THREAD and self.threadsBusy >= self.maxThreads:
+                continue
+
+            batch = [queue.popleft() for _ in xrange(min(self.batchSize, len(queue)))]
+            if not queue:
+                del self.queues[eventHandler]
+            self.depth -= len(batch)
+
+            if eventHandler.mode == THREAD:
+                self.threadsBusy += 1
+                d = deferToThreadPool(reactor, self.getPool(),
+                                      self._call, eventHandler, batch)
+                d.addBoth(self._threadDone)
+            else:
+                self._call(eventHandler, batch)
+
+        metrics.eventQueueDepth.set(self.depth)
+        if self.queues and self.threadsBusy < self.maxThreads:
+            self._scheduleDrain()
+
+    def _threadDone(self, result):
+        self.threadsBusy -= 1
+        if self.queues:
+            self._scheduleDrain()
+        return result
+
+    def _call(self, eventHandler, batch):
+        if eventHandler.batch:
+            self._run(eventHandler, batch)
+        else:
+            for event in batch:
+                self._run(eventHandler, event.obj, **event.kwargs)
+
+    def _run(self, eventHandler, *args, **kwargs):
+        start = time.time()
+        try:
+            eventHandler.fun(*args, **kwargs)
+        except Exception:
+            log.err(None, "Error in event handler %s" % eventHandler.name)
+        metrics.eventHandlerSeconds.labels(eventHandler.name).observe(
+            time.time() - start)
+
+    def getPool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(0, self.maxThreads, name="warp-events")
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        return self.pool
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        """
+        Run what's left in the queues before shutting down.
+        """
+        Service.stopService(self)
+        while self.queues or self.threadsBusy:
+            if self._drainCall is not None:
+                self._drainCall.cancel()
+            self.drain()
+            if self.queues or self.threadsBusy:
+                yield deferLater(reactor, 0.05, lambda: None)
+
+
+dispatcher = EventDispatcher()
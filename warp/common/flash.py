@@ -0,0 +1,147 @@
+"""
+Flash message storage.
+
+Flash messages are shown to the user once, on their next page load. Where
+they are kept is selected with the C{flashStore} config key:
+
+ - C{'memory'}: in the worker process, bounded in entries, age and size.
+   Only works if the next request goes to the same process.
+ - C{'session'}: with the session itself, i.e. in the C{warp_session} row
+   for database sessions and in the cookie for cookie sessions.
+
+The default is C{'session'} for the cookie session backend and
+C{'memory'} otherwise.
+"""
+import time
+from collections import OrderedDict
+
+from warp import metrics
+from warp.runtime import config
+
+# Messages beyond this many per session push out the oldest
+MAX_PER_SESSION = 20
+
+
+def messageSize(message):
+    """
+    Approximate memory used by one C{(msg, args, kwargs)} message, in bytes.
+    """
+    msg, args, kwargs = message
+    return len(msg) + len(repr(args)) + len(repr(kwargs))
+
+
+class MemoryFlashStore(object):
+    """
+    Flash messages in a per-process dict, keyed by session uid.
+
+    Entries expire C{flashTTL} seconds after their last message was added,
+    and the oldest are dropped when there are more than C{flashMaxEntries}
+    sessions with messages or they take more than C{flashMaxBytes}. So
+    messages of abandoned sessions can't pile up in a long-running worker.
+    """
+    def __init__(self, maxEntries=None, ttl=None, maxBytes=None):
+        self.maxEntries = maxEntries or config.get('flashMaxEntries', 10000)
+        self.ttl = ttl or config.get('flashTTL', 3600)
+        self.maxBytes = maxBytes or config.get('flashMaxBytes', 10 * 1024 * 1024)
+
+        # uid -> (expires, size, messages), oldest first
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def add(self, session, message):
+        self.expire()
+
+        entry = self.entries.pop(session.uid, None)
+        messages = entry[2] if entry is not None else []
+        messages.append(message)
+        del messages[:-MAX_PER_SESSION]
+
+        size = sum(messageSize(m) for m in messages)
+        self.bytes += size - (entry[1] if entry is not None else 0)
+        self.entries[session.uid] = (time.time() + self.ttl, size, messages)
+
+        while self.entries and (len(self.entries) > self.maxEntries or
+                                self.bytes > self.maxBytes):
+            uid, entry = self.entries.popitem(last=False)
+            self.bytes -= entry[1]
+            metrics.flashMessagesEvicted.inc(len(entry[2]))
+        self._updateMetrics()
+
+    def get(self, session, clear=True):
+        entry = self.entries.get(session.uid)
+        if entry is None:
+            return []
+
+        expires, size, messages = entry
+        if expires < time.time():
+            metrics.flashMessagesExpired.inc(len(messages))
+            clear, messages = True, []
+
+        if clear:
+            del self.entries[session.uid]
+            self.bytes -= size
+            self._updateMetrics()
+        return messages[:]
+
+    def expire(self):
+        """
+        Drop expired entries.
+        """
+        now = time.time()
+        while self.entries:
+            uid, entry = next(self.entries.iteritems())
+            if entry[0] >= now:
+                break
+            del self.entries[uid]
+            self.bytes -= entry[1]
+            metrics.flashMessagesExpired.inc(len(entry[2]))
+        self._updateMetrics()
+
+    def _updateMetrics(self):
+        metrics.flashStoreEntries.set(len(self.entries))
+        metrics.flashStoreBytes.set(self.bytes)
+
+
+class SessionFlashStore(object):
+    """
+    Flash messages kept in the session's C{messages} attribute, which the
+    session writes to its backend in C{saveMessages}.
+    """
+    def add(self, session, message):
+        messages = list(session.messages or ())
+        messages.append(message)
+        session.messages = messages[-MAX_PER_SESSION:]
+        session.saveMessages()
+
+    def get(self, session, clear=True):
+        if not session.messages:
+            return []
+        # JSON round trips turn tuples into lists
+        messages = [(msg, tuple(args), kwargs)
+                    for (msg, args, kwargs) in session.messages]
+        if clear:
+            session.messages = None
+            session.saveMessages()
+        return messages
+
+
+flashStores = {
+    'memory': MemoryFlashStore,
+    'session': SessionFlashStore,
+}
+
+# Created from config on first use
+store = None
+
+def getStore():
+    global store
+    if store is None:
+        name = config.get('flashStore')
+        if name is None:
+            name = 'session' if config.get('sessionBackend') == 'cookie' else 'memory'
+        try:
+            store = flashStores[name]()
+        except KeyError:
+            raise ValueError("Unknown flash store %r (choose from %s)"
+                             % (name, ", ".join(sorted(flashStores))))
+    return store
@@ -0,0 +1,187 @@
+"""
+Durable event delivery.
+
+Events with C{OUTBOX} handlers are written to the C{warp_outbox} table
+by L{CommitEventStore.commit}, in the same transaction as the changes
+that emitted them. The L{OutboxRelay} picks them up in batches of
+C{outboxBatchSize}, claims each one for C{outboxLease} seconds, runs its
+outbox handlers as C{fun(obj, **kwargs)} and deletes the row, committing
+whatever the handlers changed along with it.
+
+Delivery is at least once: if the relay dies after a handler ran but
+before the row was deleted, the event runs again once the claim expires.
+A failing event is retried with growing delays, and left in the table for
+inspection after C{outboxMaxAttempts} attempts. C{obj} is C{None} if the
+object was removed before the event ran.
+
+The relay runs in every web process unless C{outboxRelay} is C{False} in
+config, in which case run C{twistd warp eventworker} instead.
+"""
+import time
+
+from storm.locals import Storm, Int, Unicode, JSON
+from storm.info import get_obj_info
+from storm.expr import And, Update
+
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.python import log
+
+from warp import runtime, metrics
+from warp.common import events
+from warp.common.schema import stormSchema
+
+
+@stormSchema.versioned
+class OutboxEvent(Storm):
+    __version__ = "warp_1"
+    __storm_table__ = "warp_outbox"
+
+    id = Int(primary=True)
+    model = Unicode()
+    # Primary key values of the object
+    object_key = JSON()
+    event = Unicode()
+    kwargs = JSON()
+    created = Int()
+    # Not run before this time; also the end of a relay's claim
+    available = Int()
+    attempts = Int(default=0)
+    last_error = Unicode()
+
+    @classmethod
+    def fromEvent(cls, pendingEvent):
+        row = cls()
+        row.model = unicode(pendingEvent.obj.__class__.__name__)
+        row.object_key = [variable.get()
+                          for variable in get_obj_info(pendingEvent.obj)['primary_vars']]
+        row.event = unicode(pendingEvent.event)
+        row.kwargs = pendingEvent.kwargs or {}
+        row.created = row.available = int(time.time())
+        return row
+
+    def load(self, store):
+        model = events.eventModels.get(self.model)
+        if model is None:
+            raise LookupError("No outbox handlers registered for %s" % self.model)
+        key = self.object_key
+        return store.get(model, key[0] if len(key) == 1 else tuple(key))
+
+
+class OutboxRelay(Service):
+    """
+    Service running outbox events every C{outboxInterval} seconds, and
+    straight away while there is a backlog.
+    """
+    minDelay = 0.05
+
+    def __init__(self, store=None, batchSize=None, interval=None,
+                 maxAttempts=None, lease=None):
+        config = runtime.config
+        self.store = store or runtime.avatar_store
+        self.batchSize = batchSize or config.get('outboxBatchSize', 100)
+        self.interval = interval or config.get('outboxInterval', 1)
+        self.maxAttempts = maxAttempts or config.get('outboxMaxAttempts', 10)
+        self.lease = lease or config.get('outboxLease', 300)
+        self.call = None
+
+    def startService(self):
+        Service.startService(self)
+        self.schedule(self.interval)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def schedule(self, delay):
+        self.call = reactor.callLater(delay, self.run)
+
+    def run(self):
+        try:
+            count = self.relayBatch()
+        except Exception:
+            log.err(None, "Outbox relay failed")
+            self.store.rollback()
+            count = 0
+
+        if count == self.batchSize:
+            self.schedule(self.minDelay)
+        else:
+            self.schedule(self.interval)
+
+    def claim(self, now):
+        """
+        Claim a batch of events that are due, against other relays.
+
+        @return: The claimed ids
+        """
+        store = self.store
+        ids = list(store.find(OutboxEvent.id,
+                              OutboxEvent.available <= now,
+                              OutboxEvent.attempts < self.maxAttempts)
+                   .order_by(OutboxEvent.id)[:self.batchSize])
+        claimed = []
+        for eventID in ids:
+            result = store.execute(Update(
+                {OutboxEvent.available: now + self.lease},
+                And(OutboxEvent.id == eventID, OutboxEvent.available <= now),
+                OutboxEvent))
+            if result.rowcount:
+                claimed.append(eventID)
+        store.commit()
+        return claimed
+
+    def relayBatch(self):
+        """
+        Run one batch of outbox events.
+
+        @return: Number of events claimed
+        """
+        # Sites without outbox handlers needn't have the table
+        if not events.hasOutboxHandlers():
+            return 0
+
+        store = self.store
+        claimed = self.claim(int(time.time()))
+        for eventID in claimed:
+            row = store.get(OutboxEvent, eventID)
+            try:
+                self.runEvent(row)
+                store.remove(row)
+                store.commit()
+                metrics.outboxEventsRelayed.inc()
+            except Exception as e:
+                log.err(None, "Outbox event %d (%s.%s) failed" % (eventID, row.model, row.event))
+                store.rollback()
+                self.retry(store.get(OutboxEvent, eventID), e)
+                metrics.outboxEventFailures.inc()
+        return len(claimed)
+
+    def runEvent(self, row):
+        obj = row.load(self.store)
+        kwargs = dict((str(k), v) for (k, v) in row.kwargs.iteritems())
+        for eventHandler in events.getHandlers(row.model, row.event):
+            if eventHandler.mode == events.OUTBOX:
+                eventHandler.fun(obj, **kwargs)
+
+    def retry(self, row, error):
+        row.attempts += 1
+        row.last_error = unicode(repr(error))
+        if row.attempts >= self.maxAttempts:
+            log.msg("Giving up on outbox event %d after %d attempts"
+                    % (row.id, row.attempts))
+        # 2, 4, 8... intervals, at most an hour
+        row.available = int(time.time() + min(self.interval * 2 ** row.attempts, 3600))
+        self.store.commit()
+
+
+def makeRelay():
+    """
+    Get an L{OutboxRelay} to run in this process, or C{None} if a separate
+    C{eventworker} runs it.
+    """
+    if not runtime.config.get('outboxRelay', True):
+        return None
+    return OutboxRelay()
@@ -0,0 +1,222 @@
+"""
+Route table for site nodes.
+
+The site's C{nodes} directory is scanned once, at startup, into a trie of
+L{Route} objects. Resolving a URL is then a dictionary lookup per segment,
+and unknown paths never touch the import machinery.
+"""
+import os
+import time
+
+from twisted.python import log
+
+
+class Route(object):
+    """
+    One package directory under the site's nodes directory.
+
+    @ivar path: Filesystem path of the directory
+    @ivar moduleName: Dotted name of the package, e.g. C{nodes.home}
+    @ivar node: The node module (C{nodes/home/home.py}), or C{None} if the
+        package doesn't have one
+    @ivar children: Sub-routes, keyed by URL segment
+    @ivar templates: Paths of node-local C{.mak} templates, keyed by facet name
+    @ivar facets: Names of all facets the node can render
+    """
+    def __init__(self, path, moduleName):
+        self.path = path
+        self.moduleName = moduleName
+        self.node = None
+        self.children = {}
+        self.templates = {}
+        self.facets = frozenset()
+        self.signature = None
+
+    @property
+    def name(self):
+        return self.moduleName.rsplit('.', 1)[-1]
+
+    def __repr__(self):
+        return "<Route %s (%s)>" % (self.moduleName, self.node and self.node.__name__)
+
+
+class RouteTable(object):
+    """
+    Trie of node modules and their facets.
+
+    Instantiated uninitialised in L{warp.runtime} and initialised once the
+    site directory is known, like the template lookup.
+    """
+    # Set by __init__, None means the table hasn't been built yet
+    root = None
+
+    # Minimum seconds between two filesystem checks in L{refresh}
+    checkInterval = 1.0
+
+    def __init__(self, nodesDir, packageName='nodes'):
+        """
+        @param nodesDir: The site's nodes directory
+        @type  nodesDir: L{twisted.python.filepath.FilePath}
+        """
+        self.nodesDir = nodesDir
+        self.packageName = packageName
+        self.byModule = {}
+        self.lastCheck = 0
+        self.build()
+
+    def build(self):
+        """
+        Scan the nodes directory from scratch.
+        """
+        self.byModule.clear()
+        root = Route(self.nodesDir.path, self.packageName)
+        if os.path.isdir(root.path):
+            self._scanChildren(root)
+            root.signature = self._signature(root)
+        self.root = root
+
+    def lookup(self, segments):
+        """
+        Get the L{Route} for a list of URL segments, or C{None}.
+        """
+        route = self.root
+        for segment in segments:
+            route = route.children.get(segment)
+            if route is None:
+                return None
+        return route
+
+    def getNode(self, name):
+        """
+        Get node module for a slash-separated node name, or C{None}.
+        """
+        route = self.lookup(name.split('/'))
+        if route is not None:
+            return route.node
+
+    def routeFor(self, node):
+        """
+        Get the L{Route} of a node module, or C{None} if it wasn't scanned.
+        """
+        if self.root is None:
+            return None
+        return self.byModule.get(getattr(node, '__name__', None))
+
+    def refresh(self):
+        """
+        Rescan only the parts of the tree whose files changed on disk.
+        Meant for development; checks at most once per C{checkInterval}.
+
+        @return: List of routes that were reloaded
+        """
+        now = time.time()
+        if now - self.lastCheck < self.checkInterval:
+            return []
+        self.lastCheck = now
+
+        changed = []
+        self._refresh(self.root, changed)
+        return changed
+
+    # ------------------------------------------------------------------
+
+    def _scanChildren(self, route):
+        for name in sorted(os.listdir(route.path)):
+            path = os.path.join(route.path, name)
+            if not os.path.isfile(os.path.join(path, '__init__.py')):
+                continue
+            child = Route(path, "%s.%s" % (route.moduleName, name))
+            self._load(child)
+            self._scanChildren(child)
+            route.children[name] = child
+
+    def _load(self, route):
+        if route.node is not None:
+            self.byModule.pop(route.node.__name__, None)
+
+        route.node = self._importNode(route)
+        route.templates = dict(
+            (name[:-4], os.path.join(route.path, name))
+            for name in os.listdir(route.path)
+            if name.endswith('.mak'))
+        route.facets = self._findFacets(route)
+        route.signature = self._signature(route)
+
+        if route.node is not None:
+            self.byModule[route.node.__name__] = route
+
+    def _importNode(self, route):
+        name = route.name
+        try:
+            node = getattr(__import__(route.moduleName, fromlist=[name]), name, None)
+        except Exception:
+            log.err(None, "Couldn't load node %s" % route.moduleName)
+            return None
+
+        if node is not None and route.signature is not None:
+            # Already imported before, so this is a change on disk
+            node = reload(node)
+        return node
+
+    def _findFacets(self, route):
+        facets = set(route.templates)
+        for obj in (route.node, getattr(route.node, 'renderer', None)):
+            if obj is not None:
+                facets.update(name[7:] for name in dir(obj)
+                              if name.startswith('render_'))
+        return frozenset(facets)
+
+    def _signature(self, route):
+        files = [route.path]
+        if route.node is not None:
+            files.append(_sourceFile(route.node))
+        try:
+            return tuple(os.stat(f).st_mtime for f in files)
+        except OSError:
+            return None
+
+    def _refresh(self, route, changed):
+        signature = self._signature(route)
+        if signature != route.signature:
+            if route is not self.root:
+                self._load(route)
+                changed.append(route)
+            else:
+                route.signature = signature
+
+            # Pick up new and removed sub-packages
+            old = route.children
+            route.children = {}
+            for name in sorted(os.listdir(route.path)):
+                path = os.path.join(route.path, name)
+                if not os.path.isfile(os.path.join(path, '__init__.py')):
+                    continue
+                child = old.get(name)
+                if child is None:
+                    child = Route(path, "%s.%s" % (route.moduleName, name))
+                    self._load(child)
+                    self._scanChildren(child)
+                    changed.append(child)
+                route.children[name] = child
+
+            for name, child in old.iteritems():
+                if name not in route.children:
+                    self._forget(child)
+
+        for child in route.children.values():
+            self._refresh(child, changed)
+
+    def _forget(self, route):
+        if route.node is not None:
+            self.byModule.pop(route.node.__name__, None)
+        for child in route.children.itervalues():
+            self._forget(child)
+
+
+def _sourceFile(module):
+    path = module.__file__
+    if path.endswith(('.pyc', '.pyo')):
+        source = path[:-1]
+        if os.path.exists(source):
+            return source
+    return path
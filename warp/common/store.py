@@ -54,6 +54,11 @@ def get_creation_sql(store, db_uri):
                 ('warp_session', """
                 CREATE TABLE warp_session (
                     uid BYTEA NOT NULL PRIMARY KEY,
+                    isPersistent BOOLEAN NOT NULL DEFAULT FALSE,
+                    touched INTEGER,
+                    messages TEXT,
+                    language VARCHAR,
+                    after_login VARCHAR,
                     avatar_id INTEGER REFERENCES warp_avatar(id) ON DELETE CASCADE)"""),
                 ('warp_avatar_role', """
                 CREATE TABLE warp_avatar_role (
@@ -61,6 +66,17 @@ def get_creation_sql(store, db_uri):
                     avatar_id INTEGER NOT NULL REFERENCES warp_avatar(id) ON DELETE CASCADE,
                     role_name BYTEA NOT NULL,
                     position INTEGER NOT NULL DEFAULT 0)"""),
+                ('warp_outbox', """
+                CREATE TABLE warp_outbox (
+                    id INTEGER NOT NULL PRIMARY KEY,
+                    model VARCHAR NOT NULL,
+                    object_key TEXT NOT NULL,
+                    event VARCHAR NOT NULL,
+                    kwargs TEXT,
+                    created INTEGER NOT NULL,
+                    available INTEGER NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT)"""),
                 ],
             },
         'MySQLConnection': {
@@ -80,7 +96,13 @@ def get_creation_sql(store, db_uri):
                 ('warp_session', """
                 CREATE TABLE warp_session (
                     uid VARBINARY(32) NOT NULL PRIMARY KEY,
-                    avatar_id INTEGER REFERENCES warp_avatar(id) ON DELETE CASCADE
+                    isPersistent BOOLEAN NOT NULL DEFAULT FALSE,
+                    touched INTEGER,
+                    messages TEXT,
+                    language VARCHAR(16),
+                    after_login TEXT,
+                    avatar_id INTEGER REFERENCES warp_avatar(id) ON DELETE CASCADE,
+                    INDEX warp_session_touched_idx (touched)
                   ) engine=InnoDB, charset=utf8"""),
                 ('warp_avatar_role', """
                 CREATE TABLE warp_avatar_role (
@@ -89,6 +111,19 @@ def get_creation_sql(store, db_uri):
                     role_name VARBINARY(32) NOT NULL,
                     position INTEGER NOT NULL
                   ) engine=InnoDB, charset=utf8"""),
+                ('warp_outbox', """
+                CREATE TABLE warp_outbox (
+                    id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                    model VARCHAR(255) NOT NULL,
+                    object_key TEXT NOT NULL,
+                    event VARCHAR(255) NOT NULL,
+                    kwargs TEXT,
+                    created INTEGER NOT NULL,
+                    available INTEGER NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    INDEX warp_outbox_available (available)
+                  ) engine=InnoDB, charset=utf8"""),
                 ],
             },
     }.get(conn_type)
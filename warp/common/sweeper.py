@@ -0,0 +1,139 @@
+"""
+Deletion of expired sessions.
+
+Non-persistent sessions which haven't been touched for C{sessionMaxAge}
+seconds are deleted in small batches, so the sweep never holds long locks
+or blocks the reactor for long. After each batch the sweeper waits a
+multiple of the time the batch took, so it backs off when the database is
+slow.
+
+Swept sessions are also dropped from the cache of a
+L{CachedSessionManager} in the same process.
+"""
+from __future__ import print_function
+import time
+
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.python import log
+
+from warp import runtime, metrics
+from warp.common.avatar import DBSession, nowstamp
+
+
+class SessionSweeper(Service):
+    """
+    Service deleting expired sessions every C{sessionSweepInterval} seconds.
+
+    @ivar pacing: Wait this many times the duration of a batch before the
+        next one, so the sweeper uses at most about C{1 / (pacing + 1)} of
+        the database's time
+    """
+    pacing = 4
+    minDelay = 0.05
+
+    def __init__(self, maxAge=None, batchSize=None, interval=None,
+                 sessionManager=None):
+        self.maxAge = maxAge or runtime.config['sessionMaxAge']
+        self.batchSize = batchSize or runtime.config.get('sessionSweepBatchSize', 500)
+        self.interval = interval or runtime.config.get('sessionSweepInterval', 300)
+        self.sessionManager = sessionManager
+        self.call = None
+
+    def startService(self):
+        Service.startService(self)
+        self.schedule(self.interval, self.run)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def schedule(self, delay, fn, *args):
+        self.call = reactor.callLater(delay, fn, *args)
+
+    def sweepBatch(self):
+        """
+        Delete one batch of expired sessions.
+
+        @return: C{(deleted, seconds taken)}
+        """
+        store = runtime.avatar_store
+        start = time.time()
+        cutoff = nowstamp() - self.maxAge
+        try:
+            uids = list(store.find(DBSession.uid,
+                                   DBSession.isPersistent == False,
+                                   DBSession.touched < cutoff)[:self.batchSize])
+            if uids:
+                store.find(DBSession, DBSession.uid.is_in(uids)).remove()
+            store.commit()
+        except Exception:
+            store.rollback()
+            raise
+
+        if uids and hasattr(self.sessionManager, 'forget'):
+            self.sessionManager.forget(uids)
+
+        elapsed = time.time() - start
+        metrics.sessionSweepBatchSeconds.observe(elapsed)
+        metrics.sessionsSwept.inc(len(uids))
+        return len(uids), elapsed
+
+    def run(self, deleted=0, batches=0, started=None):
+        """
+        Sweep one batch, then schedule the next one, or the next run if
+        nothing is left.
+        """
+        if started is None:
+            started = time.time()
+
+        try:
+            count, elapsed = self.sweepBatch()
+        except Exception:
+            log.err(None, "Session sweep failed")
+            self.schedule(self.interval, self.run)
+            return
+
+        deleted += count
+        batches += 1
+        if count == self.batchSize:
+            delay = max(elapsed * self.pacing, self.minDelay)
+            self.schedule(delay, self.run, deleted, batches, started)
+            return
+
+        if deleted:
+            log.msg("Swept %d expired sessions in %d batches (%.1fs)"
+                    % (deleted, batches, time.time() - started))
+        self.schedule(self.interval, self.run)
+
+    def sweepAll(self, verbose=False):
+        """
+        Delete all expired sessions now, without the reactor.
+
+        @return: Number of sessions deleted
+        """
+        deleted = 0
+        while True:
+            count, elapsed = self.sweepBatch()
+            deleted += count
+            if verbose and count:
+                print("  %d sessions deleted" % deleted)
+            if count < self.batchSize:
+                return deleted
+            time.sleep(max(elapsed * self.pacing, self.minDelay))
+
+
+def makeSweeper():
+    """
+    Get a L{SessionSweeper} if sessions are stored in the database and
+    expire, otherwise C{None}.
+    """
+    config = runtime.config
+    if not config.get('sessionMaxAge') or not config.get('sessionSweep', True):
+        return None
+    if config.get('sessionBackend', 'db') not in ('db', 'cached'):
+        return None
+    site = config.get('warpSite')
+    return SessionSweeper(sessionManager=getattr(site, 'sessionManager', None))
@@ -1,78 +1,158 @@
-import operator
+"""
+Message translation.
+
+Message files are JSON, one per language (C{en_US.json}), nested by domain.
+They are merged into L{warp.runtime.messages} and then compiled into flat
+catalogs keyed by C{(domain, term)}, with the C{en_US} fallback already
+filled in, so translating a term is a single dictionary lookup. One
+translator is kept per language.
+
+With C{reloadMessages} set, only files whose modification time changed
+are read again. C{messageCacheFile} names a file (relative to the site
+directory) where parsed files and catalogs are kept between restarts.
+"""
+import marshal
+import os
+import time
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+from twisted.python import log
+
 from warp.runtime import config, messages
 
+FALLBACK_LANGUAGE = 'en_US'
+
+# Bump when the cache file layout changes
+CACHE_VERSION = 1
+
+# Minimum seconds between two checks for changed files
+checkInterval = 1.0
+
+# language -> ({(domain, term): translation}, frozenset of domains)
+catalogs = {}
+
+# language -> translator function
+_translators = {}
+
+# path -> (mtime, parsed content) of message files read by defaultLoader
+_files = {}
+# Paths of message files in merge order
+_fileOrder = []
+
+_lastCheck = 0
+
+
 def loadMessages():
-    config.get("messageLoader", defaultLoader)()
+    """
+    Load messages and compile catalogs. With the default loader this only
+    reads files which changed since the last call.
+    """
+    global _lastCheck
+
+    loader = config.get("messageLoader")
+    if loader is not None:
+        loader()
+        compileCatalogs()
+        return
+
+    now = time.time()
+    if catalogs and now - _lastCheck < checkInterval:
+        return
+    _lastCheck = now
+
+    if not catalogs and _loadCache():
+        return
+
+    if _readFiles() or not catalogs:
+        _mergeFiles()
+        compileCatalogs()
+        _saveCache()
 
 def defaultLoader():
-    messages.clear()
-    loadMessageDir(config['warpDir'].child('messages'))
-    loadMessageDir(config['siteDir'].child('messages'))
+    _readFiles()
+    _mergeFiles()
 
 def getTranslator(language):
-    lang_dict = messages.get(language, {})
-    use_fallback = language != 'en_US'
-    fallback_dict = messages.get('en_US', {}) if use_fallback else {}
+    translator = _translators.get(language)
+    if translator is None:
+        translator = _translators[language] = _makeTranslator(language)
+    return translator
+
+def compileCatalogs():
+    """
+    Flatten L{warp.runtime.messages} into L{catalogs}.
+    """
+    flat = {}
+    for (language, tree) in messages.iteritems():
+        entries, domains = {}, set()
+        _flatten(tree, None, entries, domains)
+        flat[language] = (entries, domains)
 
-    def get_namespace(base_dict, domain):
-        if domain is None:
-            return base_dict
+    fallback_entries, fallback_domains = flat.get(FALLBACK_LANGUAGE, ({}, set()))
+
+    catalogs.clear()
+    _translators.clear()
+    for (language, (entries, domains)) in flat.iteritems():
+        if language != FALLBACK_LANGUAGE:
+            merged = dict(fallback_entries)
+            merged.update(entries)
+            entries = merged
+            domains = domains | fallback_domains
+        catalogs[language] = (entries, frozenset(domains))
+
+# --------------------------------------- #
+
+def _flatten(tree, domain, entries, domains):
+    for (key, value) in tree.iteritems():
+        if isinstance(value, dict):
+            subdomain = key if domain is None else "%s:%s" % (domain, key)
+            domains.add(subdomain)
+            _flatten(value, subdomain, entries, domains)
+        else:
+            entries[(domain, key)] = value
+
+def _interpolate(text, args, kwargs):
+    if args:
+        try:
+            return text % args
+        except TypeError:
+            return None
+    if kwargs:
         try:
-            return reduce(operator.getitem, domain.split(":"), base_dict)
+            return text % kwargs
         except KeyError:
             return None
+    return text
 
-    def interpolate(text, args=None, kwargs=None):
-        if args:
-            try:
-                return text % args
-            except TypeError:
-                return None
-        if kwargs:
-            try:
-                return text % kwargs
-            except KeyError:
-                return None
-        return text
+def _makeTranslator(language):
+    empty = ({}, frozenset())
+    fallback_catalog = catalogs.get(FALLBACK_LANGUAGE, empty)
+    catalog, domains = catalogs.get(language, fallback_catalog)
+    fallback = fallback_catalog[0] if language != FALLBACK_LANGUAGE else None
 
     def t(term, *args, **kwargs):
         domain = kwargs.pop("_domain", None)
-        using_fallback = False
 
-        # Get namespace from primary language
-        namespace = get_namespace(lang_dict, domain)
-        if namespace is None:
-            if not use_fallback:
-                return u"MISSING DOMAIN: %s" % domain
-            # Try fallback namespace
-            namespace = get_namespace(fallback_dict, domain)
-            if namespace is None:
+        translation = catalog.get((domain, term))
+        if translation is None:
+            if domain is not None and domain not in domains:
                 return u"MISSING DOMAIN: %s" % domain
-            using_fallback = True
+            translation = term
 
-        # Get translation
-        translation = namespace.get(term)
-        if translation is None:
-            if use_fallback and not using_fallback:
-                translation = get_namespace(fallback_dict, domain).get(term, term)
-            else:
-                translation = term
+        if not (args or kwargs):
+            return translation
 
-        # Handle interpolation
-        result = interpolate(translation, args, kwargs)
+        result = _interpolate(translation, args, kwargs)
         if result is not None:
             return result
 
         # Try fallback interpolation
-        if use_fallback and not using_fallback:
-            fallback_translation = get_namespace(fallback_dict, domain).get(term, term)
-            result = interpolate(fallback_translation, args, kwargs)
+        if fallback is not None:
+            result = _interpolate(fallback.get((domain, term), term), args, kwargs)
             if result is not None:
                 return result
 
@@ -83,7 +163,100 @@ def getTranslator(language):
 
     return t
 
-# --------------------------------------- #
+def _messageFiles():
+    files = []
+    for directory in (config['warpDir'].child('messages'),
+                      config['siteDir'].child('messages')):
+        files.extend(sorted(directory.globChildren('*.json')))
+    return files
+
+def _readFiles():
+    """
+    Parse message files which are new or changed since they were last read.
+
+    @return: Whether any file was added, changed or removed
+    """
+    changed = False
+    order = []
+    for language_file in _messageFiles():
+        path = language_file.path
+        mtime = os.stat(path).st_mtime
+        entry = _files.get(path)
+        if entry is None or entry[0] != mtime:
+            with open(path, 'rb') as f:
+                _files[path] = (mtime, json.load(f))
+            changed = True
+        order.append(path)
+
+    for path in set(_files) - set(order):
+        del _files[path]
+        changed = True
+
+    _fileOrder[:] = order
+    return changed
+
+def _mergeFiles():
+    messages.clear()
+    for path in _fileOrder:
+        language = os.path.basename(path).split('.', 1)[0]
+        _mergeDicts(_files[path][1], messages.setdefault(language, {}))
+
+def _getCachePath():
+    cache_file = config.get('messageCacheFile')
+    if cache_file is None:
+        return None
+    return os.path.join(config['siteDir'].path, cache_file)
+
+def _loadCache():
+    """
+    Load files and catalogs from the cache file, if no message file changed
+    since it was written.
+    """
+    path = _getCachePath()
+    if path is None or not os.path.isfile(path):
+        return False
+
+    try:
+        with open(path, 'rb') as f:
+            cache = marshal.load(f)
+    except (EOFError, ValueError, TypeError, IOError):
+        return False
+    if cache.get('version') != CACHE_VERSION:
+        return False
+
+    order = [language_file.path for language_file in _messageFiles()]
+    if order != cache['order']:
+        return False
+    for file_path in order:
+        if os.stat(file_path).st_mtime != cache['files'][file_path][0]:
+            return False
+
+    _files.clear()
+    _files.update(cache['files'])
+    _fileOrder[:] = order
+    _mergeFiles()
+    catalogs.clear()
+    catalogs.update(cache['catalogs'])
+    _translators.clear()
+    return True
+
+def _saveCache():
+    path = _getCachePath()
+    if path is None:
+        return
+
+    cache = {
+        'version': CACHE_VERSION,
+        'order': _fileOrder,
+        'files': _files,
+        'catalogs': catalogs,
+    }
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            marshal.dump(cache, f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        log.err(None, "Couldn't write message cache %s" % path)
 
 def loadMessageDir(messageDir):
     for language_file in messageDir.globChildren('*.json'):
@@ -0,0 +1,114 @@
+"""
+Reference autocompletion.
+
+A L{warp.crud.colproxy.ReferenceProxy} with C{autocomplete=True} renders
+a text field instead of a C{<select>} of every referenced object, and only
+loads the label of the current one. What's typed is looked up through the
+C{autocomplete} facet of the crud node, a page of names at a time:
+
+    GET /things/autocomplete/owner?term=ab&page=1
+    {"results": [{"id": 3, "label": "Abbey Road"}, ...], "more": true}
+
+Names match when they start with the term, or with C{match=SUBSTRING}
+when they contain it. They come from the proxy's C{nameColumn}, or else
+the C{nameColumn} of the referenced crud model, which can be a column or
+an expression such as C{Lower(Thing.name)}. Index it: prefix searches on
+an indexed column don't scan the table, substring searches always do.
+
+Matches are labelled with the referenced crud model's C{name}, as the
+current value is, so a label doesn't change once it's picked.
+
+Results are cached for C{autocompleteCacheTTL} seconds, and dropped when
+objects of the referenced class are committed through the store.
+"""
+import time
+from collections import OrderedDict
+
+from storm.info import get_cls_info
+
+from warp import runtime
+from warp.common.events import changeHandler
+from warp.crud.listing import compileConditions
+
+PREFIX, SUBSTRING = 'prefix', 'substring'
+
+PAGE_SIZE = 20
+
+
+class SearchCache(object):
+    """
+    Recent searches, shared by all requests in the process.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        # (model name, search key) -> (expires, result)
+        self.entries = OrderedDict()
+        self.watched = set()
+
+    def get(self, model, key):
+        entry = self.entries.get((model.__name__, key))
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, model, key, result):
+        if model.__name__ not in self.watched:
+            self.watched.add(model.__name__)
+            changeHandler(model)(self._changed)
+
+        entryKey = (model.__name__, key)
+        self.entries.pop(entryKey, None)
+        self.entries[entryKey] = (
+            time.time() + runtime.config.get('autocompleteCacheTTL', 60), result)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, modelName):
+        for key in [key for key in self.entries if key[0] == modelName]:
+            del self.entries[key]
+
+    def _changed(self, obj, change):
+        self.invalidate(obj.__class__.__name__)
+
+
+searchCache = SearchCache()
+
+
+def escapeLike(term):
+    return term.replace(u'!', u'!!').replace(u'%', u'!%').replace(u'_', u'!_')
+
+
+def searchNames(store, model, nameColumn, term, conditions=(), match=PREFIX,
+                page=1, pageSize=PAGE_SIZE):
+    """
+    Find objects of C{model} by name, ordered by name.
+
+    @param page: Page of results, counting from 1
+    @return: C{(results, more)}: a list of C{(id, name)} and whether there
+        are further pages
+    """
+    if match not in (PREFIX, SUBSTRING):
+        raise ValueError("Unknown match %r" % match)
+
+    conditions = list(conditions)
+    key = (compileConditions(store, conditions),
+           compileConditions(store, [nameColumn]),
+           term, match, page, pageSize)
+    result = searchCache.get(model, key)
+    if result is not None:
+        return result
+
+    pattern = escapeLike(term) + u'%'
+    if match == SUBSTRING:
+        pattern = u'%' + pattern
+
+    primary = get_cls_info(model).primary_key[0]
+    start = (page - 1) * pageSize
+    # One more row than asked for tells whether there's another page
+    rows = list(store.find((primary, nameColumn),
+                           nameColumn.like(pattern, u'!'), *conditions)
+                .order_by(nameColumn, primary)[start:start + pageSize + 1])
+
+    result = (rows[:pageSize], len(rows) > pageSize)
+    searchCache.set(model, key, result)
+    return result
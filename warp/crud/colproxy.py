@@ -1,10 +1,19 @@
 import re
+import cgi
 import operator
 from datetime import datetime, date
 import pytz
 
+from storm.info import get_cls_info
+
 from warp.runtime import internal, templateLookup
 from warp.helpers import url, link, getNode, renderTemplateObj, getCrudClass, getCrudObj, getCrudNode
+from warp.crud.autocomplete import searchNames, PREFIX
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 
 class BaseProxy(object):
@@ -373,13 +382,29 @@ class PriceProxy(BaseProxy):
 
 
 class ReferenceProxy(BaseProxy):
+    """
+    With C{autocomplete=True}, edit with a text field looking up names as
+    they're typed instead of a C{<select>} of all referenced objects; see
+    L{warp.crud.autocomplete}.
+    """
+
+    autocompleteTemplate = u"""<input type="hidden" name="warpform-%(field)s" value="%(id)s" />
+<input type="text" id="ref-field-%(field)s" value="%(label)s" size="30" autocomplete="off" />
+<script type="text/javascript">
+jQuery(document).ready(function($) { $("#ref-field-%(field)s").warpref(%(options)s); });
+</script>
+"""
 
-    def __init__(self, obj, col, allowNone=False, conditions=(), default=None):
+    def __init__(self, obj, col, allowNone=False, conditions=(), default=None,
+                 autocomplete=False, nameColumn=None, match=PREFIX):
         self.obj = obj
         self.col = col
         self.allowNone = allowNone
         self.conditions = conditions
         self.default = default
+        self.autocomplete = autocomplete
+        self.nameColumn = nameColumn
+        self.match = match
 
 
     def render_view(self, request):
@@ -420,6 +445,9 @@ class ReferenceProxy(BaseProxy):
             return '<input type="hidden" name="warpform-%s" value="%s" />%s' % (
                 self.fieldName(), objID, crudClass(obj).name(request))
 
+        if self.autocomplete:
+            return self.render_autocomplete(request, objID)
+
         allObjs = [(crudClass(o).name(request), o)
                    for o in request.store.find(refClass, *self.conditions)]
         allObjs.sort()
@@ -445,6 +473,68 @@ class ReferenceProxy(BaseProxy):
             self.fieldName(), "\n".join(options))
 
 
+    def render_autocomplete(self, request, objID):
+        refClass = self.obj.__class__.__dict__[self.col]._relation.remote_cls
+
+        if objID is None and self.default is not None:
+            objID = self.default.id
+
+        # Only the current object's label; the rest are searched for
+        obj = request.store.get(refClass, objID) if objID is not None else None
+        label = getCrudClass(refClass)(obj).name(request) if obj is not None else u""
+
+        options = {
+            'source': url(getCrudNode(getCrudClass(self.obj.__class__)),
+                          "autocomplete", [self.col]),
+            'allowNone': self.allowNone,
+        }
+
+        return self.autocompleteTemplate % {
+            'field': self.fieldName(),
+            'id': objID if objID is not None else "",
+            'label': cgi.escape(unicode(label), True),
+            'options': json.dumps(options),
+        }
+
+
+    def searchColumn(self):
+        """
+        The column L{search} matches names in: C{nameColumn}, or the
+        referenced crud model's, or C{None} if neither is set.
+        """
+        if self.nameColumn is not None:
+            return self.nameColumn
+        refClass = self.obj.__class__.__dict__[self.col]._relation.remote_cls
+        return getCrudClass(refClass).nameColumn
+
+
+    def search(self, request, term, page):
+        """
+        A page of C{(id, label)} for objects that could be referenced, whose
+        names match C{term}, and whether there are more.
+
+        Objects are found by C{nameColumn}, but labelled by the crud
+        model's C{name}, like the current object in L{render_autocomplete}.
+        """
+        refClass = self.obj.__class__.__dict__[self.col]._relation.remote_cls
+        crudClass = getCrudClass(refClass)
+        nameColumn = self.searchColumn()
+        if nameColumn is None:
+            raise ValueError("No nameColumn to search %s by" % refClass.__name__)
+
+        (rows, more) = searchNames(request.store, refClass, nameColumn, term,
+                                   self.conditions, self.match, page)
+        if not rows:
+            return (rows, more)
+
+        primary = get_cls_info(refClass).primary_key[0]
+        objs = dict(request.store.find((primary, refClass),
+                                       primary.is_in([objID for (objID, name) in rows])))
+        # Skipping any deleted since the search was cached
+        return ([(objID, crudClass(objs[objID]).name(request))
+                 for (objID, name) in rows if objID in objs], more)
+
+
     def save(self, val, request):
 
         try:
@@ -0,0 +1,329 @@
+"""
+Search filters for crud lists.
+
+jqGrid's search dialog posts C{_search=true} and its filters as JSON:
+
+    {"groupOp": "AND",
+     "rules": [{"field": "name", "op": "bw", "data": "Ab"}],
+     "groups": [{"groupOp": "OR", "rules": [...]}]}
+
+or, for a single condition, C{searchField}, C{searchOper} and
+C{searchString}. L{searchConditions} turns them into Storm expressions,
+so the database does the filtering, and the count and paging in
+L{warp.crud.listing} cover the filtered rows.
+
+Fields are the crud model's C{searchColumns}, or its C{listColumns}, and
+values are converted by column type, so a bad value is an error rather
+than a comparison that never matches. The operators are:
+
+  - C{eq}, C{ne}, C{lt}, C{le}, C{gt}, C{ge}
+  - C{in}, with a list or comma separated values
+  - C{bw} (begins with) and C{cn} (contains), on text. C{bw} is a
+    C{LIKE 'term%'}, which can use an index; C{cn} can't
+
+C{ne} matches C{NULL} too.
+
+A reference column searches the C{nameColumn} of the referenced crud
+model (see L{warp.crud.autocomplete}), or else compares ids, and
+C{owner.email} searches a column of the referenced class, if its crud
+model lists it in its own C{searchColumns} or C{listColumns}. References are
+searched with a semi-join, C{owner_id IN (SELECT id FROM owner WHERE
+...)}, so rows without a reference still match the other branches of an
+C{OR}.
+"""
+import decimal
+from datetime import datetime
+
+import pytz
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from storm.expr import And, Or, Not, Select
+from storm.info import get_cls_info
+from storm.locals import (Int, Float, Decimal, Unicode, RawStr, Bool,
+                          Date, DateTime, Reference)
+
+from warp.helpers import getCrudClass
+from warp.crud import columns, colproxy
+from warp.crud.autocomplete import escapeLike
+
+# Most rules in one search, counting those in nested groups
+MAX_RULES = 50
+# Deepest nesting of groups
+MAX_DEPTH = 5
+
+COMPARISONS = ('eq', 'ne', 'lt', 'le', 'gt', 'ge', 'in')
+TEXT_OPERATORS = ('bw', 'cn')
+
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y")
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M",
+                    "%m/%d/%Y %H:%M") + DATE_FORMATS
+
+
+class FilterError(ValueError):
+    """
+    The search can't be run: an unknown field or operator, or a value of
+    the wrong type.
+    """
+
+
+def _parseTime(formats, data):
+    for fmt in formats:
+        try:
+            return datetime.strptime(data.strip(), fmt)
+        except ValueError:
+            pass
+    raise ValueError("Expected a date like %s" % datetime(2011, 12, 31).strftime(formats[0]))
+
+def _parseBool(data):
+    value = data.strip().lower()
+    if value in ('true', 'yes', '1'):
+        return True
+    if value in ('false', 'no', '0'):
+        return False
+    raise ValueError("Expected true or false")
+
+def _parsePrice(data):
+    m = colproxy.PriceProxy.priceExp.match(data.strip())
+    if not m:
+        raise ValueError("Expected a price")
+    (dollars, cents) = m.groups()
+    return int(dollars or 0) * 100 + int(cents or 0)
+
+def _parseUTCDateTime(data):
+    return _parseTime(DATETIME_FORMATS, data).replace(tzinfo=pytz.UTC)
+
+
+# Most specific first, as the warp column types subclass Storm's
+CONVERTERS = [
+    (columns.Price, _parsePrice),
+    (columns.UTCDateTime, _parseUTCDateTime),
+    (Int, int),
+    (Float, float),
+    (Decimal, decimal.Decimal),
+    (Unicode, unicode),
+    (RawStr, lambda data: data.encode("utf-8")),
+    (Bool, _parseBool),
+    (Date, lambda data: _parseTime(DATE_FORMATS, data).date()),
+    (DateTime, lambda data: _parseTime(DATETIME_FORMATS, data)),
+]
+
+
+def searchOperators(model, colName):
+    """
+    The operators C{colName} of C{model} can be searched with, for the
+    grid's search dialog.
+    """
+    try:
+        (column, convert, isText) = _resolve(model, colName)
+    except FilterError:
+        return []
+    if isText:
+        return list(TEXT_OPERATORS + COMPARISONS)
+    return list(COMPARISONS)
+
+
+def searchConditions(crudClass, model, args):
+    """
+    Conditions for the search in request arguments C{args}, if any.
+
+    @raise FilterError: If the search is invalid
+    """
+    if args.get('_search', [''])[0] != 'true':
+        return []
+
+    filters = args.get('filters', [''])[0]
+    if filters:
+        try:
+            group = json.loads(filters)
+        except (ValueError, RuntimeError):
+            # RuntimeError from nesting too deep to parse
+            raise FilterError("Invalid filters")
+    elif args.get('searchField', [''])[0]:
+        group = {'groupOp': 'AND',
+                 'rules': [{'field': args['searchField'][0],
+                            'op': args.get('searchOper', ['eq'])[0],
+                            'data': args.get('searchString', [''])[0].decode("utf-8")}]}
+    else:
+        return []
+
+    searchColumns = getattr(crudClass, 'searchColumns', None)
+    if searchColumns is None:
+        searchColumns = crudClass.listColumns
+
+    condition = FilterGroup(model, searchColumns).build(group)
+    return [condition] if condition is not None else []
+
+
+class FilterGroup(object):
+    """
+    Builds the condition for a (possibly nested) jqGrid filter group.
+    """
+    def __init__(self, model, searchColumns):
+        self.model = model
+        self.searchColumns = searchColumns
+        self.ruleCount = 0
+
+    def build(self, group, depth=0):
+        if not isinstance(group, dict):
+            raise FilterError("Invalid filters")
+        if depth > MAX_DEPTH:
+            raise FilterError("Search groups nested more than %d deep" % MAX_DEPTH)
+
+        groupOp = group.get('groupOp', 'AND')
+        if groupOp not in ('AND', 'OR'):
+            raise FilterError("Unknown group operator %r" % groupOp)
+
+        conditions = [self.rule(rule) for rule in group.get('rules') or []]
+        conditions.extend(self.build(subgroup, depth + 1)
+                          for subgroup in group.get('groups') or [])
+        conditions = [c for c in conditions if c is not None]
+
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return And(*conditions) if groupOp == 'AND' else Or(*conditions)
+
+    def rule(self, rule):
+        self.ruleCount += 1
+        if self.ruleCount > MAX_RULES:
+            raise FilterError("More than %d search rules" % MAX_RULES)
+
+        try:
+            field, op, data = rule['field'], rule['op'], rule['data']
+        except (KeyError, TypeError):
+            raise FilterError("Invalid search rule")
+        if not isinstance(field, basestring):
+            raise FilterError("Invalid search rule")
+
+        if field.split('.', 1)[0] not in self.searchColumns:
+            raise FilterError("Can't search by %s" % field)
+
+        (column, convert, isText) = _resolve(self.model, field)
+
+        if op in TEXT_OPERATORS and not isText:
+            raise FilterError("Can't use %s on %s" % (op, field))
+        if op not in COMPARISONS and op not in TEXT_OPERATORS:
+            raise FilterError("Unknown search operator %r" % op)
+
+        try:
+            if op == 'in':
+                values = data if isinstance(data, list) else data.split(',')
+                value = [convert(v.strip() if isinstance(v, basestring) else v)
+                         for v in values]
+            else:
+                value = convert(data)
+        except (TypeError, ValueError, AttributeError, decimal.InvalidOperation) as e:
+            raise FilterError("Invalid value for %s: %s" % (field, e))
+
+        return column.condition(op, value)
+
+
+class _Column(object):
+    """
+    A searchable column, or a column of a referenced class reached through
+    a reference.
+    """
+    def __init__(self, expr, localKey=None, remotePrimary=None):
+        self.expr = expr
+        self.localKey = localKey
+        self.remotePrimary = remotePrimary
+
+    def compare(self, op, value):
+        expr = self.expr
+        if op == 'eq':
+            return expr == value
+        if op == 'ne':
+            return Or(expr != value, expr == None)
+        if op == 'lt':
+            return expr < value
+        if op == 'le':
+            return expr <= value
+        if op == 'gt':
+            return expr > value
+        if op == 'ge':
+            return expr >= value
+        if op == 'in':
+            return expr.is_in(value)
+        if op == 'bw':
+            return expr.like(escapeLike(value) + u'%', u'!')
+        if op == 'cn':
+            return expr.like(u'%' + escapeLike(value) + u'%', u'!')
+
+    def condition(self, op, value):
+        if self.localKey is None:
+            return self.compare(op, value)
+
+        if op == 'ne':
+            # Rows without a reference aren't equal either
+            return Or(self.localKey == None,
+                      Not(self.localKey.is_in(
+                          Select(self.remotePrimary, self.compare('eq', value)))))
+        return self.localKey.is_in(Select(self.remotePrimary, self.compare(op, value)))
+
+
+def _propertyOf(model, name):
+    # The property itself, without triggering its __get__
+    for klass in model.__mro__:
+        if name in klass.__dict__:
+            return klass.__dict__[name]
+    return None
+
+def _converter(prop):
+    for (propClass, convert) in CONVERTERS:
+        if isinstance(prop, propClass):
+            return (convert, propClass is Unicode)
+    return None
+
+def _searchColumns(model):
+    try:
+        crudClass = getCrudClass(model)
+    except KeyError:
+        return ()
+    searchColumns = getattr(crudClass, 'searchColumns', None)
+    if searchColumns is None:
+        searchColumns = getattr(crudClass, 'listColumns', None) or ()
+    return searchColumns
+
+def _resolve(model, field):
+    """
+    @return: C{(column, convert, isText)} for C{field} of C{model}
+    """
+    (name, _, remoteName) = field.partition('.')
+    prop = _propertyOf(model, name)
+
+    if isinstance(prop, Reference):
+        relation = prop._relation
+        if len(relation.local_key) != 1 or not relation.remote_key_is_primary:
+            raise FilterError("Can't search by %s" % field)
+        localKey = relation.local_key[0]
+        remoteClass = relation.remote_cls
+        remotePrimary = get_cls_info(remoteClass).primary_key[0]
+
+        if remoteName:
+            # Only what the referenced model shows, or the browser could
+            # probe any column, such as a password hash, a prefix at a time
+            if remoteName not in _searchColumns(remoteClass):
+                raise FilterError("Can't search by %s" % field)
+            remoteProp = _propertyOf(remoteClass, remoteName)
+            found = _converter(remoteProp) if remoteProp is not None else None
+            if found is None:
+                raise FilterError("Can't search by %s" % field)
+            return (_Column(getattr(remoteClass, remoteName), localKey, remotePrimary),) + found
+
+        try:
+            nameColumn = getCrudClass(remoteClass).nameColumn
+        except (KeyError, AttributeError):
+            nameColumn = None
+        if nameColumn is not None:
+            return (_Column(nameColumn, localKey, remotePrimary), unicode, True)
+        return (_Column(localKey), int, False)
+
+    found = _converter(prop) if prop is not None and not remoteName else None
+    if found is None:
+        raise FilterError("Can't search by %s" % field)
+    return (_Column(getattr(model, name)),) + found
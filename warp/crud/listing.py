@@ -0,0 +1,342 @@
+"""
+Paged queries for crud lists.
+
+A page and the total number of rows are fetched in one statement, with
+C{COUNT(*) OVER ()} alongside each row, where the database has window
+functions (PostgreSQL, SQLite 3.25 and later). Elsewhere, or when the page
+is empty, the total takes a second query.
+
+Rows are always ordered by the sort column and then the primary key, so
+the order is stable. When a grid moves to the next page it sends back the
+cursor it got with the previous one, and the page is fetched by seeking
+past the previous page's last row instead of with C{OFFSET}, so deep
+pages cost the same as the first. Rows with a C{NULL} sort value are
+sought past where the database sorts them: after other values on
+PostgreSQL, before them elsewhere.
+
+How the total is found depends on the crud model's C{listCount}:
+
+  - C{'exact'} counts the rows for every page
+  - C{'cached'} keeps exact counts for C{listCountTTL} seconds, per model
+    and conditions, dropping them when changes to the model are committed
+  - C{'estimated'} takes the planner's estimate on PostgreSQL, so huge
+    tables aren't scanned; the total is then marked approximate. Other
+    databases have no estimates and use C{'cached'} instead
+
+Rendering a reference column loads the referenced object, one query per
+row. L{prefetch} loads them for a whole page first, one C{IN (...)} query
+per referenced class.
+"""
+import sqlite3
+import time
+from collections import OrderedDict
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from storm.expr import SQL, Desc, And, Or, State
+from storm.info import get_cls_info, get_obj_info
+from storm.references import Reference
+
+from warp.common.events import changeHandler
+
+EXACT, CACHED, ESTIMATED = 'exact', 'cached', 'estimated'
+
+# Most keys in one IN (...)
+PREFETCH_CHUNK = 500
+
+
+class ListPage(object):
+    """
+    @ivar rows: Objects on the page
+    @ivar total: Number of rows in the whole list
+    @ivar cursor: Pass this back to L{ListQuery.page} to get the next page
+        by seeking, or C{None}
+    @ivar approximate: Whether C{total} is an estimate
+    """
+    def __init__(self, rows, total, cursor, approximate=False):
+        self.rows = rows
+        self.total = total
+        self.cursor = cursor
+        self.approximate = approximate
+
+
+class CountCache(object):
+    """
+    Exact list counts, per model and conditions, for the most recently
+    used C{size} of them. Searches make for many distinct conditions.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        # (model name, conditions key) -> (expiry time, count)
+        self.counts = OrderedDict()
+        self.watched = set()
+
+    def get(self, model, key):
+        entryKey = (model.__name__, key)
+        entry = self.counts.pop(entryKey, None)
+        if entry is None or entry[0] < time.time():
+            return None
+        self.counts[entryKey] = entry
+        return entry[1]
+
+    def set(self, model, key, count, ttl):
+        if model.__name__ not in self.watched:
+            self.watched.add(model.__name__)
+            changeHandler(model)(self._changed)
+
+        entryKey = (model.__name__, key)
+        self.counts.pop(entryKey, None)
+        self.counts[entryKey] = (time.time() + ttl, count)
+        while len(self.counts) > self.size:
+            self.counts.popitem(last=False)
+
+    def invalidate(self, modelName):
+        for key in [key for key in self.counts if key[0] == modelName]:
+            del self.counts[key]
+
+    def _changed(self, obj, change):
+        self.invalidate(obj.__class__.__name__)
+
+
+countCache = CountCache()
+
+
+def compileConditions(store, conditions):
+    """
+    Key identifying C{conditions}: their SQL and parameters.
+    """
+    if not conditions:
+        return ()
+    state = State()
+    statement = store._connection.compile(And(*conditions), state)
+    return (statement, tuple(variable.get() for variable in state.parameters))
+
+
+def estimateCount(store, model, conditions):
+    """
+    The planner's estimate of the number of rows, or C{None} where there
+    is no planner to ask.
+    """
+    if store._connection.__class__.__name__ != 'PostgresConnection':
+        return None
+    state = State()
+    select = store.find(model, *conditions)._get_select()
+    statement = store._connection.compile(select, state)
+    plan = store.execute("EXPLAIN (FORMAT JSON) " + statement,
+                         state.parameters).get_one()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def hasWindowFunctions(store):
+    name = store._connection.__class__.__name__
+    if name == 'PostgresConnection':
+        return True
+    if name == 'SQLiteConnection':
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    return False
+
+
+def nullsSortHigh(store):
+    """
+    Whether C{NULL} sorts after other values in ascending order.
+    """
+    return store._connection.__class__.__name__ == 'PostgresConnection'
+
+
+class ListQuery(object):
+    """
+    @param sortKey: Identifies the sort order in cursors, so a cursor
+        isn't used after the grid is sorted differently
+    @param countMode: L{EXACT}, L{CACHED} or L{ESTIMATED}
+    @param countTTL: Seconds to keep cached counts
+    """
+    def __init__(self, store, model, conditions, sortColumn, descending=False,
+                 sortKey=None, countMode=EXACT, countTTL=60):
+        if countMode not in (EXACT, CACHED, ESTIMATED):
+            raise ValueError("Unknown count mode %r" % countMode)
+        self.store = store
+        self.model = model
+        self.conditions = list(conditions)
+        self.sortColumn = sortColumn
+        self.descending = descending
+        self.sortKey = sortKey
+        self.countMode = countMode
+        self.countTTL = countTTL
+
+        primary = get_cls_info(model).primary_key
+        # Seeking needs a single column key to break ties
+        self.primaryColumn = primary[0] if len(primary) == 1 else None
+
+    def orderBy(self):
+        columns = [self.sortColumn]
+        if self.primaryColumn is not None and self.primaryColumn is not self.sortColumn:
+            columns.append(self.primaryColumn)
+        if self.descending:
+            return [Desc(column) for column in columns]
+        return columns
+
+    def count(self):
+        count = self.store.find(self.model, *self.conditions).count()
+        if self.countMode != EXACT:
+            self.cacheCount(count)
+        return count
+
+    def cacheCount(self, count):
+        key = compileConditions(self.store, self.conditions)
+        countCache.set(self.model, key, count, self.countTTL)
+
+    def knownCount(self):
+        """
+        The total without counting rows, if the count mode allows it.
+
+        @return: C{(total, approximate)}, C{total} being C{None} if the
+            rows have to be counted
+        """
+        if self.countMode == ESTIMATED:
+            estimate = estimateCount(self.store, self.model, self.conditions)
+            if estimate is not None:
+                return estimate, True
+        if self.countMode != EXACT:
+            key = compileConditions(self.store, self.conditions)
+            return countCache.get(self.model, key), False
+        return None, False
+
+    def page(self, page, rowsPerPage, cursor=None):
+        """
+        Fetch page C{page}, counting from 1.
+        """
+        start = (page - 1) * rowsPerPage
+        conditions = list(self.conditions)
+
+        seek = self.seekCondition(page, cursor)
+        if seek is not None:
+            conditions.append(seek)
+            offset = 0
+        else:
+            offset = start
+
+        total, approximate = self.knownCount()
+
+        if total is None and hasWindowFunctions(self.store):
+            results = list(self.store.find((self.model, SQL("COUNT(*) OVER ()")),
+                                           *conditions)
+                           .order_by(*self.orderBy())[offset:offset + rowsPerPage])
+            rows = [row for (row, _) in results]
+            if results:
+                # The window counts the rows left after seeking
+                total = results[0][1] + (start if seek is not None else 0)
+                # which only adds up if the rows before the cursor
+                # haven't changed, so that total isn't kept
+                if self.countMode != EXACT and seek is None:
+                    self.cacheCount(total)
+        else:
+            rows = list(self.store.find(self.model, *conditions)
+                        .order_by(*self.orderBy())[offset:offset + rowsPerPage])
+
+        if total is None:
+            total = self.count()
+
+        return ListPage(rows, total, self.makeCursor(page, rows), approximate)
+
+    def makeCursor(self, page, rows):
+        if self.primaryColumn is None or not rows:
+            return None
+        return {
+            'page': page,
+            'id': get_obj_info(rows[-1]).variables[self.primaryColumn].get(),
+            'sort': self.sortKey,
+        }
+
+    def seekCondition(self, page, cursor):
+        """
+        Condition selecting the rows after the cursor's, if the cursor is
+        for the page before C{page} in this order. Cursors come from the
+        browser, so anything else, including a malformed cursor, gives
+        C{None} and the page is fetched with C{OFFSET}.
+        """
+        if (not isinstance(cursor, dict) or self.primaryColumn is None
+                or cursor.get('page') != page - 1
+                or cursor.get('sort') != self.sortKey):
+            return None
+
+        primary = self.primaryColumn
+        try:
+            lastID = primary.variable_factory(value=cursor.get('id')).get()
+        except (TypeError, ValueError):
+            return None
+        if lastID is None:
+            return None
+        if primary is self.sortColumn:
+            return primary < lastID if self.descending else primary > lastID
+
+        last = self.store.find((primary, self.sortColumn), primary == lastID).one()
+        if last is None:
+            # Gone
+            return None
+        lastValue = last[1]
+
+        sort = self.sortColumn
+        if self.descending:
+            after = (sort < lastValue, primary < lastID)
+        else:
+            after = (sort > lastValue, primary > lastID)
+        nullsAfter = nullsSortHigh(self.store) != self.descending
+
+        if lastValue is None:
+            # NULLs don't compare, so they are ordered by the primary key
+            # alone, and other values either all come before them or all
+            # after
+            nullTies = And(sort == None, after[1])
+            if nullsAfter:
+                return nullTies
+            return Or(sort != None, nullTies)
+
+        seek = Or(after[0], And(sort == lastValue, after[1]))
+        if nullsAfter:
+            return Or(seek, sort == None)
+        return seek
+
+
+def prefetch(store, rows, colNames):
+    """
+    Load the objects the references C{colNames} of C{rows} point to, so
+    following them doesn't query. References to compound keys, or not to
+    a primary key, are left to load lazily.
+
+    @return: The loaded objects. Keep hold of them while rendering: the
+        store only caches objects something refers to.
+    """
+    if not rows:
+        return []
+    model = rows[0].__class__
+
+    # Referenced class -> keys
+    wanted = {}
+    for colName in colNames:
+        reference = getattr(model, colName, None)
+        if not isinstance(reference, Reference):
+            continue
+        relation = reference._relation
+        if not relation.remote_key_is_primary or len(relation.remote_key) != 1:
+            continue
+        keys = wanted.setdefault(relation.remote_cls, set())
+        for row in rows:
+            if relation.get_remote(row) is not None:
+                continue
+            key = relation.get_local_variables(row)[0].get()
+            if key is not None:
+                keys.add(key)
+
+    loaded = []
+    for (remoteClass, keys) in wanted.iteritems():
+        primary = get_cls_info(remoteClass).primary_key[0]
+        keys = sorted(keys)
+        for i in xrange(0, len(keys), PREFETCH_CHUNK):
+            loaded.extend(store.find(remoteClass,
+                                     primary.is_in(keys[i:i + PREFETCH_CHUNK])))
+    return loaded
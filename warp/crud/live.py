@@ -0,0 +1,110 @@
+"""
+Live list updates.
+
+With C{liveUpdates = True} on a crud model, the ids of its objects changed
+by each commit are published to the comet channel C{crud:<Model>}, which
+the grids in C{crud/list.mak} subscribe to:
+
+    {"key": "crud:Thing",
+     "created": [12],
+     "updated": [7],
+     "deleted": [3]}
+
+Changes committed in the same reactor turn are published together. Rows
+aren't rendered here: every subscriber would see them, whatever its
+avatar, C{listConditions} or search. Grids drop deleted rows and fetch
+their page again through C{list_json} when rows on it changed, or new
+rows may belong on it, so what they show is still filtered for them.
+
+Only changes flushed from objects are seen. After changing rows with
+C{ResultSet.set} or SQL, emit C{liveUpdate} from the changed objects
+(see L{warp.common.events.EventModel.emit}).
+"""
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from warp.common.events import changeHandler, handler, ADDED, CHANGED, REMOVED
+from warp.webserver import comet
+
+# Model name -> crud class, for models with live updates
+watched = {}
+
+# Model name -> {row id: (change, obj)} waiting to be published
+pending = {}
+
+_flushCall = None
+
+
+def channelName(model):
+    return "crud:%s" % model.__name__
+
+def rowID(obj):
+    if hasattr(obj, '__storm_primary__'):
+        return '.'.join(str(getattr(obj, k)) for k in obj.__storm_primary__)
+    return obj.id
+
+
+def watch(model, crudClass):
+    """
+    Publish committed changes to objects of C{model}.
+    """
+    if model.__name__ in watched:
+        return
+    watched[model.__name__] = crudClass
+    changeHandler(model)(_rowChanged)
+
+
+def _rowChanged(obj, change):
+    rows = pending.setdefault(obj.__class__.__name__, OrderedDict())
+    key = rowID(obj)
+    previous = rows.get(key, (None,))[0]
+
+    if change == REMOVED:
+        if previous == ADDED:
+            # Nobody has seen it yet
+            del rows[key]
+        else:
+            rows[key] = (REMOVED, obj)
+    else:
+        if previous == ADDED:
+            change = ADDED
+        elif previous == REMOVED:
+            change = CHANGED
+        rows[key] = (change, obj)
+
+    _scheduleFlush()
+
+@handler('liveUpdate')
+def _liveUpdate(obj):
+    if obj.__class__.__name__ in watched:
+        _rowChanged(obj, CHANGED)
+
+def _scheduleFlush():
+    global _flushCall
+    if _flushCall is None:
+        _flushCall = reactor.callLater(0, flush)
+
+
+def flush():
+    """
+    Publish the pending changes of every watched model.
+    """
+    global _flushCall
+    _flushCall = None
+
+    batches = pending.items()
+    pending.clear()
+    for (modelName, rows) in batches:
+        channel = "crud:%s" % modelName
+        message = {'key': channel, 'created': [], 'updated': [], 'deleted': []}
+        for (key, (change, obj)) in rows.iteritems():
+            if change == ADDED:
+                message['created'].append(key)
+            elif change == REMOVED:
+                message['deleted'].append(key)
+            else:
+                message['updated'].append(key)
+
+        if message['created'] or message['updated'] or message['deleted']:
+            comet.publish(channel, message)
@@ -5,7 +5,7 @@ try:
 except ImportError:
     import simplejson as json
 
-from warp.crud import colproxy, columns
+from warp.crud import colproxy, columns, filters
 from warp import helpers
 
 class CrudModel(object):
@@ -39,6 +39,29 @@ class CrudModel(object):
     allowCreate = True
     hideListActions = False
 
+    # Publish committed changes to open lists through comet, see
+    # warp.crud.live
+    liveUpdates = False
+
+    # How lists find their total: 'exact', 'cached' or 'estimated', see
+    # warp.crud.listing
+    listCount = 'exact'
+    listCountTTL = 60
+
+    # References to load for a whole list page at once, see
+    # warp.crud.listing.prefetch. None means those in listColumns rendered
+    # by the default proxies.
+    listPrefetch = None
+
+    # Column or expression searched by name when autocompleting references
+    # to this model, see warp.crud.autocomplete
+    nameColumn = None
+
+    # Columns lists can be searched by, see warp.crud.filters. None means
+    # listColumns.
+    searchColumns = None
+    listSearch = True
+
     gridAttrs = {
         'rowNum': "10",
         'rowList': "[10,20,30]",
@@ -108,6 +131,18 @@ class CrudModel(object):
             return getattr(self, funcName)(val, request)
         return self.getProxy(colName, request).save(val, request)
 
+    @classmethod
+    def prefetchColumns(cls, model, colNames, prefix="render_list_"):
+        """
+        The references among C{colNames} which the default proxies will
+        follow, where C{prefix} names the methods rendering columns
+        instead (C{"render_"} for views).
+        """
+        return [colName for colName in colNames
+                if isinstance(getattr(model, colName, None), Reference)
+                and not hasattr(cls, "render_proxy_%s" % colName)
+                and not hasattr(cls, prefix + colName)]
+
     @classmethod
     def listConditions(cls, model, request):
         conditions = []
@@ -116,4 +151,6 @@ class CrudModel(object):
             where = json.loads(whereJSON)
             for (k, v) in where.iteritems():
                 conditions.append(getattr(model, k) == v)
+        if cls.listSearch:
+            conditions.extend(filters.searchConditions(cls, model, request.args))
         return conditions
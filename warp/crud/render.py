@@ -10,12 +10,14 @@ except ImportError:
 from twisted.web.resource import NoResource
 from twisted.web import static
 
-from storm.locals import Desc, Reference
+from storm.locals import Reference
 
 from warp.runtime import (templateLookup, internal,
                           exposedStormClasses, config)
 from warp import helpers
-from warp.crud import form
+from warp.crud import form, listing, live
+from warp.crud.filters import FilterError
+from warp.webserver import comet
 
 
 class CrudRenderer(object):
@@ -25,6 +27,9 @@ class CrudRenderer(object):
         self.crudModel = crudModel or helpers.getCrudClass(model)
         self.tinyTemplate = None
 
+        if self.crudModel.liveUpdates:
+            live.watch(model, self.crudModel)
+
     def getTinyTemplate(self):
         if not self.tinyTemplate:
             self.tinyTemplate = """
@@ -73,47 +78,66 @@ class CrudRenderer(object):
         params = dict((k, request.args.get(k, [''])[0])
                       for k in ('_search', 'page', 'rows', 'sidx', 'sord'))
 
-        # XXX Todo -- Search
-
         sortCol = getattr(self.model, params['sidx'])
 
         if isinstance(sortCol, Reference):
             sortCol = sortCol._local_key[0]
 
-        if params['sord'] == 'desc':
-            sortCol = Desc(sortCol)
-
         rowsPerPage = int(params['rows'])
-        start = (int(params['page']) - 1) * rowsPerPage
-        end = start + rowsPerPage
+        page = int(params['page'])
 
-        conditions = self.crudModel.listConditions(self.model, request)
-
-        totalResults = request.store.find(self.model, *conditions).count()
-
-        results = list(request.store.find(self.model, *conditions).order_by(sortCol)[start:end])
+        try:
+            conditions = self.crudModel.listConditions(self.model, request)
+        except FilterError as e:
+            request.setResponseCode(400)
+            return json.dumps({'error': str(e)})
+
+        query = listing.ListQuery(request.store, self.model, conditions, sortCol,
+                                  descending=params['sord'] == 'desc',
+                                  sortKey=[params['sidx'], params['sord']],
+                                  countMode=self.crudModel.listCount,
+                                  countTTL=self.crudModel.listCountTTL)
+        try:
+            cursor = json.loads(request.args.get('cursor', ['null'])[0])
+        except ValueError:
+            # Paged with OFFSET instead
+            cursor = None
+        result = query.page(page, rowsPerPage, cursor)
 
         exclude = json.loads(request.args.get('exclude', ['[]'])[0])
 
+        prefetchColumns = self.crudModel.listPrefetch
+        if prefetchColumns is None:
+            prefetchColumns = self.crudModel.prefetchColumns(
+                self.model, [colName for colName in self.crudModel.listColumns
+                             if colName not in exclude])
+        # Held so the store keeps them while the rows render
+        loaded = listing.prefetch(request.store, result.rows, prefetchColumns)
+
         makeRow = lambda row: [row.renderListView(colName, request)
                                for colName in row.listColumns
                                if colName not in exclude]
 
-        rows = [{'id': '.'.join(str(getattr(row, k)) for k in row.__storm_primary__)
-                       if hasattr(row, '__storm_primary__')
-                       else row.id,
+        rows = [{'id': live.rowID(row),
                  'cell': makeRow(self.crudModel(row))}
-                for row in results]
+                for row in result.rows]
+
+        cometID = request.args.get('cometID', [None])[0]
+        if (cometID and self.crudModel.liveUpdates
+                and comet.ownedBy(cometID, request.getSession())):
+            comet.subscribe(cometID, live.channelName(self.model))
 
-        (totalPages, addOne) = divmod(totalResults, rowsPerPage)
+        (totalPages, addOne) = divmod(result.total, rowsPerPage)
         if addOne: totalPages += 1
 
 
         obj = {
             'total': totalPages,
             'page': params['page'],
-            'records': len(results),
+            'records': result.total,
             'rows': rows,
+            'userdata': {'cursor': result.cursor,
+                         'approximate': result.approximate},
             }
 
         return json.dumps(obj)
@@ -146,6 +170,12 @@ class CrudRenderer(object):
             template = templateLookup.get_template("/error_404.mak")
             return helpers.renderTemplateObj(request, template)
 
+        # Several references to the same class load in one query
+        crudColumns = getattr(self.crudModel, 'crudColumns', ())
+        loaded = listing.prefetch(request.store, [obj],
+                                  self.crudModel.prefetchColumns(self.model, crudColumns,
+                                                                 "render_"))
+
         return helpers.renderTemplateObj(request,
                                          self._getViewTemplate(),
                                          crud=self.crudModel(obj),
@@ -168,6 +198,39 @@ class CrudRenderer(object):
                                          subTemplate="form.mak")
 
 
+    def render_autocomplete(self, request):
+        """
+        Names for an autocompleting reference field, see
+        L{warp.crud.autocomplete}.
+        """
+        colName = request.resource.args[0] if request.resource.args else None
+        if colName not in getattr(self.crudModel, 'crudColumns', ()):
+            return NoResource().render(request)
+
+        # Only the proxy's configuration is needed, so skip the model's
+        # __init__, which may want arguments
+        proxy = self.crudModel(self.model.__new__(self.model)).getProxy(colName, request)
+        if not getattr(proxy, 'autocomplete', False):
+            return NoResource().render(request)
+
+        if proxy.searchColumn() is None:
+            request.setResponseCode(400)
+            return json.dumps({'error': "No nameColumn to search %s by" % colName})
+
+        term = request.args.get('term', [''])[0].decode("utf-8")
+        try:
+            page = max(int(request.args.get('page', ['1'])[0]), 1)
+        except ValueError:
+            page = 1
+
+        (results, more) = proxy.search(request, term, page)
+
+        return json.dumps({
+                'results': [{'id': objID, 'label': name} for (objID, name) in results],
+                'more': more,
+                })
+
+
     def render_save(self, request):
         objects = json.load(request.content)
         (success, info) = form.applyForm(objects, request)
@@ -1,3 +1,4 @@
+import os
 import sys
 import urllib
 import warp.log as log
@@ -6,7 +7,8 @@ from mako.template import Template
 
 from twisted.python import util, filepath
 
-from warp.runtime import templateLookup, config, exposedStormClasses
+from warp.runtime import templateLookup, config, exposedStormClasses, routeTable
+from warp.common import assets
 
 def antispam(renderer):
     '''
@@ -32,6 +34,10 @@ def antispam(renderer):
     return wrapped
 
 def getNode(name):
+    # Once the route table is built, unknown nodes are just a missed lookup
+    if routeTable.root is not None:
+        return routeTable.getNode(name)
+
     bits = name.split('/')
     leaf = bits[-1]
 
@@ -57,11 +63,38 @@ def getCrudNode(crudClass):
     # XXX WHAT - God, what *should* this do??
     return sys.modules[crudClass.__module__]
 
+def getTemplateModuleDir():
+    """
+    Directory where Mako keeps compiled template modules, or C{None} to
+    compile in memory on every start. Relative paths are under siteDir.
+    """
+    module_dir = config.get('templateCacheDir')
+    if module_dir is None:
+        return None
+    return os.path.join(config['siteDir'].path, module_dir)
+
+# Compiled node-local templates: path -> (mtime, Template)
+_templateCache = {}
+
 def getTemplate(template_path):
-    return Template(filename=template_path,
-                    lookup=templateLookup,
-                    format_exceptions=config.get('makoErrorPages', True),
-                    output_encoding="utf-8")
+    cached = _templateCache.get(template_path)
+    if cached is not None and not config.get('reloadTemplates'):
+        return cached[1]
+
+    mtime = os.path.getmtime(template_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    template = Template(filename=template_path,
+                        lookup=templateLookup,
+                        module_directory=getTemplateModuleDir(),
+                        format_exceptions=config.get('makoErrorPages', True),
+                        output_encoding="utf-8")
+    _templateCache[template_path] = (mtime, template)
+    return template
+
+def flushTemplateCache():
+    _templateCache.clear()
 
 def renderTemplate(request, template_path, **kw):
     template = getTemplate(template_path)
@@ -114,3 +147,43 @@ def button(label, node, facet="index", args=[], confirm=None, **attrs):
         action = "if (confirm('%s')) { %s }" % (confirm, action)
     bits = " ".join('%s="%s"' % (k.rstrip('_'), v) for (k,v) in attrs.iteritems())
     return '<input type="button" value="%s" onclick="%s" %s>' % (label, action, bits)
+
+
+def staticURL(path):
+    """
+    URL of a static file, e.g. C{_warp/json2.js} or C{css/site.css}.
+
+    Indexed files get a fingerprinted URL that browsers may cache forever.
+    """
+    resource = getattr(config.get('warpSite'), 'resource', None)
+    if path.startswith('_warp/'):
+        index = getattr(resource, 'warpStatic', None)
+        prefix, name = '_warp/', path[6:]
+    else:
+        index = getattr(resource, 'siteStatic', None)
+        prefix, name = '', path
+
+    if index is not None:
+        name = index.url(name)
+    return "%s/%s%s" % (config.get('baseURL', ''), prefix, name)
+
+
+def assetTags(bundle):
+    """
+    Script or stylesheet tags for a bundle: the built bundle if there is
+    one (see C{twistd warp bundle}), otherwise one tag per source file.
+    """
+    bundle_path = "%s/%s" % (assets.getBundleDir(), bundle)
+    resource = getattr(config.get('warpSite'), 'resource', None)
+    index = getattr(resource, 'siteStatic', None)
+
+    if index is not None and bundle_path in index.assets:
+        urls = [staticURL(bundle_path)]
+    else:
+        urls = [staticURL(source) for source in assets.getBundles()[bundle]]
+
+    if bundle.endswith('.css'):
+        tag = '<link rel="stylesheet" type="text/css" href="%s" />'
+    else:
+        tag = '<script type="text/javascript" src="%s"></script>'
+    return "\n".join(tag % u for u in urls)
@@ -0,0 +1,70 @@
+"""
+Prometheus metrics.
+
+These live in the default registry, so the metrics service started by the
+twistd plugin exposes them.
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+sessionCacheHits = Counter(
+    'warp_session_cache_hits_total',
+    "Session lookups answered from the in-process session cache")
+sessionCacheMisses = Counter(
+    'warp_session_cache_misses_total',
+    "Session lookups that had to go to the database")
+sessionFlushSeconds = Histogram(
+    'warp_session_flush_seconds',
+    "Time taken to write batched session touches")
+sessionsFlushed = Counter(
+    'warp_sessions_flushed_total',
+    "Session touches written to the database in batches")
+
+flashStoreEntries = Gauge(
+    'warp_flash_store_entries',
+    "Sessions with flash messages in the in-process flash store")
+flashStoreBytes = Gauge(
+    'warp_flash_store_bytes',
+    "Approximate size of messages in the in-process flash store")
+flashMessagesExpired = Counter(
+    'warp_flash_messages_expired_total',
+    "Flash messages dropped from the in-process store unread after flashTTL")
+flashMessagesEvicted = Counter(
+    'warp_flash_messages_evicted_total',
+    "Flash messages dropped from the in-process store to stay within its limits")
+
+sessionsSwept = Counter(
+    'warp_sessions_swept_total',
+    "Expired sessions deleted by the session sweeper")
+sessionSweepBatchSeconds = Histogram(
+    'warp_session_sweep_batch_seconds',
+    "Time taken to delete one batch of expired sessions")
+
+roleCacheHits = Counter(
+    'warp_role_cache_hits_total',
+    "Avatar role lookups answered from the in-process role cache")
+roleCacheMisses = Counter(
+    'warp_role_cache_misses_total',
+    "Avatar role lookups that had to go to the database")
+
+cometSessions = Gauge(
+    'warp_comet_sessions',
+    "Live comet sessions in this process")
+cometMessagesDropped = Counter(
+    'warp_comet_messages_dropped_total',
+    "Comet messages dropped because a session's buffer was full",
+    ['policy'])
+
+eventQueueDepth = Gauge(
+    'warp_event_queue_depth',
+    "Events waiting for queued or threaded event handlers")
+eventHandlerSeconds = Histogram(
+    'warp_event_handler_seconds',
+    "Time taken by event handlers, per handler",
+    ['handler'])
+
+outboxEventsRelayed = Counter(
+    'warp_outbox_events_relayed_total',
+    "Outbox events whose handlers ran and which were removed from the outbox")
+outboxEventFailures = Counter(
+    'warp_outbox_event_failures_total',
+    "Outbox event runs that failed and will be retried")
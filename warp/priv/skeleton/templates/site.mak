@@ -54,7 +54,7 @@
 <%def name="navEntry(label, linkNode, linkFacet)">
 <%
 attrs = {}
-if not access.allowed(request.avatar, linkNode):
+if not access.requestAllowed(request, linkNode):
    return ""
 if request.prepath[0] == linkNode.__name__.split('.')[1]:
    attrs["class"] = "active"
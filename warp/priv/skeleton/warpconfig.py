@@ -16,7 +16,28 @@ config = {
     },
     # Whether to trace SQL queries using storm tracer
     'trace': False,
+    # Development only: pick up new and changed nodes without a restart
+    'reloadNodes': False,
+    # Development only: serve static files added or changed after startup
+    'reloadStatic': False,
+    # Development only: recompile templates when they change on disk
+    'reloadTemplates': False,
+    # Keep compiled templates on disk between restarts (relative to the
+    # site directory). Fill it ahead of time with 'twistd warp precompile'
+    # 'templateCacheDir': 'template_cache',
     'default': 'home',
+    # 'db' (default), 'cached' (in-process cache over 'db'), 'memory' or
+    # 'cookie' (signed cookie, no server-side state; needs 'sessionSecret',
+    # and 'sessionEncryptionKey' to also encrypt it)
+    # 'sessionBackend': 'cached',
+    # Where flash messages are kept: 'memory' (per process) or 'session'
+    # 'flashStore': 'session',
+    # With several worker processes, pass comet messages between them
+    # through a broker started with 'twistd warp cometBroker'
+    # 'cometBackplane': 'broker',
+    # Run outbox event handlers in 'twistd warp eventworker' instead of
+    # the web processes
+    # 'outboxRelay': False,
     "defaultRoles": ('anon',),
 
     'roles': {
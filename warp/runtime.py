@@ -6,6 +6,7 @@ import sys
 from mako.lookup import TemplateLookup
 
 from warp.common.events import CommitEventStore
+from warp.common.routes import RouteTable
 
 
 log = sys.stdout
@@ -26,6 +27,9 @@ tx_pool = None
 
 templateLookup = TemplateLookup.__new__(TemplateLookup)
 
+# Trie of site nodes, built when the root resource is created
+routeTable = RouteTable.__new__(RouteTable)
+
 config = {}
 
 sql = {}
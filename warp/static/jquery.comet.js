@@ -20,26 +20,69 @@
         $.get("/_comet/id", function(id) {
             $.comet.id = id;
             if (readyCallback) { readyCallback(); }
-            $.comet.poll();
+            if (window.EventSource) {
+                $.comet.stream();
+            } else {
+                $.comet.poll();
+            }
         });
     };
 
+    // Call readyCallback once the page has a comet id, starting comet
+    // if nothing has yet
+    $.comet.ready = function(readyCallback) {
+        if ($.comet.id) {
+            readyCallback();
+        } else if ($.comet.waiting) {
+            $.comet.waiting.push(readyCallback);
+        } else {
+            $.comet.waiting = [readyCallback];
+            $.comet.init(function() {
+                var waiting = $.comet.waiting;
+                $.comet.waiting = null;
+                $.each(waiting, function(i, callback) { callback(); });
+            });
+        }
+    };
+
+    // Server-Sent Events. The browser reconnects by itself, resuming
+    // with Last-Event-ID; if the stream never opens, fall back to polling.
+    $.comet.stream = function() {
+        var opened = false;
+        var source = new EventSource("/_comet/stream?id=" + encodeURIComponent($.comet.id));
+        source.onopen = function() { opened = true; };
+        source.onmessage = function(event) {
+            $.comet.dispatch($.parseJSON(event.data));
+        };
+        source.onerror = function() {
+            if (!opened) {
+                source.close();
+                $.comet.poll();
+            }
+        };
+        $.comet.source = source;
+    };
+
     $.comet.poll = function() {
         var timestamp = (new Date()).getTime();
         $.getJSON("/_comet/longpoll", {"id": $.comet.id, "time": timestamp}, $.comet.messages);
     };
 
-    $.comet.messages = function(json) {
-        $.each(json, function(i, obj) {
-            var callback = $.comet.callbacks[obj.key];
-            if (callback) {
-                try { callback(obj); }
-                catch (e) { 
-                    if (console && console.debug) {
-                        console.debug("Oh noes: " + e);
-                    }
+    $.comet.dispatch = function(obj) {
+        var callback = $.comet.callbacks[obj.key];
+        if (callback) {
+            try { callback(obj); }
+            catch (e) { 
+                if (console && console.debug) {
+                    console.debug("Oh noes: " + e);
                 }
             }
+        }
+    };
+
+    $.comet.messages = function(json) {
+        $.each(json, function(i, obj) {
+            $.comet.dispatch(obj);
         });
         $.comet.poll();
     };
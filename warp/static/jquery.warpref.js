@@ -0,0 +1,81 @@
+/*
+ * Autocompleting reference fields, see warp.crud.autocomplete.
+ *
+ * The text field shows the referenced object's name; the hidden field
+ * before it holds its id, which is what the form submits.
+ */
+
+(function($) {
+
+    $.fn.warpref = function(options) {
+        return this.each(function() {
+            _setup($(this), options);
+        });
+    };
+
+    $.fn.warpref.delay = 250;
+
+    function _setup(field, options) {
+        var hidden = field.prev("input:hidden");
+        var menu = $('<ul class="warpref-menu"></ul>').hide().insertAfter(field);
+        var chosen = field.val();
+        var timer = null;
+        var request = null;
+        var term = null;
+
+        function load(page) {
+            if (request) request.abort();
+            request = $.getJSON(options.source, {'term': term, 'page': page}, function(data) {
+                request = null;
+                if (page == 1) menu.empty();
+                menu.find("li.warpref-more").remove();
+
+                $.each(data.results, function(i, result) {
+                    $('<li></li>').text(result.label).data("warpref", result).appendTo(menu);
+                });
+                if (data.more) {
+                    $('<li class="warpref-more">More...</li>')
+                        .data("warpref-page", page + 1).appendTo(menu);
+                }
+                if (menu.children().length) {
+                    menu.css({'left': field.position().left,
+                              'top': field.position().top + field.outerHeight()}).show();
+                } else {
+                    menu.hide();
+                }
+            });
+        }
+
+        field.bind("keyup", function() {
+            if (field.val() == term) return;
+            term = field.val();
+            if (!term && options.allowNone) hidden.val("");
+            clearTimeout(timer);
+            timer = setTimeout(function() { load(1); }, $.fn.warpref.delay);
+        });
+
+        // mousedown comes before the field's blur
+        menu.delegate("li", "mousedown", function(e) {
+            e.preventDefault();
+            var item = $(this);
+            if (item.hasClass("warpref-more")) {
+                load(item.data("warpref-page"));
+                return;
+            }
+            var result = item.data("warpref");
+            hidden.val(result.id);
+            chosen = result.label;
+            field.val(chosen);
+            term = null;
+            menu.hide();
+        });
+
+        field.bind("blur", function() {
+            menu.hide();
+            // Typing without choosing doesn't change the reference
+            if (!(options.allowNone && !field.val())) field.val(chosen);
+            term = null;
+        });
+    }
+
+})(jQuery);
@@ -1,4 +1,7 @@
 <%! from warp.helpers import url, getCrudNode %>
+<%! from warp.crud.live import channelName %>
+<%! from warp.crud.filters import searchOperators %>
+<%! import json %>
 
 <%
 if model.listTitles:
@@ -27,6 +30,10 @@ createBoxID = "createBox%d" % gc
 listID = "list%d" % gc
 pagerID = "pager%d" % gc
 
+liveChannel = channelName(crudNode.renderer.model) if model.liveUpdates else None
+
+searchColumns = model.searchColumns if model.searchColumns is not None else model.listColumns
+
 %>
 
 <script type="text/javascript">
@@ -34,35 +41,107 @@ pagerID = "pager%d" % gc
 jQuery(document).ready(function(){ 
 
   function delLinkFormatter (cellvalue, options, rowObject) {
-    return '[<a href="#" onclick="if (confirm(\'Delete?\')) { $.post(\'${url(crudNode, "delete")}/' + rowObject[0] + '\', {}, function() { $(\'#${listID}\').trigger(\'reloadGrid\'); }); }; return false" style="color: red">Del</a>]';
+    return '[<a href="#" onclick="if (confirm(\'Delete?\')) { $.post(\'${url(crudNode, "delete")}/' + options.rowId + '\', {}, function() { $(\'#${listID}\').trigger(\'reloadGrid\'); }); }; return false" style="color: red">Del</a>]';
   }
 
-  var grid = jQuery("#${listID}").jqGrid({
-    url: '${url(crudNode, 'list_json')}',
-    postData: ${postData or '{}'},
-    datatype: 'json',
-    mtype: 'GET',
-    colNames:${colNames},
-    colModel :[ 
+  var grid = jQuery("#${listID}");
+
+  var makeGrid = function() {
+    grid.jqGrid({
+      url: '${url(crudNode, 'list_json')}',
+      postData: ${postData or '{}'},
+      datatype: 'json',
+      mtype: 'GET',
+      colNames:${colNames},
+      colModel :[ 
 <%
 for c in model.listColumns:
   if c in (exclude or []): continue
   d = {'name': c, 'id': c}
+  ops = searchOperators(crudNode.renderer.model, c) if model.listSearch and c in searchColumns else []
+  d['search'] = bool(ops)
+  if ops:
+    d['searchoptions'] = {'sopt': ops}
   d.update(model.listAttrs.get(c, {}))
-  context.write("%s," % repr(d))
+  context.write("%s," % json.dumps(d))
 %>
 % if not model.hideListActions:
-    {'name': 'Actions', 'id': '_actions',
-     'align': 'center', 'width': 50,
-     'formatter':delLinkFormatter}
+      {'name': 'Actions', 'id': '_actions',
+       'align': 'center', 'width': 50, 'search': false,
+       'formatter':delLinkFormatter}
+% endif
+      ],
+      pager: '#${pagerID}',
+      loadComplete: function() {
+        // Estimated totals, see warp.crud.listing
+        var approximate = grid.jqGrid('getGridParam', 'userData').approximate;
+        grid.jqGrid('setGridParam', {
+          recordtext: approximate ? "View {0} - {1} of about {2}" : $.jgrid.defaults.recordtext
+        });
+      },
+      // Moving to the next page, let the server seek past this page's
+      // last row instead of counting through the rows before it
+      onPaging: function(button) {
+        var cursor = grid.jqGrid('getGridParam', 'userData').cursor;
+        var postData = grid.jqGrid('getGridParam', 'postData');
+        if (button.indexOf('next') === 0 && cursor) {
+          postData.cursor = JSON.stringify(cursor);
+        } else {
+          delete postData.cursor;
+        }
+      },
+% if liveChannel:
+      beforeRequest: function() {
+        grid.jqGrid('getGridParam', 'postData').cometID = $.comet.id;
+      },
 % endif
-    ],
-    pager: '#${pagerID}',
 % for k, v in model.gridAttrs.iteritems():
-  ${k}: ${v},
+    ${k}: ${v},
 % endfor
-  dummy: false
-  }); 
+    dummy: false
+    }); 
+% if model.listSearch:
+    // Searches run on the server, see warp.crud.filters
+    grid.jqGrid('navGrid', '#${pagerID}',
+                {edit: false, add: false, del: false, search: true, refresh: true},
+                {}, {}, {},
+                {multipleSearch: true, multipleGroup: true, closeAfterSearch: true});
+% endif
+  };
+
+% if liveChannel:
+  // Changes published by warp.crud.live only carry ids, so rows are
+  // fetched again through list_json, with the grid's conditions and search
+  var reloading = null;
+  var patchGrid = function(diff) {
+    $.each(diff.deleted, function(i, id) {
+      grid.jqGrid('delRowData', id);
+    });
+
+    // Rows can't be placed by the grid's sort order, so new ones are only
+    // looked for while the page has room
+    var changed = $.grep(diff.updated, function(id) { return grid.jqGrid('getInd', id); });
+    var hasRoom = grid.jqGrid('getGridParam', 'reccount') < grid.jqGrid('getGridParam', 'rowNum');
+    if ((changed.length || (diff.created.length && hasRoom)) && !reloading) {
+      // One reload for a burst of commits
+      reloading = setTimeout(function() {
+        reloading = null;
+        grid.trigger('reloadGrid');
+      }, 250);
+    }
+  };
+
+  $.comet.ready(function() {
+    var previous = $.comet.callbacks['${liveChannel}'];
+    $.comet('${liveChannel}', function(diff) {
+      patchGrid(diff);
+      if (previous) { previous(diff); }
+    });
+    makeGrid();
+  });
+% else:
+  makeGrid();
+% endif
 
 }); 
 
@@ -1,6 +1,3 @@
-    <link rel="stylesheet" type="text/css" media="screen" href="/_warp/jqueryui/css/ui-lightness/jquery-ui-1.7.2.custom.css" />
-    <link rel="stylesheet" type="text/css" media="screen" href="/_warp/jqgrid/css/ui.jqgrid.css" />
-
-    <script src="/_warp/jqgrid/js/i18n/grid.locale-en.js" type="text/javascript"></script>
-    <script src="/_warp/jqgrid/js/jquery.jqGrid.min.js" type="text/javascript"></script>
-
+<%! from warp.helpers import assetTags %>
+    ${assetTags('jqgrid.css')}
+    ${assetTags('jqgrid.js')}
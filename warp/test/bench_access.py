@@ -0,0 +1,64 @@
+"""
+Benchmark access checks with and without the decision table.
+
+Builds a site with many roles and nodes, then times checking every facet of
+every node for an avatar holding several roles:
+
+    python -m warp.test.bench_access [roles] [nodes]
+"""
+from __future__ import print_function
+import sys
+import timeit
+import types
+
+from warp import runtime
+from warp.common import access as a
+
+FACETS = ['index', 'view', 'list', 'edit', 'save', 'delete']
+
+
+class BenchAvatar(object):
+    def __init__(self, roles):
+        self.roles = roles
+
+
+def makeSite(roleCount, nodeCount):
+    nodes = [types.ModuleType('node%d' % i) for i in range(nodeCount)]
+    roles = {}
+    for r in range(roleCount):
+        ruleMap = {}
+        for (i, node) in enumerate(nodes):
+            if (i + r) % 3 == 0:
+                ruleMap[node] = [a.AllowFacets(FACETS[:r % len(FACETS) + 1])]
+            elif (i + r) % 3 == 1:
+                ruleMap[node] = [a.All(a.Not(a.Equals(nodes[0])),
+                                       a.Any(a.Deny(), a.AllowFacets(['index'])))]
+        roles['role%d' % r] = a.Role(ruleMap, default=[a.Deny()])
+
+    runtime.config.update({'roles': roles, 'defaultRoles': ()})
+    avatar = BenchAvatar(tuple(roles['role%d' % r] for r in range(0, roleCount, 3)))
+    return nodes, avatar
+
+
+def checkAll(check, avatar, nodes):
+    for node in nodes:
+        for facet in FACETS:
+            check(avatar, node, facetName=facet)
+
+
+def uncached(avatar, obj, **kwargs):
+    return a.evaluate(a.getRoles(avatar), obj, avatar, kwargs)[0]
+
+
+def main(roleCount=30, nodeCount=200, number=20):
+    nodes, avatar = makeSite(roleCount, nodeCount)
+    checks = nodeCount * len(FACETS) * number
+
+    for (name, check) in [('rule walk', uncached), ('decision table', a.allowed)]:
+        a.clearDecisions()
+        seconds = timeit.timeit(lambda: checkAll(check, avatar, nodes), number=number)
+        print("%-15s %8.2f us/check" % (name, seconds / checks * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
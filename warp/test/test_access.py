@@ -1,5 +1,9 @@
+import types
+
 from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
 
+from warp import runtime
 from warp.common import access as a
 
 class AccessTest(unittest.TestCase):
@@ -42,3 +46,51 @@ class AccessTest(unittest.TestCase):
         self.assertEqual(a.Role({}, default=[a.Allow()]).allows(object()), True)
         self.assertEqual(a.Role({}, default=[a.Deny()]).allows(object()), False)
         self.assertEqual(a.Role({}, default=[]).allows(object()), None)
+
+
+class DecisionTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.node = types.ModuleType('node')
+        self.other = types.ModuleType('other')
+        self.patch(a, 'decisions', {})
+        self.patch(runtime, 'config', {
+            'roles': {
+                'anon': a.Role({
+                    self.node: [a.AllowFacets(['index'])],
+                    self.other: [a.Callback(self.callback)],
+                }),
+            },
+            'defaultRoles': ('anon',),
+        })
+
+    def callback(self, obj, **kwargs):
+        self.calls.append(obj)
+        return True
+
+    def test_static(self):
+        self.assertEqual(a.allowed(None, self.node, facetName='index'), True)
+        self.assertEqual(a.allowed(None, self.node, facetName='edit'), False)
+        self.assertEqual(len(a.decisions), 2)
+        self.assertEqual(a.allowed(None, self.node, facetName='edit'), False)
+
+    def test_dynamic(self):
+        self.assertEqual(a.allowed(None, self.other), True)
+        self.assertEqual(a.allowed(None, self.other), True)
+        self.assertEqual(a.decisions, {})
+        self.assertEqual(self.calls, [self.other, self.other])
+
+    def test_isStatic(self):
+        self.assertTrue(a.All(a.Allow(), a.Not(a.Equals(1))).static)
+        self.assertFalse(a.Any(a.Allow(), a.Callback(None)).static)
+        self.assertFalse(a.If(a.Allow(), object()).static)
+
+    def test_requestAllowed(self):
+        request = DummyRequest([])
+        request.avatar = None
+        self.assertEqual(a.requestAllowed(request, self.other, resourceArgs=['1']), True)
+        self.assertEqual(a.requestAllowed(request, self.other, resourceArgs=['1']), True)
+        self.assertEqual(self.calls, [self.other])
+        self.assertEqual(a.requestAllowed(request, self.other, resourceArgs=['2']), True)
+        self.assertEqual(len(self.calls), 2)
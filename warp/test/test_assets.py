@@ -0,0 +1,132 @@
+import sys
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+
+from warp import helpers
+from warp.common import assets
+from warp.webserver.staticfiles import StaticIndex
+
+
+class RewriteCSSURLsTest(unittest.TestCase):
+
+    def test_relative(self):
+        css = "a { background: url(images/x.png) } b { background: url('../y.png') }"
+        self.assertEqual(
+            assets.rewriteCSSURLs(css, '_warp/skin/style.css'),
+            "a { background: url(/_warp/skin/images/x.png) } "
+            "b { background: url('/_warp/skin/../y.png') }")
+
+    def test_absolute_untouched(self):
+        css = 'a { background: url("/img/x.png") } b { src: url(data:font/woff;base64,AA) }'
+        self.assertEqual(assets.rewriteCSSURLs(css, 'css/site.css'), css)
+
+
+class Resource(object):
+    def __init__(self, siteStatic, warpStatic):
+        self.siteStatic = siteStatic
+        self.warpStatic = warpStatic
+
+
+class Site(object):
+    def __init__(self, resource):
+        self.resource = resource
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        base = FilePath(self.mktemp())
+        self.warpStatic = base.child('warp').child('static')
+        self.siteStatic = base.child('site').child('static')
+        self.warpStatic.makedirs()
+        self.siteStatic.child('css').makedirs()
+        self.warpStatic.child('lib.js').setContent('var lib = 1')
+        self.siteStatic.child('app.js').setContent('lib();')
+        self.siteStatic.child('css').child('site.css').setContent('a { background: url(x.png) }')
+
+        self.config = {'warpDir': base.child('warp'), 'siteDir': base.child('site')}
+        self.patch(assets, 'config', self.config)
+        self.patch(helpers, 'config', self.config)
+        self.patch(assets, 'BUNDLES', {
+                'all.js': ['_warp/lib.js', 'app.js'],
+                'all.css': ['css/site.css'],
+                })
+        self.patch(assets, 'rjsmin', None)
+        self.patch(assets, 'rcssmin', None)
+        self.patch(sys, 'stdout', StringIO())
+
+    def serve(self):
+        """
+        Index the static directories, like a started site does.
+        """
+        self.siteIndex = StaticIndex(self.siteStatic.path)
+        self.warpIndex = StaticIndex(self.warpStatic.path)
+        self.config['warpSite'] = Site(Resource(self.siteIndex, self.warpIndex))
+
+    def test_build(self):
+        assets.buildBundles()
+        bundles = self.siteStatic.child('_bundles')
+        self.assertEqual(bundles.child('all.js').getContent(), 'var lib = 1;\nlib();')
+        self.assertEqual(bundles.child('all.css').getContent(),
+                         'a { background: url(/css/x.png) }')
+
+    def test_build_config(self):
+        self.config['bundleDir'] = 'b'
+        self.config['bundles'] = {'extra.js': ['app.js']}
+        assets.buildBundles()
+        self.assertEqual(sorted(self.siteStatic.child('b').listdir()),
+                         ['all.css', 'all.js', 'extra.js'])
+
+    def test_build_missing(self):
+        self.config['bundles'] = {'broken.js': ['nothere.js']}
+        self.assertRaises(IOError, assets.buildBundles)
+
+    def test_static_url(self):
+        self.serve()
+        self.assertEqual(helpers.staticURL('app.js'),
+                         '/' + self.siteIndex.url('app.js'))
+        self.assertEqual(helpers.staticURL('_warp/lib.js'),
+                         '/_warp/' + self.warpIndex.url('lib.js'))
+        self.assertNotEqual(self.siteIndex.url('app.js'), 'app.js')
+        self.assertTrue(helpers.staticURL('app.js').startswith('/app.'))
+
+        self.config['baseURL'] = '/base'
+        self.assertTrue(helpers.staticURL('_warp/lib.js').startswith('/base/_warp/lib.'))
+
+    def test_static_url_missing(self):
+        self.serve()
+        self.assertEqual(helpers.staticURL('nothere.js'), '/nothere.js')
+        self.assertEqual(helpers.staticURL('_warp/nothere.js'), '/_warp/nothere.js')
+
+    def test_static_url_no_site(self):
+        self.assertEqual(helpers.staticURL('app.js'), '/app.js')
+        self.assertEqual(helpers.staticURL('_warp/lib.js'), '/_warp/lib.js')
+
+    def test_tags_dev(self):
+        # Without a built bundle, each source gets its own tag
+        self.serve()
+        self.assertEqual(helpers.assetTags('all.js'), "\n".join([
+                    '<script type="text/javascript" src="/_warp/%s"></script>'
+                    % self.warpIndex.url('lib.js'),
+                    '<script type="text/javascript" src="/%s"></script>'
+                    % self.siteIndex.url('app.js')]))
+        self.assertEqual(helpers.assetTags('all.css'),
+                         '<link rel="stylesheet" type="text/css" href="/%s" />'
+                         % self.siteIndex.url('css/site.css'))
+
+    def test_tags_bundled(self):
+        assets.buildBundles()
+        self.serve()
+        url = self.siteIndex.url('_bundles/all.js')
+        self.assertTrue(url.startswith('_bundles/all.'))
+        self.assertEqual(helpers.assetTags('all.js'),
+                         '<script type="text/javascript" src="/%s"></script>' % url)
+        self.assertEqual(helpers.assetTags('all.css'),
+                         '<link rel="stylesheet" type="text/css" href="/%s" />'
+                         % self.siteIndex.url('_bundles/all.css'))
+
+    def test_tags_unknown(self):
+        self.serve()
+        self.assertRaises(KeyError, helpers.assetTags, 'nothere.js')
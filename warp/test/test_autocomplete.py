@@ -0,0 +1,181 @@
+import json
+from collections import defaultdict
+
+from storm.locals import Storm, Int, Unicode, Reference
+
+from twisted.trial import unittest
+
+from warp import runtime, helpers
+from warp.common import store, events
+from warp.crud import autocomplete, colproxy
+from warp.crud.model import CrudModel
+from warp.crud.render import CrudRenderer
+
+
+class Customer(Storm):
+    __storm_table__ = "test_customer"
+
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class Order(Storm):
+    __storm_table__ = "test_order"
+
+    id = Int(primary=True)
+    customer_id = Int()
+    customer = Reference(customer_id, Customer.id)
+
+
+class Note(Storm):
+    __storm_table__ = "test_note"
+
+    id = Int(primary=True)
+    customer_id = Int()
+    customer = Reference(customer_id, Customer.id)
+
+    def __init__(self, customer):
+        self.customer = customer
+
+
+class CrudCustomer(CrudModel):
+    nameColumn = Customer.name
+
+    def name(self, request):
+        return u"%s (#%d)" % (self.obj.name, self.obj.id)
+
+
+class CrudOrder(CrudModel):
+    crudColumns = ['customer']
+
+    def render_proxy_customer(self, request):
+        return colproxy.ReferenceProxy(self.obj, 'customer', autocomplete=True)
+
+
+class CrudNote(CrudModel):
+    crudColumns = ['customer']
+
+    def render_proxy_customer(self, request):
+        return colproxy.ReferenceProxy(self.obj, 'customer', autocomplete=True)
+
+
+class FakeRequest(object):
+    def __init__(self, store):
+        self.store = store
+
+
+class FacetRequest(FakeRequest):
+    def __init__(self, store, col, term):
+        FakeRequest.__init__(self, store)
+        self.resource = FakeResource([col])
+        self.args = {'term': [term]}
+        self.code = 200
+
+    def setResponseCode(self, code):
+        self.code = code
+
+
+class FakeResource(object):
+    def __init__(self, args):
+        self.args = args
+
+
+class AutocompleteTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+        self.store.execute("CREATE TABLE test_customer (id INTEGER PRIMARY KEY, name VARCHAR)")
+        self.store.execute("CREATE TABLE test_order (id INTEGER PRIMARY KEY, customer_id INTEGER)")
+        self.patch(events, 'changeHandlers', defaultdict(list))
+        self.patch(autocomplete, 'searchCache', autocomplete.SearchCache())
+        for (i, name) in enumerate([u'Abbey', u'Abbot', u'Babbage', u'Cab_Co',
+                                    u'Cabbage', u'Zed']):
+            self.addCustomer(i + 1, name)
+
+        for (model, crudClass) in [(Customer, CrudCustomer), (Order, CrudOrder)]:
+            helpers.exposedStormClasses[model.__name__] = (model, crudClass)
+            self.addCleanup(helpers.exposedStormClasses.pop, model.__name__)
+
+    def addCustomer(self, customerID, name):
+        customer = Customer()
+        customer.id = customerID
+        customer.name = name
+        self.store.add(customer)
+        self.store.commit()
+        return customer
+
+    def search(self, term, **kwargs):
+        return autocomplete.searchNames(self.store, Customer, Customer.name, term, **kwargs)
+
+    def test_prefix(self):
+        self.assertEqual(self.search(u'Ab'), ([(1, u'Abbey'), (2, u'Abbot')], False))
+        self.assertEqual(self.search(u'Cab_'), ([(4, u'Cab_Co')], False))
+        self.assertEqual(self.search(u'%'), ([], False))
+
+    def test_substring(self):
+        self.assertEqual(self.search(u'bba', match=autocomplete.SUBSTRING),
+                         ([(3, u'Babbage'), (5, u'Cabbage')], False))
+
+    def test_pages(self):
+        self.assertEqual(self.search(u'', pageSize=4),
+                         ([(1, u'Abbey'), (2, u'Abbot'), (3, u'Babbage'), (4, u'Cab_Co')], True))
+        self.assertEqual(self.search(u'', page=2, pageSize=4),
+                         ([(5, u'Cabbage'), (6, u'Zed')], False))
+
+    def test_conditions(self):
+        self.assertEqual(self.search(u'', conditions=[Customer.id > 4]),
+                         ([(5, u'Cabbage'), (6, u'Zed')], False))
+
+    def test_cache(self):
+        self.assertEqual(self.search(u'Z'), ([(6, u'Zed')], False))
+        self.store.execute("INSERT INTO test_customer VALUES (7, 'Zap')")
+        self.assertEqual(self.search(u'Z'), ([(6, u'Zed')], False))
+
+        # Committing through the store drops cached results
+        self.addCustomer(8, u'Zoo')
+        self.assertEqual(self.search(u'Z'), ([(7, u'Zap'), (6, u'Zed'), (8, u'Zoo')], False))
+
+    def test_cache_size(self):
+        cache = autocomplete.SearchCache(size=2)
+        for key in 'abc':
+            cache.set(Customer, key, key)
+        self.assertIdentical(cache.get(Customer, 'a'), None)
+        self.assertEqual(cache.get(Customer, 'c'), 'c')
+
+    def test_proxy(self):
+        self.patch(colproxy, 'url', lambda node, facet, args: "/%s/%s" % (facet, args[0]))
+        order = Order()
+        order.id = 1
+        order.customer_id = 3
+        self.store.add(order)
+
+        request = FakeRequest(self.store)
+        proxy = CrudOrder(order).getProxy('customer', request)
+        html = proxy.render_edit(request)
+        self.assertIn('name="warpform-Order-1-customer" value="3"', html)
+        self.assertIn('value="Babbage (#3)"', html)
+        self.assertIn('"source": "/autocomplete/customer"', html)
+        self.assertNotIn('<option', html)
+
+        # Labelled like the current value, not with the raw name
+        self.assertEqual(proxy.search(request, u'Ca', 1),
+                         ([(4, u'Cab_Co (#4)'), (5, u'Cabbage (#5)')], False))
+        self.assertEqual(proxy.search(request, u'Q', 1), ([], False))
+
+    def test_facet(self):
+        # Note can't be built without arguments
+        request = FacetRequest(self.store, 'customer', 'Cab')
+        result = json.loads(CrudRenderer(Note, CrudNote).render_autocomplete(request))
+        self.assertEqual(request.code, 200)
+        self.assertEqual(result, {
+                'results': [{'id': 4, 'label': u'Cab_Co (#4)'},
+                            {'id': 5, 'label': u'Cabbage (#5)'}],
+                'more': False})
+
+    def test_facet_no_name(self):
+        self.patch(CrudCustomer, 'nameColumn', None)
+        request = FacetRequest(self.store, 'customer', 'Cab')
+        result = json.loads(CrudRenderer(Note, CrudNote).render_autocomplete(request))
+        self.assertEqual(request.code, 400)
+        self.assertIn('error', result)
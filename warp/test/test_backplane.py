@@ -0,0 +1,353 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+from twisted.web.test.test_web import DummyChannel
+
+from warp.webserver import backplane, comet
+from warp.webserver.timerwheel import TimerWheel
+
+
+class WaitMixin(object):
+
+    @defer.inlineCallbacks
+    def waitFor(self, condition, timeout=5.0):
+        waited = 0
+        while not condition():
+            if waited > timeout:
+                self.fail("Timed out")
+            yield task.deferLater(reactor, 0.01, lambda: None)
+            waited += 0.01
+
+
+class BrokerBackplaneTest(WaitMixin, unittest.TestCase):
+    """
+    Run a broker and two workers over a real Unix socket.
+    """
+    def setUp(self):
+        self.path = self.mktemp()
+        port = backplane.listenBroker(self.path)
+        self.addCleanup(port.stopListening)
+        self.broker = port.factory
+
+        self.received = {'a': [], 'b': []}
+        self.workers = {}
+        for name in 'ab':
+            worker = backplane.BrokerBackplane(
+                self.path, self.recorder(name, 'pub'), self.recorder(name, 'push'),
+                self.recorder(name, 'subscribe'))
+            worker.startService()
+            self.addCleanup(worker.stopService)
+            self.workers[name] = worker
+
+        return self.waitFor(lambda: all(worker.connection is not None
+                                        for worker in self.workers.values()))
+
+    def recorder(self, name, kind):
+        return lambda *args: self.received[name].append((kind,) + args)
+
+    @defer.inlineCallbacks
+    def test_publish(self):
+        a, b = self.workers['a'], self.workers['b']
+        b.channelAdded('news')
+        yield self.waitFor(lambda: 'news' in self.broker.channels)
+
+        a.publish('news', '{"n":1}', None)
+        a.publish('other', '{"n":2}', None)
+        b.publish('news', '{"n":3}', None)
+        yield self.waitFor(lambda: self.received['b'])
+
+        self.assertEqual(self.received['b'], [('pub', 'news', '{"n":1}', None)])
+        self.assertEqual(self.received['a'], [])
+
+    @defer.inlineCallbacks
+    def test_push(self):
+        a, b = self.workers['a'], self.workers['b']
+        b.sessionAdded('s1')
+        yield self.waitFor(lambda: 's1' in self.broker.sessions)
+
+        a.push('s1', '{"n":1}', 'counter')
+        yield self.waitFor(lambda: self.received['b'])
+        self.assertEqual(self.received['b'], [('push', 's1', '{"n":1}', 'counter')])
+
+        b.sessionRemoved('s1')
+        yield self.waitFor(lambda: 's1' not in self.broker.sessions)
+
+    @defer.inlineCallbacks
+    def test_session_on_two_workers(self):
+        a, b = self.workers['a'], self.workers['b']
+        a.sessionAdded('s1')
+        b.sessionAdded('s1')
+        yield self.waitFor(lambda: len(self.broker.sessions.get('s1', ())) == 2)
+
+        # Registering on b didn't take the session away from a
+        b.push('s1', '{"n":1}')
+        yield self.waitFor(lambda: self.received['a'])
+        self.assertEqual(self.received['a'], [('push', 's1', '{"n":1}', None)])
+
+        b.sessionRemoved('s1')
+        yield self.waitFor(lambda: len(self.broker.sessions['s1']) == 1)
+
+    @defer.inlineCallbacks
+    def test_subscribe(self):
+        a, b = self.workers['a'], self.workers['b']
+        b.sessionAdded('s1')
+        yield self.waitFor(lambda: 's1' in self.broker.sessions)
+
+        self.assertTrue(a.subscribe('s1', 'news'))
+        yield self.waitFor(lambda: self.received['b'])
+        self.assertEqual(self.received['b'], [('subscribe', 's1', 'news')])
+        self.assertEqual(self.received['a'], [])
+
+    @defer.inlineCallbacks
+    def test_subscribe_before_session(self):
+        a, b = self.workers['a'], self.workers['b']
+        a.subscribe('s1', 'news')
+        yield self.waitFor(lambda: 's1' in self.broker.subscriptions)
+
+        # The browser's stream reaches the other worker afterwards
+        b.sessionAdded('s1')
+        yield self.waitFor(lambda: self.received['b'])
+        self.assertEqual(self.received['b'], [('subscribe', 's1', 'news')])
+
+        # Gone everywhere, so forgotten
+        b.sessionRemoved('s1')
+        yield self.waitFor(lambda: not self.broker.subscriptions)
+
+    def test_waiting_limit(self):
+        self.broker.maxWaiting = 2
+        for sid in 'xyz':
+            self.broker.addSessionChannel(sid, 'news')
+        self.assertEqual(sorted(self.broker.subscriptions), ['y', 'z'])
+
+    @defer.inlineCallbacks
+    def test_worker_gone(self):
+        b = self.workers['b']
+        b.channelAdded('news')
+        b.sessionAdded('s1')
+        yield self.waitFor(lambda: 's1' in self.broker.sessions)
+
+        yield b.stopService()
+        yield self.waitFor(lambda: not self.broker.sessions and not self.broker.channels)
+
+
+class RecordingBackplane(object):
+    def __init__(self):
+        self.calls = []
+
+    def channelAdded(self, channel):
+        self.calls.append(('channelAdded', channel))
+
+    def channelRemoved(self, channel):
+        self.calls.append(('channelRemoved', channel))
+
+    def sessionAdded(self, sid):
+        self.calls.append(('sessionAdded', sid))
+
+    def sessionRemoved(self, sid):
+        self.calls.append(('sessionRemoved', sid))
+
+    def subscribe(self, sid, channel):
+        self.calls.append(('subscribe', sid, channel))
+        return False
+
+    def publish(self, channel, data, coalesce=None):
+        self.calls.append(('publish', channel, data, coalesce))
+
+    def push(self, sid, data, coalesce=None):
+        self.calls.append(('push', sid, data, coalesce))
+
+
+class CometBackplaneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(comet, 'wheel', TimerWheel(clock=task.Clock()))
+        self.patch(comet, 'sessions', {})
+        self.patch(comet, 'channels', {})
+        self.backplane = RecordingBackplane()
+        self.patch(comet, 'backplane', self.backplane)
+
+    def makeSession(self, sid):
+        request = DummyRequest([])
+        request.args = {'id': [sid]}
+        return comet.get_session(request, True)
+
+    def test_announce(self):
+        session = self.makeSession('a')
+        session.subscribe('news')
+        self.makeSession('b').subscribe('news')
+        session.cbSessionTimeout()
+        self.assertEqual(self.backplane.calls, [
+            ('sessionAdded', 'a'),
+            ('channelAdded', 'news'),
+            ('sessionAdded', 'b'),
+            ('sessionRemoved', 'a'),
+        ])
+
+    def test_publish(self):
+        session = self.makeSession('a')
+        session.subscribe('news')
+        del self.backplane.calls[:]
+
+        self.assertEqual(comet.publish('news', {'n': 1}, 'c'), 1)
+        self.assertEqual(self.backplane.calls, [('publish', 'news', '{"n": 1}', 'c')])
+        self.assertEqual(session.buffered(), ['{"n": 1}'])
+
+        comet.deliver('news', '{"n": 2}', 'c')
+        self.assertEqual(session.buffered(), ['{"n": 2}'])
+
+    def test_pushTo(self):
+        session = self.makeSession('a')
+        del self.backplane.calls[:]
+
+        comet.pushTo('a', {'n': 1})
+        comet.pushTo('elsewhere', {'n': 2})
+        comet.deliverTo('a', '{"n": 3}')
+        self.assertEqual(session.buffered(), ['{"n": 1}', '{"n": 3}'])
+        self.assertEqual(self.backplane.calls,
+                         [('push', 'elsewhere', '{"n": 2}', None)])
+
+
+def makeRequest(sid):
+    request = server.Request(DummyChannel(), False)
+    request.gotLength(0)
+    request.method = 'GET'
+    request.clientproto = 'HTTP/1.1'
+    request.args = {'id': [sid]}
+    return request
+
+
+class CometWorker(object):
+    """
+    The comet state of one worker process, swapped into L{comet} while the
+    worker runs something.
+    """
+    def __init__(self, path):
+        self.sessions = {}
+        self.channels = {}
+        self.backplane = backplane.BrokerBackplane(
+            path, self.wrap(comet.deliver), self.wrap(comet.deliverTo),
+            self.wrap(comet.subscribeTo))
+
+    def wrap(self, fn):
+        return lambda *args: self.run(fn, *args)
+
+    def run(self, fn, *args):
+        saved = (comet.sessions, comet.channels, comet.backplane)
+        comet.sessions, comet.channels, comet.backplane = (
+            self.sessions, self.channels, self.backplane)
+        try:
+            return fn(*args)
+        finally:
+            comet.sessions, comet.channels, comet.backplane = saved
+
+
+class TwoWorkerCometTest(WaitMixin, unittest.TestCase):
+    """
+    A browser's stream on one worker, subscribed from another.
+    """
+    def setUp(self):
+        self.patch(comet, 'wheel', TimerWheel(clock=task.Clock()))
+        self.path = self.mktemp()
+        port = backplane.listenBroker(self.path)
+        self.addCleanup(port.stopListening)
+        self.broker = port.factory
+
+        self.workers = {}
+        for name in 'ab':
+            worker = CometWorker(self.path)
+            worker.backplane.startService()
+            self.addCleanup(worker.backplane.stopService)
+            self.workers[name] = worker
+
+        return self.waitFor(lambda: all(worker.backplane.connection is not None
+                                        for worker in self.workers.values()))
+
+    def written(self, request):
+        return request.transport.written.getvalue()
+
+    @defer.inlineCallbacks
+    def test_subscribe_elsewhere(self):
+        a, b = self.workers['a'], self.workers['b']
+        stream = makeRequest('s1')
+        b.run(comet.render_stream, stream)
+        yield self.waitFor(lambda: 's1' in self.broker.sessions)
+
+        a.run(comet.subscribe, 's1', 'news')
+        # No session left on a that nothing reads
+        self.assertEqual(a.sessions, {})
+        yield self.waitFor(lambda: 'news' in self.broker.channels)
+
+        a.run(comet.publish, 'news', {'n': 1})
+        yield self.waitFor(lambda: '{"n": 1}' in self.written(stream))
+
+        # Still pushed to b's stream
+        a.run(comet.pushTo, 's1', {'n': 2})
+        yield self.waitFor(lambda: '{"n": 2}' in self.written(stream))
+
+    @defer.inlineCallbacks
+    def test_subscribe_before_stream(self):
+        a, b = self.workers['a'], self.workers['b']
+        a.run(comet.subscribe, 's1', 'news')
+        yield self.waitFor(lambda: 's1' in self.broker.subscriptions)
+        self.assertEqual(a.sessions, {})
+
+        stream = makeRequest('s1')
+        b.run(comet.render_stream, stream)
+        yield self.waitFor(lambda: 'news' in self.broker.channels)
+
+        a.run(comet.publish, 'news', {'n': 1})
+        yield self.waitFor(lambda: '{"n": 1}' in self.written(stream))
+
+
+class WorkerDeliveryTest(unittest.TestCase):
+    """
+    Frames from the broker reach browsers through real requests.
+    """
+    def setUp(self):
+        self.patch(comet, 'wheel', TimerWheel(clock=task.Clock()))
+        self.patch(comet, 'sessions', {})
+        self.patch(comet, 'channels', {})
+        self.patch(comet, 'backplane', RecordingBackplane())
+
+        worker = backplane.BrokerBackplane(self.mktemp(), comet.deliver, comet.deliverTo)
+        self.protocol = backplane.WorkerProtocol()
+        self.protocol.factory = worker.factory
+
+        comet.subscribe('s1', 'news')
+
+    def makeRequest(self):
+        return makeRequest('s1')
+
+    def receive(self, *frame):
+        self.protocol.stringReceived(json.dumps(frame))
+
+    def test_longpoll(self):
+        request = self.makeRequest()
+        self.assertEqual(comet.render_longpoll(request), server.NOT_DONE_YET)
+        self.receive('pub', 'news', '{"n": 1}', None)
+        self.assertTrue(request.finished)
+        self.assertIn('[{"n": 1}]', request.transport.written.getvalue())
+
+        # Buffered, then fetched by the next poll
+        self.receive('push', 's1', '{"n": 2}', 'counter')
+        response = comet.render_longpoll(self.makeRequest())
+        self.assertIsInstance(response, str)
+        self.assertEqual(response, '[{"n": 2}]')
+
+    def test_stream(self):
+        request = self.makeRequest()
+        comet.render_stream(request)
+        self.receive('pub', 'news', '{"text": "caf\\u00e9"}', None)
+        self.assertIn('data: {"text": "caf\\u00e9"}', request.transport.written.getvalue())
+
+    def test_bad_frames(self):
+        for frame in ['nonsense', '[]', '["nothing"]', '["pub"]', '[1]']:
+            self.protocol.stringReceived(frame)
+        self.assertEqual(len(self.flushLoggedErrors()), 0)
+
+        self.protocol.factory.backplane.deliver = lambda *args: 1 // 0
+        self.receive('pub', 'news', '{}', None)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
@@ -0,0 +1,175 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from warp import metrics, runtime
+from warp.webserver import comet
+from warp.webserver.timerwheel import TimerWheel
+
+
+class CometTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(comet, 'wheel', TimerWheel(clock=self.clock))
+        self.patch(comet, 'sessions', {})
+        self.patch(comet, 'channels', {})
+
+    def makeSession(self, sid):
+        request = DummyRequest([])
+        request.args = {'id': [sid]}
+        return comet.get_session(request, True)
+
+    def poll(self, session):
+        request = DummyRequest([])
+        result = session.addListener(request)
+        if result is NOT_DONE_YET:
+            return request
+        return json.loads(result)
+
+    def test_buffered(self):
+        session = self.makeSession('a')
+        session.push({'key': 1})
+        session.push({'key': 2})
+        self.assertEqual(self.poll(session), [{'key': 1}, {'key': 2}])
+        self.assertEqual(session.buffered(), [])
+
+    def test_listener(self):
+        session = self.makeSession('a')
+        request = self.poll(session)
+        session.push({'key': 1})
+        self.assertEqual(json.loads("".join(request.written)), [{'key': 1}])
+        self.assertEqual(request.finished, 1)
+
+    def test_publish(self):
+        sessions = [self.makeSession(sid) for sid in 'abc']
+        sessions[0].subscribe('news')
+        sessions[1].subscribe('news')
+
+        encoded = []
+        self.patch(comet.json, 'dumps', lambda obj: encoded.append(obj) or '{"n":1}')
+        self.assertEqual(comet.publish('news', {'n': 1}), 2)
+        self.assertEqual(len(encoded), 1)
+
+        self.assertEqual(sessions[0].buffered(), ['{"n":1}'])
+        self.assertEqual(sessions[2].buffered(), [])
+        self.assertEqual(comet.publish('nobody', {}), 0)
+
+    def test_coalesce(self):
+        session = self.makeSession('a')
+        session.subscribe('stats')
+        comet.publish('stats', {'count': 1}, coalesce='count')
+        session.push({'other': True})
+        comet.publish('stats', {'count': 2}, coalesce='count')
+        self.assertEqual(self.poll(session), [{'count': 2}, {'other': True}])
+
+        comet.publish('stats', {'count': 3}, coalesce='count')
+        self.assertEqual(self.poll(session), [{'count': 3}])
+
+    def test_unsubscribe_on_timeout(self):
+        session = self.makeSession('a')
+        session.subscribe('news')
+        self.clock.advance(comet.SESSION_TIMEOUT + 1)
+        self.assertEqual(comet.channels, {})
+        self.assertEqual(comet.sessions, {})
+
+    def stream(self, session, lastEventId=None):
+        request = DummyRequest([])
+        if lastEventId is not None:
+            request.headers['last-event-id'] = str(lastEventId)
+        self.assertIdentical(session.addStream(request), NOT_DONE_YET)
+        return request
+
+    def events(self, request):
+        return [json.loads(line[6:]) for line in "".join(request.written).splitlines()
+                if line.startswith('data: ')]
+
+    def test_stream(self):
+        session = self.makeSession('a')
+        session.push({'n': 1})
+        request = self.stream(session)
+        self.assertEqual(request.outgoingHeaders['content-type'], 'text/event-stream')
+
+        session.push({'n': 2})
+        self.assertEqual(self.events(request), [{'n': 1}, {'n': 2}])
+        self.assertIn("id: 2\n", "".join(request.written))
+
+    def test_heartbeat(self):
+        session = self.makeSession('a')
+        request = self.stream(session)
+        self.clock.pump([comet.HEARTBEAT_INTERVAL] * 3)
+        self.assertEqual("".join(request.written).count(": heartbeat"), 3)
+        self.assertIn('a', comet.sessions)
+
+        request.finish()
+        self.assertIdentical(session.stream, None)
+        self.assertFalse(session.heartbeat)
+
+    def test_resume(self):
+        session = self.makeSession('a')
+        request = self.stream(session)
+        for n in range(3):
+            session.push({'n': n})
+        request.finish()
+
+        session.push({'n': 3})
+        request = self.stream(session, lastEventId=1)
+        self.assertEqual(self.events(request), [{'n': 1}, {'n': 2}, {'n': 3}])
+
+    def test_timeouts_on_wheel(self):
+        session = self.makeSession('a')
+        request = self.poll(session)
+        self.assertEqual(len(comet.wheel), 2)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.pump([1] * comet.POLL_TIMEOUT)
+        self.assertEqual(json.loads("".join(request.written)), [])
+        self.assertEqual(len(comet.wheel), 1)
+
+    def test_buffer_drop_oldest(self):
+        self.patch(runtime, 'config', {'cometBufferSize': 2})
+        session = self.makeSession('a')
+        dropped = metrics.cometMessagesDropped.labels('drop-oldest')._value.get()
+        for n in range(4):
+            session.push({'n': n})
+        self.assertEqual(self.poll(session), [{'n': 2}, {'n': 3}])
+        self.assertEqual(
+            metrics.cometMessagesDropped.labels('drop-oldest')._value.get() - dropped, 2)
+
+    def test_buffer_coalesce(self):
+        self.patch(runtime, 'config', {'cometBufferSize': 2,
+                                       'cometBufferPolicy': 'coalesce'})
+        session = self.makeSession('a')
+        session.push({'n': 0})
+        session.push({'count': 1}, coalesce='count')
+        session.push({'n': 2})
+        session.push({'n': 3})
+        session.push({'count': 4}, coalesce='count')
+        self.assertEqual(self.poll(session), [
+            {'n': 0}, {'count': 4}, {'key': '_overflow', 'dropped': 2}])
+
+        session.push({'n': 5})
+        self.assertEqual(self.poll(session), [{'n': 5}])
+
+    def test_id_owner(self):
+        class FakeSession(object):
+            def __init__(self, uid):
+                self.uid = uid
+                self.isMaterialized = False
+
+            def materialize(self):
+                self.isMaterialized = True
+
+        owner, other = FakeSession('owner'), FakeSession('other')
+        request = DummyRequest([])
+        request.session = owner
+        sid = comet.render_id(request)
+
+        self.assertTrue(owner.isMaterialized)
+        self.assertTrue(comet.ownedBy(sid, owner))
+        self.assertFalse(comet.ownedBy(sid, other))
+        self.assertFalse(comet.ownedBy(sid.split('.')[0], owner))
+        self.assertFalse(comet.ownedBy('guess', owner))
@@ -0,0 +1,114 @@
+from collections import defaultdict
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from warp.common import events
+
+
+class Thing(object):
+    pass
+
+class Other(object):
+    pass
+
+
+class EventDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(events, 'reactor', self.clock)
+        self.patch(events, 'handlers', defaultdict(list))
+        self.patch(events, '_handlerTable', {})
+        self.dispatcher = events.EventDispatcher(maxThreads=2, batchSize=3)
+        self.calls = []
+
+        self.threads = []
+        def deferToThreadPool(reactor, pool, f, *args):
+            d = defer.Deferred()
+            self.threads.append((d, f, args))
+            return d
+        self.patch(events, 'deferToThreadPool', deferToThreadPool)
+        self.patch(self.dispatcher, 'getPool', lambda: None)
+
+    def emit(self, obj, event, **kwargs):
+        self.dispatcher.dispatch(events.PendingEvent(obj, event, kwargs))
+
+    def record(self, name):
+        return lambda obj, **kwargs: self.calls.append((name, obj, kwargs))
+
+    def test_table(self):
+        general = self.record('general')
+        events.handler('saved')(general)
+        events.handler('saved', Thing)(self.record('thing'))
+        events.handler('saved', Thing)(general)
+
+        table = events.getHandlers('Thing', 'saved')
+        self.assertEqual([h.fun for h in table][1:], [general])
+        self.assertIdentical(events.getHandlers('Thing', 'saved'), table)
+        self.assertEqual(len(events.getHandlers('Other', 'saved')), 1)
+
+        events.handler('saved', Other)(self.record('other'))
+        self.assertEqual(len(events.getHandlers('Other', 'saved')), 2)
+
+    def test_sync(self):
+        events.handler('saved', Thing)(self.record('sync'))
+        thing = Thing()
+        self.emit(thing, 'saved', reason='test')
+        self.emit(Other(), 'saved')
+        self.assertEqual(self.calls, [('sync', thing, {'reason': 'test'})])
+
+    def test_queue(self):
+        events.handler('saved', mode=events.QUEUE)(self.record('queued'))
+        things = [Thing() for _ in range(4)]
+        for thing in things:
+            self.emit(thing, 'saved')
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.dispatcher.depth, 4)
+
+        self.clock.advance(0)
+        self.assertEqual([obj for (name, obj, kwargs) in self.calls], things)
+        self.assertEqual(self.dispatcher.depth, 0)
+
+    def test_batch(self):
+        batches = []
+        @events.handler('saved', mode=events.QUEUE, batch=True)
+        def saved(batch):
+            batches.append(batch)
+        things = [Thing() for _ in range(5)]
+        for thing in things:
+            self.emit(thing, 'saved')
+
+        self.clock.advance(0)
+        self.assertEqual([[e.obj for e in batch] for batch in batches],
+                         [things[:3], things[3:]])
+
+    def test_sync_batch(self):
+        self.assertRaises(ValueError, events.handler('saved', batch=True), self.record('x'))
+
+    def test_threads(self):
+        for name in 'abc':
+            events.handler('saved', mode=events.THREAD)(self.record(name))
+
+        self.emit(Thing(), 'saved')
+        self.clock.advance(0)
+        # Two threads at most
+        self.assertEqual(len(self.threads), 2)
+        self.assertEqual(self.dispatcher.depth, 1)
+
+        d, f, args = self.threads.pop(0)
+        f(*args)
+        d.callback(None)
+        self.clock.advance(0)
+        self.assertEqual(len(self.threads), 2)
+        self.assertEqual(self.dispatcher.depth, 0)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_error(self):
+        def broken(obj):
+            raise RuntimeError("broken")
+        events.handler('saved')(broken)
+        events.handler('saved')(self.record('after'))
+        self.emit(Thing(), 'saved')
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual(len(self.calls), 1)
@@ -0,0 +1,136 @@
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from datetime import date
+
+from storm.locals import Storm, Int, Unicode, Reference, Date, Bool
+
+from twisted.trial import unittest
+
+from warp import runtime, helpers
+from warp.common import store
+from warp.crud import filters
+from warp.crud.model import CrudModel
+
+
+class Customer(Storm):
+    __storm_table__ = "test_customer"
+
+    id = Int(primary=True)
+    name = Unicode()
+    city = Unicode()
+    secret = Unicode()
+
+
+class Order(Storm):
+    __storm_table__ = "test_order"
+
+    id = Int(primary=True)
+    customer_id = Int()
+    customer = Reference(customer_id, Customer.id)
+    quantity = Int()
+    placed = Date()
+    paid = Bool()
+
+
+class CrudCustomer(CrudModel):
+    listColumns = ['name', 'city']
+    nameColumn = Customer.name
+
+
+class CrudOrder(CrudModel):
+    listColumns = ['id', 'customer', 'quantity', 'placed', 'paid']
+
+
+class FilterTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+        self.store.execute("CREATE TABLE test_customer (id INTEGER PRIMARY KEY, name VARCHAR, city VARCHAR, "
+                           "secret VARCHAR)")
+        self.store.execute("CREATE TABLE test_order (id INTEGER PRIMARY KEY, customer_id INTEGER, "
+                           "quantity INTEGER, placed VARCHAR, paid INTEGER)")
+        for row in [(1, u'Abbey', u'Hanoi'), (2, u'Babbage', u'Paris'), (3, u'Cab_Co', u'Hanoi')]:
+            self.store.execute("INSERT INTO test_customer VALUES (?, ?, ?, 'x')", row)
+        for row in [(1, 1, 5, u'2011-01-01', 1), (2, 1, 10, u'2011-02-01', 0),
+                    (3, 2, 15, u'2011-03-01', 1), (4, 3, 20, u'2011-04-01', 0),
+                    (5, None, 25, u'2011-05-01', 0)]:
+            self.store.execute("INSERT INTO test_order VALUES (?, ?, ?, ?, ?)", row)
+        self.store.commit()
+
+        for (model, crudClass) in [(Customer, CrudCustomer), (Order, CrudOrder)]:
+            helpers.exposedStormClasses[model.__name__] = (model, crudClass)
+            self.addCleanup(helpers.exposedStormClasses.pop, model.__name__)
+
+    def search(self, *rules, **group):
+        group.setdefault('groupOp', 'AND')
+        group['rules'] = [{'field': f, 'op': op, 'data': data} for (f, op, data) in rules]
+        args = {'_search': ['true'], 'filters': [json.dumps(group)]}
+        conditions = filters.searchConditions(CrudOrder, Order, args)
+        return sorted(order.id for order in self.store.find(Order, *conditions))
+
+    def test_comparisons(self):
+        self.assertEqual(self.search(('quantity', 'gt', '10')), [3, 4, 5])
+        self.assertEqual(self.search(('quantity', 'le', '10'), ('paid', 'eq', 'true')), [1])
+        self.assertEqual(self.search(('quantity', 'in', '5, 20')), [1, 4])
+        self.assertEqual(self.search(('placed', 'lt', '02/15/2011')), [1, 2])
+
+    def test_ne_includes_null(self):
+        self.assertEqual(self.search(('customer', 'ne', 'Abbey')), [3, 4, 5])
+
+    def test_reference(self):
+        self.assertEqual(self.search(('customer', 'bw', 'ab')), [1, 2])
+        self.assertEqual(self.search(('customer', 'cn', 'b_')), [4])
+        self.assertEqual(self.search(('customer.city', 'eq', 'Hanoi')), [1, 2, 4])
+
+    def test_groups(self):
+        self.assertEqual(self.search(('quantity', 'eq', '25'), ('customer', 'eq', 'Babbage'),
+                                     groupOp='OR'), [3, 5])
+        self.assertEqual(self.search(('paid', 'eq', 'false'),
+                                     groups=[{'groupOp': 'OR', 'rules': [
+                                         {'field': 'quantity', 'op': 'lt', 'data': '15'},
+                                         {'field': 'customer.city', 'op': 'eq', 'data': 'Hanoi'}]}]),
+                         [2, 4])
+
+    def test_single_field(self):
+        args = {'_search': ['true'], 'searchField': ['quantity'],
+                'searchOper': ['ge'], 'searchString': ['20']}
+        conditions = filters.searchConditions(CrudOrder, Order, args)
+        self.assertEqual(sorted(o.id for o in self.store.find(Order, *conditions)), [4, 5])
+
+    def test_not_searching(self):
+        self.assertEqual(filters.searchConditions(CrudOrder, Order, {'_search': ['false']}), [])
+
+    def test_invalid(self):
+        self.assertRaises(filters.FilterError, self.search, ('quantity', 'gt', 'many'))
+        self.assertRaises(filters.FilterError, self.search, ('quantity', 'cn', '1'))
+        self.assertRaises(filters.FilterError, self.search, ('quantity', 'xx', '1'))
+        self.assertRaises(filters.FilterError, self.search, ('customer_id', 'eq', '1'))
+        self.assertRaises(filters.FilterError, self.search, ('customer.nothing', 'eq', '1'))
+        self.assertRaises(filters.FilterError, self.search, ('placed', 'eq', 'yesterday'))
+        self.assertRaises(filters.FilterError, self.search, groupOp='XOR')
+        # Columns the referenced model doesn't list
+        self.assertRaises(filters.FilterError, self.search, ('customer.secret', 'bw', 'x'))
+        self.assertRaises(filters.FilterError, self.search, ('customer.id', 'eq', '1'))
+        self.assertRaises(filters.FilterError, self.search,
+                          *[('quantity', 'eq', '1')] * (filters.MAX_RULES + 1))
+
+    def test_operators(self):
+        self.assertEqual(filters.searchOperators(Order, 'quantity'), list(filters.COMPARISONS))
+        self.assertEqual(filters.searchOperators(Order, 'customer')[:2], ['bw', 'cn'])
+        self.assertEqual(filters.searchOperators(Order, 'nothing'), [])
+
+    def test_depth(self):
+        group = {'groupOp': 'AND', 'rules': [{'field': 'quantity', 'op': 'eq', 'data': '5'}]}
+        for i in range(filters.MAX_DEPTH):
+            group = {'groupOp': 'AND', 'groups': [group]}
+        self.assertEqual(self.search(**group), [1])
+
+        for depth in (filters.MAX_DEPTH + 1, 5000):
+            nested = ('{"groups": [' * depth + json.dumps(group) + ']}' * depth)
+            args = {'_search': ['true'], 'filters': [nested]}
+            self.assertRaises(filters.FilterError, filters.searchConditions,
+                              CrudOrder, Order, args)
@@ -0,0 +1,56 @@
+from twisted.trial import unittest
+
+from warp.common import flash
+
+
+class DummySession(object):
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class MemoryFlashStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = flash.MemoryFlashStore(maxEntries=2, ttl=60, maxBytes=1000)
+
+    def test_add_get(self):
+        session = DummySession('a')
+        self.store.add(session, ("Hello", (), {}))
+        self.store.add(session, ("World", (1,), {}))
+
+        self.assertEqual(self.store.get(session, clear=False),
+                         [("Hello", (), {}), ("World", (1,), {})])
+        self.assertEqual(len(self.store.get(session)), 2)
+        self.assertEqual(self.store.get(session), [])
+        self.assertEqual(self.store.bytes, 0)
+
+    def test_max_entries(self):
+        for uid in 'abc':
+            self.store.add(DummySession(uid), ("Hello", (), {}))
+        self.assertEqual(list(self.store.entries), ['b', 'c'])
+        self.assertEqual(self.store.get(DummySession('a')), [])
+
+    def test_max_bytes(self):
+        self.store.add(DummySession('a'), ("x" * 600, (), {}))
+        self.store.add(DummySession('b'), ("x" * 600, (), {}))
+        self.assertEqual(list(self.store.entries), ['b'])
+        self.assertTrue(self.store.bytes <= 1000)
+
+    def test_ttl(self):
+        self.store.ttl = -1
+        self.store.add(DummySession('a'), ("Hello", (), {}))
+        self.assertEqual(self.store.get(DummySession('a')), [])
+
+        self.store.add(DummySession('b'), ("Hello", (), {}))
+        self.store.ttl = 60
+        self.store.add(DummySession('c'), ("Hello", (), {}))
+        self.assertEqual(list(self.store.entries), ['c'])
+        self.assertEqual(self.store.bytes, flash.messageSize(("Hello", (), {})))
+
+    def test_max_per_session(self):
+        session = DummySession('a')
+        for i in range(flash.MAX_PER_SESSION + 5):
+            self.store.add(session, ("Message", (i,), {}))
+        messages = self.store.get(session)
+        self.assertEqual(len(messages), flash.MAX_PER_SESSION)
+        self.assertEqual(messages[-1][1], (flash.MAX_PER_SESSION + 4,))
@@ -0,0 +1,285 @@
+from collections import defaultdict
+
+from storm.locals import Storm, Int, Unicode, Reference
+from storm.tracer import install_tracer, remove_tracer_type
+
+from twisted.trial import unittest
+
+from warp import runtime
+from warp.common import store, events
+from warp.crud import listing
+from warp.crud.model import CrudModel
+
+
+class Item(Storm):
+    __storm_table__ = "test_item"
+
+    id = Int(primary=True)
+    name = Unicode()
+    rank = Int()
+
+
+class ListQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+        self.store.execute("CREATE TABLE test_item (id INTEGER PRIMARY KEY, name VARCHAR, rank INTEGER)")
+        for i in range(1, 24):
+            item = Item()
+            item.id = i
+            item.name = u'item%d' % i
+            # Plenty of ties, so the primary key has to break them
+            item.rank = i % 4
+            self.store.add(item)
+        self.store.commit()
+
+    def query(self, descending=False, conditions=(), sortKey=['rank', 'asc']):
+        return listing.ListQuery(self.store, Item, conditions, Item.rank,
+                                 descending=descending, sortKey=sortKey)
+
+    def expected(self, descending=False):
+        items = sorted(self.store.find(Item), key=lambda item: (item.rank, item.id),
+                       reverse=descending)
+        return [item.id for item in items]
+
+    def walk(self, query):
+        ids, cursor = [], None
+        for page in range(1, 4):
+            result = query.page(page, 10, cursor)
+            self.assertEqual(result.total, 23)
+            ids.extend(item.id for item in result.rows)
+            cursor = result.cursor
+        return ids
+
+    def test_offset(self):
+        result = self.query().page(2, 10)
+        self.assertEqual([item.id for item in result.rows], self.expected()[10:20])
+        self.assertEqual(result.total, 23)
+        self.assertEqual(result.cursor, {'page': 2, 'id': result.rows[-1].id,
+                                         'sort': ['rank', 'asc']})
+
+    def test_seek(self):
+        self.assertEqual(self.walk(self.query()), self.expected())
+        self.assertEqual(self.walk(self.query(descending=True)), self.expected(True))
+
+    def test_seek_condition(self):
+        query = self.query()
+        cursor = query.page(1, 10).cursor
+        self.assertNotIdentical(query.seekCondition(2, cursor), None)
+        # Only for the next page in the same order
+        self.assertIdentical(query.seekCondition(3, cursor), None)
+        self.assertIdentical(self.query(sortKey=['name', 'asc']).seekCondition(2, cursor), None)
+
+    def test_bad_cursor(self):
+        query = self.query()
+        for cursor in ['cursor', [1], {'page': 1}, {'page': 1, 'id': 'x'},
+                       {'page': 1, 'id': [1]}, {'page': 1, 'id': {}}, {'page': '1', 'id': 1}]:
+            if isinstance(cursor, dict):
+                cursor['sort'] = ['rank', 'asc']
+            self.assertIdentical(query.seekCondition(2, cursor), None)
+            self.assertEqual([item.id for item in query.page(2, 10, cursor).rows],
+                             self.expected()[10:20])
+
+    def test_seek_nulls(self):
+        for item in self.store.find(Item, Item.rank == 2):
+            item.rank = None
+        self.store.commit()
+
+        # SQLite sorts NULL first
+        self.assertEqual(self.walk(self.query()), self.expected())
+        self.assertEqual(self.walk(self.query(descending=True)), self.expected(True))
+
+        # Seeking past each row finds the rows after it, wherever the
+        # database sorts NULL
+        for nullsHigh in (False, True):
+            self.patch(listing, 'nullsSortHigh', lambda store: nullsHigh)
+            for descending in (False, True):
+                order = [item.id for item in sorted(
+                    self.store.find(Item), reverse=descending,
+                    key=lambda item: ((item.rank is None) == nullsHigh, item.rank, item.id))]
+                query = self.query(descending=descending)
+                for (n, itemID) in enumerate(order):
+                    cursor = {'page': 1, 'id': itemID, 'sort': ['rank', 'asc']}
+                    found = self.store.find(Item.id, query.seekCondition(2, cursor))
+                    self.assertEqual(sorted(found), sorted(order[n + 1:]))
+
+    def test_without_window(self):
+        self.patch(listing, 'hasWindowFunctions', lambda store: False)
+        self.assertEqual(self.walk(self.query()), self.expected())
+
+    def test_past_end(self):
+        result = self.query(conditions=[Item.rank == 1]).page(5, 10)
+        self.assertEqual(result.rows, [])
+        self.assertEqual(result.total, 6)
+        self.assertIdentical(result.cursor, None)
+
+
+class CountModeTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+        self.store.execute("CREATE TABLE test_item (id INTEGER PRIMARY KEY, name VARCHAR, rank INTEGER)")
+        self.patch(events, 'changeHandlers', defaultdict(list))
+        self.patch(listing, 'countCache', listing.CountCache())
+        for i in range(1, 6):
+            self.addItem(i)
+
+    def addItem(self, i):
+        item = Item()
+        item.id = i
+        item.rank = i % 2
+        self.store.add(item)
+        self.store.commit()
+        return item
+
+    def query(self, countMode, conditions=()):
+        return listing.ListQuery(self.store, Item, conditions, Item.id,
+                                 countMode=countMode)
+
+    def test_cached(self):
+        self.assertEqual(self.query(listing.CACHED).page(1, 2).total, 5)
+        # Not committed, so not seen
+        self.store.execute("INSERT INTO test_item (id, rank) VALUES (6, 0)")
+        self.assertEqual(self.query(listing.CACHED).page(1, 2).total, 5)
+        self.assertEqual(self.query(listing.EXACT).page(1, 2).total, 6)
+
+        # Per conditions
+        odd = [Item.rank == 1]
+        self.assertEqual(self.query(listing.CACHED, odd).page(1, 2).total, 3)
+
+    def test_invalidated(self):
+        self.assertEqual(self.query(listing.CACHED).page(1, 2).total, 5)
+        self.addItem(6)
+        self.assertEqual(self.query(listing.CACHED).page(1, 2).total, 6)
+        self.store.remove(self.store.get(Item, 1))
+        self.store.commit()
+        self.assertEqual(self.query(listing.CACHED).page(1, 2).total, 5)
+
+    def test_expired(self):
+        query = listing.ListQuery(self.store, Item, [], Item.id,
+                                  countMode=listing.CACHED, countTTL=-1)
+        query.page(1, 2)
+        self.store.execute("INSERT INTO test_item (id, rank) VALUES (6, 0)")
+        self.assertEqual(query.page(1, 2).total, 6)
+
+    def test_cache_bounded(self):
+        cache = listing.CountCache(size=2)
+        for key in 'abc':
+            cache.set(Item, key, 1, 60)
+        self.assertIdentical(cache.get(Item, 'a'), None)
+        self.assertEqual(cache.get(Item, 'b'), 1)
+
+        cache.set(Item, 'd', 1, -1)
+        self.assertIdentical(cache.get(Item, 'd'), None)
+        # Dropped, not just skipped
+        self.assertEqual(len(cache.counts), 1)
+
+    def test_seek_not_cached(self):
+        query = self.query(listing.CACHED)
+        cursor = query.page(1, 2).cursor
+        listing.countCache.invalidate('Item')
+
+        # Unseen by change handlers, so the seek's count is off
+        self.store.execute("DELETE FROM test_item WHERE id = 1")
+        query.page(2, 2, cursor)
+        self.assertEqual(query.page(1, 2).total, 4)
+
+    def test_estimated(self):
+        self.patch(listing, 'estimateCount', lambda store, model, conditions: 1000)
+        result = self.query(listing.ESTIMATED).page(1, 2)
+        self.assertEqual(result.total, 1000)
+        self.assertTrue(result.approximate)
+        self.assertEqual(len(result.rows), 2)
+
+    def test_estimated_elsewhere(self):
+        # No planner estimates on SQLite, so it's cached instead
+        result = self.query(listing.ESTIMATED).page(1, 2)
+        self.assertEqual(result.total, 5)
+        self.assertFalse(result.approximate)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, self.query, 'guess')
+
+
+class Owner(Storm):
+    __storm_table__ = "test_owner"
+
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class OwnedItem(Storm):
+    __storm_table__ = "test_owned_item"
+
+    id = Int(primary=True)
+    owner_id = Int()
+    owner = Reference(owner_id, Owner.id)
+    editor_id = Int()
+    editor = Reference(editor_id, Owner.id)
+
+
+class CrudOwnedItem(CrudModel):
+    listColumns = ['id', 'owner', 'editor']
+
+    def render_list_editor(self, request):
+        return u"Someone"
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.statements = []
+
+    def connection_raw_execute(self, connection, raw_cursor, statement, params):
+        self.statements.append(statement)
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+        self.store.execute("CREATE TABLE test_owner (id INTEGER PRIMARY KEY, name VARCHAR)")
+        self.store.execute("CREATE TABLE test_owned_item "
+                           "(id INTEGER PRIMARY KEY, owner_id INTEGER, editor_id INTEGER)")
+        for i in range(1, 5):
+            self.store.execute("INSERT INTO test_owner VALUES (?, ?)", (i, u'owner%d' % i))
+        for i in range(1, 11):
+            self.store.execute("INSERT INTO test_owned_item VALUES (?, ?, ?)",
+                               (i, i % 4 + 1, (i + 1) % 4 + 1 if i < 10 else None))
+        self.store.commit()
+
+    def countQueries(self, f):
+        counter = QueryCounter()
+        install_tracer(counter)
+        self.addCleanup(remove_tracer_type, QueryCounter)
+        f()
+        return len(counter.statements)
+
+    def test_prefetch(self):
+        rows = list(self.store.find(OwnedItem).order_by(OwnedItem.id))
+        loaded = []
+        self.assertEqual(self.countQueries(
+            lambda: loaded.extend(listing.prefetch(self.store, rows, ['owner', 'editor']))), 1)
+        self.assertEqual(sorted(owner.id for owner in loaded), [1, 2, 3, 4])
+
+        names = []
+        self.assertEqual(self.countQueries(
+            lambda: names.extend((row.owner.name, row.editor and row.editor.name)
+                                 for row in rows)), 0)
+        self.assertEqual(names[0], (u'owner2', u'owner3'))
+        self.assertEqual(names[-1], (u'owner3', None))
+
+    def test_nothing_to_fetch(self):
+        self.assertEqual(listing.prefetch(self.store, [], ['owner']), [])
+        rows = list(self.store.find(OwnedItem))
+        self.assertEqual(self.countQueries(
+            lambda: listing.prefetch(self.store, rows, ['id', 'missing'])), 0)
+
+    def test_prefetch_columns(self):
+        self.assertEqual(CrudOwnedItem.prefetchColumns(OwnedItem, CrudOwnedItem.listColumns),
+                         ['owner'])
+        self.assertEqual(CrudOwnedItem.prefetchColumns(OwnedItem, CrudOwnedItem.listColumns,
+                                                       "render_"),
+                         ['owner', 'editor'])
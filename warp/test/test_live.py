@@ -0,0 +1,173 @@
+from collections import defaultdict
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+from warp import runtime
+from warp.common import store, events
+from warp.common.avatar import Avatar
+from warp.crud import live
+from warp.crud.model import CrudModel
+from warp.crud.render import CrudRenderer
+from warp.test.test_backplane import CometWorker, WaitMixin, makeRequest
+from warp.webserver import backplane, comet
+from warp.webserver.timerwheel import TimerWheel
+
+
+class CrudAvatar(CrudModel):
+    listColumns = ['email']
+    liveUpdates = True
+
+
+class LiveUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+
+        self.clock = task.Clock()
+        self.patch(live, 'reactor', self.clock)
+        self.patch(live, 'watched', {})
+        self.patch(live, 'pending', {})
+        self.patch(events, 'changeHandlers', defaultdict(list))
+        self.patch(comet, 'wheel', TimerWheel(clock=task.Clock()))
+        self.patch(comet, 'sessions', {})
+        self.patch(comet, 'channels', {})
+
+        live.watch(Avatar, CrudAvatar)
+        comet.subscribe('s', live.channelName(Avatar))
+        self.session = comet.sessions['s']
+
+    def messages(self):
+        self.clock.advance(0)
+        return [comet.json.loads(data) for data in self.session._takeBuffer()]
+
+    def addAvatar(self, email):
+        avatar = Avatar()
+        avatar.email = email
+        self.store.add(avatar)
+        self.store.commit()
+        return avatar
+
+    def test_created_and_updated(self):
+        avatar = self.addAvatar(u'a@example.com')
+        avatar.email = u'b@example.com'
+        self.store.commit()
+        other = self.addAvatar(u'c@example.com')
+        self.store.commit()
+
+        self.assertEqual(self.messages(), [{
+            'key': 'crud:Avatar',
+            'created': [avatar.id, other.id],
+            'updated': [],
+            'deleted': [],
+        }])
+
+        avatar.email = u'd@example.com'
+        self.store.remove(other)
+        self.store.commit()
+        message = self.messages()[0]
+        self.assertEqual(message['updated'], [avatar.id])
+        self.assertEqual(message['deleted'], [other.id])
+
+    def test_added_and_removed(self):
+        avatar = self.addAvatar(u'a@example.com')
+        self.store.remove(avatar)
+        self.store.commit()
+        self.assertEqual(self.messages(), [])
+
+    def test_rolled_back(self):
+        avatar = Avatar()
+        self.store.add(avatar)
+        self.store.flush()
+        self.store.rollback()
+        self.assertEqual(self.messages(), [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class FakeSession(object):
+    isMaterialized = True
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def materialize(self):
+        pass
+
+
+class ListRequest(DummyRequest):
+    def __init__(self, store, session, cometID):
+        DummyRequest.__init__(self, [])
+        self.store = store
+        self.session = session
+        self.args = {'page': ['1'], 'rows': ['10'], 'sidx': ['id'], 'sord': ['asc'],
+                     'cometID': [cometID]}
+
+
+class TwoWorkerLiveTest(WaitMixin, unittest.TestCase):
+    """
+    A grid's list request on one worker, the browser's stream on another.
+    """
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+
+        self.clock = task.Clock()
+        self.patch(live, 'reactor', self.clock)
+        self.patch(live, 'watched', {})
+        self.patch(live, 'pending', {})
+        self.patch(events, 'changeHandlers', defaultdict(list))
+        self.patch(comet, 'wheel', TimerWheel(clock=task.Clock()))
+
+        path = self.mktemp()
+        port = backplane.listenBroker(path)
+        self.addCleanup(port.stopListening)
+        self.broker = port.factory
+
+        self.workers = []
+        for i in range(2):
+            worker = CometWorker(path)
+            worker.backplane.startService()
+            self.addCleanup(worker.backplane.stopService)
+            self.workers.append(worker)
+
+        self.renderer = CrudRenderer(Avatar, CrudAvatar)
+        return self.waitFor(lambda: all(worker.backplane.connection is not None
+                                        for worker in self.workers))
+
+    @defer.inlineCallbacks
+    def test_live_elsewhere(self):
+        listWorker, streamWorker = self.workers
+        session = FakeSession('web')
+        idRequest = DummyRequest([])
+        idRequest.session = session
+        sid = comet.render_id(idRequest)
+
+        stream = makeRequest(sid)
+        streamWorker.run(comet.render_stream, stream)
+        yield self.waitFor(lambda: sid in self.broker.sessions)
+
+        listWorker.run(self.renderer.render_list_json, ListRequest(self.store, session, sid))
+        self.assertEqual(listWorker.sessions, {})
+        yield self.waitFor(lambda: 'crud:Avatar' in self.broker.channels)
+
+        avatar = Avatar()
+        avatar.email = u'a@example.com'
+        self.store.add(avatar)
+        self.store.commit()
+        listWorker.run(self.clock.advance, 0)
+
+        yield self.waitFor(lambda: '"created": [%d]' % avatar.id
+                           in stream.transport.written.getvalue())
+
+    def test_other_session(self):
+        listWorker = self.workers[0]
+        idRequest = DummyRequest([])
+        idRequest.session = FakeSession('web')
+        sid = comet.render_id(idRequest)
+
+        listWorker.run(self.renderer.render_list_json,
+                       ListRequest(self.store, FakeSession('other'), sid))
+        self.assertEqual(self.broker.subscriptions, {})
+        self.assertEqual(listWorker.sessions, {})
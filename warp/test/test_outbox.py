@@ -0,0 +1,140 @@
+import os
+from collections import defaultdict
+
+import yaml
+
+from storm.locals import Int, Unicode
+
+from twisted.trial import unittest
+
+from warp import runtime
+from warp.common import store, events, outbox
+from warp.common.schema import stormSchema
+from warp.common.events import EventModel, OUTBOX
+from warp.common.outbox import OutboxEvent, OutboxRelay
+
+
+class Widget(EventModel):
+    __storm_table__ = "test_widget"
+
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.store = runtime.avatar_store
+        self.store.execute("CREATE TABLE test_widget (id INTEGER PRIMARY KEY, name VARCHAR)")
+        self.store.commit()
+
+        self.patch(events, 'handlers', defaultdict(list))
+        self.patch(events, '_handlerTable', {})
+        self.patch(events, 'eventModels', {})
+        self.calls = []
+
+        @events.handler('shipped', Widget, mode=OUTBOX)
+        def shipped(widget, **kwargs):
+            self.calls.append((widget, kwargs))
+
+        self.relay = OutboxRelay(batchSize=10, interval=1, maxAttempts=3)
+
+    def addWidget(self):
+        widget = Widget()
+        widget.name = u'gear'
+        self.store.add(widget)
+        return widget
+
+    def outbox(self):
+        return list(self.store.find(OutboxEvent).order_by(OutboxEvent.id))
+
+    def test_written_with_commit(self):
+        widget = self.addWidget()
+        widget.emit('shipped', carrier=u'post')
+        widget.emit('ignored')
+        self.assertEqual(self.outbox(), [])
+
+        self.store.commit()
+        [row] = self.outbox()
+        self.assertEqual((row.model, row.object_key, row.event, row.kwargs),
+                         (u'Widget', [widget.id], u'shipped', {u'carrier': u'post'}))
+        # Not run until the relay picks it up
+        self.assertEqual(self.calls, [])
+
+    def test_rollback(self):
+        self.addWidget().emit('shipped')
+        self.store.flush()
+        self.store.rollback()
+        self.store.commit()
+        self.assertEqual(self.outbox(), [])
+
+    def test_relay(self):
+        widget = self.addWidget()
+        widget.emit('shipped', carrier=u'post')
+        self.store.commit()
+
+        self.assertEqual(self.relay.relayBatch(), 1)
+        self.assertEqual(self.calls, [(widget, {'carrier': u'post'})])
+        self.assertEqual(self.outbox(), [])
+        self.assertEqual(self.relay.relayBatch(), 0)
+
+    def test_removed_object(self):
+        widget = self.addWidget()
+        widget.emit('shipped')
+        self.store.commit()
+        self.store.remove(widget)
+        self.store.commit()
+
+        self.relay.relayBatch()
+        self.assertEqual(self.calls, [(None, {})])
+
+    def test_retry(self):
+        @events.handler('broken', Widget, mode=OUTBOX)
+        def broken(widget):
+            widget.name = u'changed'
+            raise RuntimeError("broken")
+
+        widget = self.addWidget()
+        widget.emit('broken')
+        self.store.commit()
+
+        self.assertEqual(self.relay.relayBatch(), 1)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        [row] = self.outbox()
+        self.assertEqual(row.attempts, 1)
+        self.assertIn(u'broken', row.last_error)
+        self.assertEqual(widget.name, u'gear')
+
+        # Backed off, so not due yet
+        self.assertEqual(self.relay.relayBatch(), 0)
+
+    def test_claimed_once(self):
+        self.addWidget().emit('shipped')
+        self.store.commit()
+
+        now = outbox.time.time()
+        self.assertEqual(len(self.relay.claim(int(now))), 1)
+        other = OutboxRelay(batchSize=10)
+        self.assertEqual(other.claim(int(now)), [])
+
+
+class SchemaTest(unittest.TestCase):
+
+    def migratedVersions(self, db):
+        path = os.path.join(os.path.dirname(outbox.__file__), '..', 'migrations', db)
+        versions = set()
+        for name in os.listdir(path):
+            with open(os.path.join(path, name)) as f:
+                versions.update((m['table'], m['to']) for m in yaml.safe_load_all(f) if m)
+        return versions
+
+    def test_outbox_versioned(self):
+        self.assertIn(('warp_outbox', u'warp_1'), stormSchema.getExpectedTableVersions())
+
+    def test_migrations(self):
+        # schemup only migrates to the versions of registered tables
+        for db in ('postgres', 'mysql'):
+            versions = self.migratedVersions(db)
+            for expected in stormSchema.getExpectedTableVersions():
+                self.assertIn(expected, versions, db)
@@ -1,3 +1,5 @@
+import types
+
 from twisted.trial import unittest
 
 from twisted.internet import defer, reactor
@@ -10,6 +12,7 @@ from twisted.web.server import NOT_DONE_YET
 
 from warp.common.avatar import SessionManagerBase
 from warp.webserver.site import WarpSite
+from warp.webserver import resource as warp_resource
 
 from twisted.protocols import loopback
 
@@ -123,6 +126,29 @@ class RequestTest(unittest.TestCase):
     def test_basic(self):
         self.assertEqual(self.request.channel, self.channel)
 
+class FacetCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.node = types.ModuleType('facetcache_node')
+        self.node.__file__ = self.mktemp()
+        self.node.render_index = lambda request: "index"
+        self.addCleanup(warp_resource.facetCache.clear)
+
+    def test_resolved_once(self):
+        res = warp_resource.NodeResource(self.node)
+        self.assertIdentical(res.getRenderFunc('index'), self.node.render_index)
+
+        # Served from the cache even after the node changes
+        self.node.render_index = lambda request: "changed"
+        self.assertNotIdentical(res.getRenderFunc('index'), self.node.render_index)
+
+        warp_resource.reloadFacets()
+        self.assertIdentical(res.getRenderFunc('index'), self.node.render_index)
+
+    def test_misses_not_cached(self):
+        res = warp_resource.NodeResource(self.node)
+        self.assertIdentical(res.getRenderFunc('nothere'), None)
+        self.assertEqual(warp_resource.facetCache, {})
+
 # /Users/jake/.virtualenvs/click/lib/python2.7/site-packages/twisted/web/test/test_http.py
 # class LoopbackHTTPClient(http.HTTPClient):
 #     def connectionMade(self):
@@ -0,0 +1,75 @@
+import os
+import sys
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+
+from warp.common.routes import RouteTable
+
+
+class RouteTableTest(unittest.TestCase):
+
+    packageName = 'routetest_nodes'
+
+    def setUp(self):
+        base = FilePath(self.mktemp())
+        self.nodesDir = base.child(self.packageName)
+        self.nodesDir.makedirs()
+        self.nodesDir.child('__init__.py').setContent('')
+
+        self.makeNode('home', 'def render_index(request):\n    return "home"\n')
+        self.makeNode('home/sub', 'def render_list(request):\n    return "sub"\n')
+        self.nodesDir.child('home').child('about.mak').setContent('About')
+        self.nodesDir.child('notanode').makedirs()
+
+        sys.path.insert(0, base.path)
+        self.addCleanup(sys.path.remove, base.path)
+        self.addCleanup(self.forgetModules)
+
+        self.table = RouteTable(self.nodesDir, self.packageName)
+
+    def makeNode(self, name, source):
+        directory = self.nodesDir.preauthChild(name)
+        directory.makedirs()
+        directory.child('__init__.py').setContent('')
+        directory.child(directory.basename() + '.py').setContent(source)
+
+    def forgetModules(self):
+        for name in list(sys.modules):
+            if name.startswith(self.packageName):
+                del sys.modules[name]
+
+    def test_lookup(self):
+        home = self.table.getNode('home')
+        self.assertEqual(home.__name__, '%s.home.home' % self.packageName)
+        self.assertEqual(home.render_index(None), "home")
+        self.assertEqual(self.table.getNode('home/sub').render_list(None), "sub")
+
+    def test_unknown(self):
+        self.assertIdentical(self.table.getNode('nothere'), None)
+        self.assertIdentical(self.table.getNode('notanode'), None)
+        self.assertIdentical(self.table.getNode('home/nothere'), None)
+        self.assertNotIn('%s.nothere' % self.packageName, sys.modules)
+
+    def test_facets(self):
+        route = self.table.routeFor(self.table.getNode('home'))
+        self.assertEqual(route.facets, frozenset(['index', 'about']))
+        self.assertEqual(route.templates['about'],
+                         self.nodesDir.child('home').child('about.mak').path)
+        self.assertEqual(sorted(route.children), ['sub'])
+
+    def test_refresh_new_node(self):
+        self.makeNode('added', 'def render_index(request):\n    return "new"\n')
+        self.nodesDir.changed()
+        # Make sure the directory mtime differs even on coarse filesystems
+        os.utime(self.nodesDir.path, (0, 0))
+
+        self.table.lastCheck = 0
+        changed = self.table.refresh()
+
+        self.assertEqual([r.name for r in changed], ['added'])
+        self.assertEqual(self.table.getNode('added').render_index(None), "new")
+
+    def test_refresh_unchanged(self):
+        self.table.lastCheck = 0
+        self.assertEqual(self.table.refresh(), [])
@@ -0,0 +1,95 @@
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+from twisted.test import proto_helpers
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyChannel
+
+from warp.webserver.staticfiles import StaticIndex, FOREVER
+
+
+class StaticIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.child('js').makedirs()
+        self.root.child('js').child('app.js').setContent('var x = 1;' * 100)
+        self.root.child('logo.png').setContent('\x89PNG0123456789')
+        self.index = StaticIndex(self.root.path)
+
+    def render(self, name, method='GET', headers=None):
+        resource = self.index.getResource(name)
+        channel = DummyChannel()
+        channel.transport = proto_helpers.StringTransport()
+        request = server.Request(channel, False)
+        request.gotLength(0)
+        request.method = method
+        request.clientproto = 'HTTP/1.1'
+        for k, v in (headers or {}).items():
+            request.requestHeaders.setRawHeaders(k, [v])
+        result = resource.render(request)
+        if result is not server.NOT_DONE_YET:
+            request.write(result)
+            request.finish()
+        # Drive the file producer, like a real transport would
+        while not request.finished:
+            channel.transport.producer.resumeProducing()
+        body = channel.transport.value().split('\r\n\r\n', 1)[1]
+        return request, body
+
+    def test_lookup(self):
+        self.assertIdentical(self.index.getResource('nothere.js'), None)
+        self.assertIdentical(self.index.getResource('../secret'), None)
+        self.assertNotIdentical(self.index.getResource('js/app.js'), None)
+
+    def test_serve(self):
+        request, body = self.render('logo.png')
+        self.assertEqual(request.code, 200)
+        self.assertEqual(body, '\x89PNG0123456789')
+        asset = self.index.assets['logo.png']
+        self.assertEqual(request.responseHeaders.getRawHeaders('etag'), [asset.etag])
+        self.assertEqual(request.responseHeaders.getRawHeaders('cache-control'), None)
+
+    def test_not_modified(self):
+        etag = self.index.assets['logo.png'].etag
+        request, body = self.render('logo.png', headers={'if-none-match': etag})
+        self.assertEqual(request.code, 304)
+        self.assertEqual(body, '')
+
+    def test_range(self):
+        request, body = self.render('logo.png', headers={'range': 'bytes=4-7'})
+        self.assertEqual(request.code, 206)
+        self.assertEqual(body, '0123')
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-range'),
+                         ['bytes 4-7/14'])
+
+    def test_range_not_satisfiable(self):
+        request, body = self.render('logo.png', headers={'range': 'bytes=20-'})
+        self.assertEqual(request.code, 416)
+
+    def test_gzip(self):
+        request, body = self.render('js/app.js', headers={'accept-encoding': 'gzip, deflate'})
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-encoding'), ['gzip'])
+        self.assertEqual(body[:2], '\x1f\x8b')
+        etag = request.responseHeaders.getRawHeaders('etag')[0]
+        self.assertEqual(etag, self.index.assets['js/app.js'].gzipETag)
+
+        # The tag of one encoding doesn't validate the other
+        request, body = self.render('js/app.js', headers={'if-none-match': etag})
+        self.assertEqual(request.code, 200)
+        request, body = self.render('js/app.js', headers={'if-none-match': etag,
+                                                          'accept-encoding': 'gzip'})
+        self.assertEqual(request.code, 304)
+
+    def test_gzip_refused(self):
+        for accept in ['gzip;q=0', 'deflate', '*;q=0.5, gzip; q=0', 'identity']:
+            request, body = self.render('js/app.js', headers={'accept-encoding': accept})
+            self.assertIdentical(request.responseHeaders.getRawHeaders('content-encoding'), None)
+        request, body = self.render('js/app.js', headers={'accept-encoding': '*'})
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-encoding'), ['gzip'])
+
+    def test_fingerprinted(self):
+        name = self.index.url('js/app.js')
+        self.assertNotEqual(name, 'js/app.js')
+        request, body = self.render(name)
+        self.assertEqual(body, 'var x = 1;' * 100)
+        self.assertEqual(request.responseHeaders.getRawHeaders('cache-control'), [FOREVER])
@@ -0,0 +1,61 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from warp import runtime
+from warp.common import store, sweeper
+from warp.common.avatar import DBSession, CachedSessionManager, nowstamp
+
+
+class SessionSweeperTest(unittest.TestCase):
+
+    def setUp(self):
+        store.setup_store('sqlite:')
+        now = nowstamp()
+        for i in range(7):
+            self.addSession('old%d' % i, now - 1000)
+        self.addSession('persistent', now - 1000, isPersistent=True)
+        self.addSession('fresh', now)
+        runtime.avatar_store.commit()
+
+        self.sweeper = sweeper.SessionSweeper(maxAge=100, batchSize=3, interval=60)
+        self.clock = task.Clock()
+        self.patch(sweeper, 'reactor', self.clock)
+
+    def addSession(self, uid, touched, isPersistent=False):
+        session = DBSession()
+        session.uid = uid
+        session.touched = touched
+        session.isPersistent = isPersistent
+        runtime.avatar_store.add(session)
+
+    def remaining(self):
+        return sorted(runtime.avatar_store.find(DBSession.uid))
+
+    def test_sweepAll(self):
+        self.assertEqual(self.sweeper.sweepAll(), 7)
+        self.assertEqual(self.remaining(), ['fresh', 'persistent'])
+
+    def test_batches(self):
+        self.sweeper.startService()
+        self.addCleanup(self.sweeper.stopService)
+
+        self.clock.advance(60)
+        self.assertEqual(len(self.remaining()), 6)
+
+        # Further batches follow quickly until the backlog is gone
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual(self.remaining(), ['fresh', 'persistent'])
+        self.assertEqual(self.sweeper.call.getTime(), 62 + 60)
+
+    def test_cached(self):
+        manager = CachedSessionManager(size=10, flushInterval=60)
+        self.addCleanup(manager.flush)
+        old = manager.getSession('old0')
+        fresh = manager.getSession('fresh')
+
+        self.sweeper.sessionManager = manager
+        self.sweeper.sweepAll()
+        self.assertNotIn(old.uid, manager.cache)
+        self.assertIn(fresh.uid, manager.cache)
+        self.assertIdentical(manager.getSession('old0'), None)
@@ -0,0 +1,79 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from warp.webserver.timerwheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(tick=1.0, size=8, clock=self.clock)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.callLater(delay, self.fired.append, name)
+
+    def test_fire(self):
+        self.schedule(2.5, 'a')
+        self.schedule(1, 'b')
+        self.clock.pump([1, 1])
+        self.assertEqual(self.fired, ['b'])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_never_early(self):
+        self.schedule(5, 'running')
+        self.clock.advance(0.9)
+        timer = self.schedule(1, 'a')
+        self.clock.advance(1.0)
+        self.assertEqual(self.fired, [])
+        self.assertTrue(timer.active())
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertFalse(timer.active())
+
+    def test_reset_and_cancel(self):
+        timer = self.schedule(2, 'a')
+        other = self.schedule(2, 'b')
+        self.clock.advance(1)
+        timer.reset(3)
+        other.cancel()
+        other.cancel()
+        self.clock.pump([1, 1])
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_rounds(self):
+        # Further ahead than the wheel's eight slots
+        self.schedule(20, 'a')
+        self.clock.pump([1] * 19)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_reschedule_from_callback(self):
+        def again():
+            self.fired.append(self.clock.seconds())
+            if len(self.fired) < 3:
+                self.wheel.callLater(2, again)
+        self.wheel.callLater(2, again)
+        self.clock.pump([1] * 10)
+        self.assertEqual(self.fired, [2, 4, 6])
+
+    def test_idle(self):
+        self.schedule(1, 'a')
+        self.clock.advance(1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # Timers scheduled on an idle wheel are counted from when they are
+        # scheduled, not from the wheel's last tick
+        self.clock.advance(100.5)
+        self.schedule(1, 'b')
+        self.clock.advance(0.9)
+        self.assertEqual(self.fired, ['a'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['a', 'b'])
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+from twisted.trial import unittest
+from twisted.python.filepath import FilePath
+
+from warp import runtime
+from warp.common import translate
+
+
+class TranslateTest(unittest.TestCase):
+
+    def setUp(self):
+        base = FilePath(self.mktemp())
+        self.warpDir = base.child('warp')
+        self.siteDir = base.child('site')
+        self.warpDir.child('messages').makedirs()
+        self.siteDir.child('messages').makedirs()
+
+        self.writeMessages(self.warpDir, 'en_US', {
+            '_warp': {'login': {'Failed': 'Login failed'}},
+        })
+        self.writeMessages(self.siteDir, 'en_US', {
+            'Hello': 'Hello',
+            'Greet': 'Hello %s',
+            'crud': {'Save': 'Save', 'Count': '%(n)d rows'},
+        })
+        self.writeMessages(self.siteDir, 'es_MX', {
+            'Hello': u'Hola',
+            'Greet': u'Hola %s %s',
+            'crud': {'Save': u'Guardar'},
+        })
+
+        self.patch(translate, 'config', {'warpDir': self.warpDir,
+                                         'siteDir': self.siteDir})
+        self.addCleanup(self.reset)
+        self.reset()
+        translate.loadMessages()
+
+    def reset(self):
+        runtime.messages.clear()
+        translate.catalogs.clear()
+        translate._translators.clear()
+        translate._files.clear()
+        translate._lastCheck = 0
+
+    def writeMessages(self, directory, language, content, mtime=None):
+        path = directory.child('messages').child(language + '.json')
+        path.setContent(json.dumps(content))
+        if mtime is not None:
+            os.utime(path.path, (mtime, mtime))
+
+    def test_translate(self):
+        t = translate.getTranslator('es_MX')
+        self.assertEqual(t('Hello'), u'Hola')
+        self.assertEqual(t('Save', _domain='crud'), u'Guardar')
+        # Falls back to en_US
+        self.assertEqual(t('Count', n=3, _domain='crud'), u'3 rows')
+        self.assertEqual(t('Failed', _domain='_warp:login'), u'Login failed')
+        # Unknown terms are returned as they are
+        self.assertEqual(t('Whatever', _domain='crud'), u'Whatever')
+        self.assertEqual(t('Save', _domain='nothere'), u'MISSING DOMAIN: nothere')
+
+    def test_interpolation_fallback(self):
+        t = translate.getTranslator('es_MX')
+        self.assertEqual(t('Greet', 'Ana'), u'Hello Ana')
+        self.assertTrue(t('Count', 3, _domain='crud').startswith(u"COULDN'T INTERPOLATE"))
+
+    def test_unknown_language(self):
+        self.assertEqual(translate.getTranslator('fr_FR')('Hello'), u'Hello')
+
+    def test_cached(self):
+        self.assertIdentical(translate.getTranslator('es_MX'),
+                             translate.getTranslator('es_MX'))
+
+    def test_reload_changed(self):
+        self.writeMessages(self.siteDir, 'es_MX', {'Hello': u'Buenas'}, mtime=1000)
+        translate._lastCheck = 0
+        translate.loadMessages()
+        self.assertEqual(translate.getTranslator('es_MX')('Hello'), u'Buenas')
+
+    def test_cache_file(self):
+        translate.config['messageCacheFile'] = 'messages.cache'
+        self.reset()
+        translate.loadMessages()
+        self.assertTrue(self.siteDir.child('messages.cache').exists())
+
+        self.reset()
+        self.patch(translate.json, 'load', None)
+        translate.loadMessages()
+        self.assertEqual(translate.getTranslator('es_MX')('Hello'), u'Hola')
+        self.assertEqual(runtime.messages['es_MX']['crud']['Save'], u'Guardar')
@@ -1,17 +1,26 @@
 """
 Test authentication.
 """
+import base64
+
 from twisted.trial import unittest
 # from twisted.internet.defer import inlineCallbacks
 # from twisted.internet import task
 from twisted.web import server, resource
+from twisted.web.test.test_web import DummyChannel
 
 # from twisted.web.test.requesthelper import DummyChannel, DummyRequest
 # from twisted_web_test_utils import DummySite
 
 # from webserver.auth import LoginBase
 import common.avatar
-from common.avatar import Session, SessionManagerBase, DEFAULT_LANG
+from common.avatar import (Session, SessionManagerBase, SessionManager,
+                           CachedSessionManager, CookieSessionManager,
+                           DBSession, DEFAULT_LANG, Fernet, Avatar, AvatarRole,
+                           loadAvatar, roleCache)
+from warp import runtime, metrics
+from warp.common import store, flash
+from warp.webserver.site import WarpSite
 
 class DummyAvatar:
     id = 123
@@ -102,6 +111,330 @@ class SessionManagerBaseTest(unittest.TestCase):
         self.assertEqual(session2.uid, uid)
 
 
+class CachedSessionManagerTest(unittest.TestCase):
+    """
+    Test L{common.avatar.CachedSessionManager}.
+    """
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.sessionManager = CachedSessionManager(size=2, flushInterval=60)
+        self.addCleanup(self.sessionManager.flush)
+
+    def queries(self, fn, *args):
+        """
+        Count database lookups done by calling fn.
+        """
+        misses = metrics.sessionCacheMisses._value.get()
+        result = fn(*args)
+        return result, metrics.sessionCacheMisses._value.get() - misses
+
+    def createSession(self):
+        session = self.sessionManager.createSession()
+        session.materialize()
+        return session
+
+    def test_cached(self):
+        session = self.createSession()
+        session2, misses = self.queries(self.sessionManager.getSession, session.uid)
+        self.assertIdentical(session2, session)
+        self.assertEqual(misses, 0)
+
+    def test_evicted(self):
+        session = self.createSession()
+        session.setAvatarID(5)
+        self.createSession()
+        self.createSession()
+
+        session2, misses = self.queries(self.sessionManager.getSession, session.uid)
+        self.assertNotIdentical(session2, session)
+        self.assertEqual(misses, 1)
+        self.assertEqual(session2.avatar_id, 5)
+
+    def test_unknown(self):
+        self.assertIdentical(self.sessionManager.getSession('nothere'), None)
+
+    def test_batched_touch(self):
+        sessions = [self.createSession() for i in range(2)]
+        for session in sessions:
+            session.touched -= 100
+            session.touch()
+
+        self.assertTrue(self.sessionManager.flushCall.active())
+        self.sessionManager.flush()
+        self.assertIdentical(self.sessionManager.flushCall, None)
+
+        for session in sessions:
+            row = runtime.avatar_store.get(DBSession, session.uid)
+            self.assertEqual(row.touched, session.touched)
+
+    def test_lazy(self):
+        session = self.sessionManager.createSession()
+        session.touched -= 100
+        session.touch()
+        self.assertIdentical(self.sessionManager.flushCall, None)
+        self.assertNotIn(session.uid, self.sessionManager.cache)
+
+        session.addFlashMessage("Hello")
+        self.assertIn(session.uid, self.sessionManager.cache)
+        self.assertNotIdentical(runtime.avatar_store.get(DBSession, session.uid), None)
+        session.getFlashMessages()
+
+    def test_flash_in_row(self):
+        self.patch(flash, 'store', flash.SessionFlashStore())
+        session = self.createSession()
+        session.addFlashMessage("Hello", _domain='test')
+        self.sessionManager.cache.clear()
+
+        session2 = self.sessionManager.getSession(session.uid)
+        self.assertEqual(session2.getFlashMessages(), [("Hello", (), {'_domain': 'test'})])
+        self.sessionManager.cache.clear()
+        self.assertEqual(self.sessionManager.getSession(session.uid).getFlashMessages(), [])
+
+    def test_save_deleted(self):
+        session = self.createSession()
+        runtime.avatar_store.find(DBSession, DBSession.uid == session.uid).remove()
+        runtime.avatar_store.commit()
+
+        session.setAvatarID(5)
+        row = runtime.avatar_store.get(DBSession, session.uid)
+        self.assertEqual(row.avatar_id, 5)
+
+    def test_state_in_row(self):
+        session = self.sessionManager.createSession()
+        session.language = u'es_MX'
+        self.assertTrue(session.isMaterialized)
+        session.afterLogin = '/home'
+        self.sessionManager.cache.clear()
+
+        session2 = self.sessionManager.getSession(session.uid)
+        self.assertEqual(session2.language, u'es_MX')
+        self.assertEqual(session2.afterLogin, '/home')
+
+
+class CookieSessionManagerTest(unittest.TestCase):
+    """
+    Test L{common.avatar.CookieSessionManager}.
+    """
+    def setUp(self):
+        self.sessionManager = CookieSessionManager(secret='sekrit')
+        self.patch(flash, 'store', flash.SessionFlashStore())
+        self.site = WarpSite(resource.Resource())
+        self.site.sessionManager = self.sessionManager
+
+    def makeRequest(self, cookie=None):
+        request = self.site.requestFactory(DummyChannel(), False)
+        request.site = self.site
+        request.sitepath = []
+        if cookie is not None:
+            request.received_cookies['TWISTED_SESSION'] = cookie
+        return request
+
+    def responseCookie(self, request):
+        request.write('')
+        [cookie] = request.cookies
+        return cookie.split(';')[0].split('=', 1)[1]
+
+    def test_roundtrip(self):
+        session = self.sessionManager.createSession()
+        session.setAvatarID(5)
+        session.language = u'es_MX'
+        session.afterLogin = '/home'
+        session.addFlashMessage("Hello", 1, _domain='test')
+
+        session2 = self.sessionManager.getSession(session.cookieValue())
+        self.assertEqual(session2.uid, session.uid)
+        self.assertEqual(session2.avatar_id, 5)
+        self.assertEqual(session2.language, u'es_MX')
+        self.assertEqual(session2.afterLogin, '/home')
+        self.assertEqual(session2.touched, session.touched)
+        self.assertEqual(session2.getFlashMessages(),
+                         [("Hello", (1,), {'_domain': 'test'})])
+
+    def test_tampered(self):
+        session = self.sessionManager.createSession()
+        session.setAvatarID(5)
+        value = session.cookieValue()
+        body, signature = value.split('.')
+        forged = base64.urlsafe_b64encode(
+            base64.urlsafe_b64decode(body).replace('5', '1'))
+
+        self.assertIdentical(self.sessionManager.getSession('%s.%s' % (forged, signature)), None)
+        self.assertIdentical(CookieSessionManager(secret='other').getSession(value), None)
+        self.assertIdentical(self.sessionManager.getSession('garbage'), None)
+
+    def test_encrypted(self):
+        if Fernet is None:
+            raise unittest.SkipTest("cryptography is not installed")
+        manager = CookieSessionManager(secret='sekrit',
+                                       encryptionKey=Fernet.generate_key())
+        session = manager.createSession()
+        session.setAvatarID(5)
+        value = session.cookieValue()
+
+        self.assertNotIn('avatar_id', value)
+        self.assertEqual(manager.getSession(value).avatar_id, 5)
+
+    def test_request(self):
+        request = self.makeRequest()
+        request.getSession()
+        request.write('')
+        self.assertEqual(request.cookies, [])
+
+        request = self.makeRequest()
+        request.getSession().addFlashMessage("Hello")
+        cookie = self.responseCookie(request)
+
+        # Reading the flash message changes the session, so the cookie is sent again
+        request = self.makeRequest(cookie)
+        self.assertEqual(len(request.getSession().getFlashMessages()), 1)
+        cookie = self.responseCookie(request)
+
+        request = self.makeRequest(cookie)
+        self.assertEqual(request.getSession().getFlashMessages(), [])
+        request.write('')
+        self.assertEqual(request.cookies, [])
+
+
+class RoleCacheTest(unittest.TestCase):
+    """
+    Test L{common.avatar.roleCache}.
+    """
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.patch(runtime, 'config', {
+            'roles': {'admin': 'ADMIN', 'editor': 'EDITOR', 'anon': 'ANON'},
+            'defaultRoles': ('anon',),
+        })
+        roleCache.invalidate()
+        self.addCleanup(roleCache.invalidate)
+
+        avatar = Avatar()
+        avatar.email = u'test@example.com'
+        runtime.avatar_store.add(avatar)
+        runtime.avatar_store.flush()
+        self.avatar_id = avatar.id
+        self.addRole('editor', 1)
+        runtime.avatar_store.commit()
+
+    def addRole(self, name, position):
+        role = AvatarRole()
+        role.avatar_id = self.avatar_id
+        role.role_name = name
+        role.position = position
+        runtime.avatar_store.add(role)
+        return role
+
+    def test_loadAvatar(self):
+        avatar = loadAvatar(self.avatar_id)
+        self.assertEqual(avatar.email, u'test@example.com')
+        self.assertEqual(roleCache.get(self.avatar_id), ('EDITOR', 'ANON'))
+        self.assertEqual(avatar.roles, ('EDITOR', 'ANON'))
+        self.assertIdentical(loadAvatar(12345), None)
+
+    def test_no_roles(self):
+        runtime.avatar_store.find(AvatarRole).remove()
+        loadAvatar(self.avatar_id)
+        self.assertEqual(roleCache.get(self.avatar_id), ('ANON',))
+
+    def test_invalidate_on_commit(self):
+        avatar = loadAvatar(self.avatar_id)
+        self.addRole('admin', 0)
+        # Not committed yet
+        runtime.avatar_store.flush()
+        self.assertEqual(avatar.roles, ('EDITOR', 'ANON'))
+
+        runtime.avatar_store.commit()
+        self.assertIdentical(roleCache.get(self.avatar_id), None)
+        self.assertEqual(avatar.roles, ('ADMIN', 'EDITOR', 'ANON'))
+
+    def test_rollback(self):
+        avatar = loadAvatar(self.avatar_id)
+        self.addRole('admin', 0)
+        runtime.avatar_store.rollback()
+        runtime.avatar_store.commit()
+        self.assertEqual(avatar.roles, ('EDITOR', 'ANON'))
+
+    def test_ttl(self):
+        runtime.config['roleCacheTTL'] = -1
+        loadAvatar(self.avatar_id)
+        self.assertIdentical(roleCache.get(self.avatar_id), None)
+
+
+class LazySessionTest(unittest.TestCase):
+    """
+    Test that L{common.avatar.SessionManager} only stores sessions which
+    hold something.
+    """
+    def setUp(self):
+        store.setup_store('sqlite:')
+        self.site = WarpSite(resource.Resource())
+        self.site.sessionManager = SessionManager()
+
+    def rowCount(self):
+        return runtime.avatar_store.find(DBSession).count()
+
+    def makeRequest(self):
+        request = self.site.requestFactory(DummyChannel(), False)
+        request.site = self.site
+        request.sitepath = []
+        return request
+
+    def test_anonymous(self):
+        request = self.makeRequest()
+        session = request.getSession()
+        self.assertFalse(session.isMaterialized)
+        self.assertEqual(request.cookies, [])
+        self.assertEqual(self.rowCount(), 0)
+
+        session.setAvatarID(None)
+        session.setPersistent(False)
+        session.language = DEFAULT_LANG
+        session.afterLogin = None
+        self.assertEqual(self.rowCount(), 0)
+
+    def test_materialize(self):
+        for change in [lambda s: s.addFlashMessage("Hello"),
+                       lambda s: s.setAvatarID(5),
+                       lambda s: s.setPersistent(True),
+                       lambda s: setattr(s, 'language', u'es_MX'),
+                       lambda s: setattr(s, 'afterLogin', '/home')]:
+            request = self.makeRequest()
+            session = request.getSession()
+            change(session)
+            session.getFlashMessages()
+
+            self.assertTrue(session.isMaterialized)
+            self.assertEqual(len(request.cookies), 1)
+            self.assertIn(session.uid, request.cookies[0])
+            self.assertIdentical(self.site.getSession(session.uid), session)
+
+    def test_state_in_row(self):
+        request = self.makeRequest()
+        session = request.getSession()
+        session.language = u'es_MX'
+        session.afterLogin = '/home'
+
+        runtime.avatar_store.invalidate()
+        row = runtime.avatar_store.get(DBSession, session.uid)
+        self.assertEqual(row.language, u'es_MX')
+        self.assertEqual(row.afterLogin, '/home')
+
+    def test_avatar_reference(self):
+        self.patch(runtime, 'config', {'roles': {}, 'defaultRoles': ()})
+        roleCache.invalidate()
+        self.addCleanup(roleCache.invalidate)
+        avatar = Avatar()
+        avatar.email = u'test@example.com'
+        runtime.avatar_store.add(avatar)
+        runtime.avatar_store.flush()
+
+        session = self.makeRequest().getSession()
+        session.setAvatarID(avatar.id)
+        self.assertEqual(
+            runtime.avatar_store.find(DBSession, DBSession.avatar == avatar).one(), session)
+        self.assertEqual(session.getAvatar().email, u'test@example.com')
+
+
 # class TestLoginBase(unittest.TestCase):
 #     def setUp(self):
 #         # self.web = request.WarpRequest(DummyChannel(), 1)
@@ -0,0 +1,94 @@
+"""
+Compile every template into the on-disk module cache ahead of time, so
+freshly started workers don't pay Mako's compile cost on first render.
+"""
+from __future__ import print_function
+import multiprocessing
+import os
+import time
+
+from mako import exceptions
+
+from warp import helpers
+from warp.runtime import config, templateLookup
+
+
+def findTemplates():
+    """
+    Find all templates a site can render.
+
+    @return: List of C{(kind, name)}, where kind is C{'lookup'} for
+        templates rendered by URI through the template lookup, and
+        C{'node'} for node-local templates rendered by path.
+    """
+    jobs = []
+    seen = set()
+
+    site_dir = config['siteDir']
+    for base in (site_dir.child('templates'), config['warpDir'].child('templates')):
+        for path in _walk(base.path):
+            uri = '/' + os.path.relpath(path, base.path).replace(os.sep, '/')
+            # Site templates shadow Warp's ones with the same URI
+            if uri not in seen:
+                seen.add(uri)
+                jobs.append(('lookup', uri))
+
+    jobs.extend(('node', path) for path in _walk(site_dir.child('nodes').path))
+    return jobs
+
+
+def compileTemplate(job):
+    """
+    Compile one template found by L{findTemplates}.
+
+    @return: C{(name, error)}, where error is C{None} on success
+    """
+    kind, name = job
+    try:
+        if kind == 'lookup':
+            templateLookup.get_template(name)
+        else:
+            helpers.getTemplate(name)
+    except Exception:
+        return (name, exceptions.text_error_template().render())
+    return (name, None)
+
+
+def precompile(processes=None):
+    """
+    Compile all templates using a pool of worker processes.
+
+    @return: Number of templates that failed to compile
+    """
+    module_dir = helpers.getTemplateModuleDir()
+    if module_dir is None:
+        print("Set 'templateCacheDir' in config to precompile templates")
+        return 0
+
+    jobs = findTemplates()
+    print("Compiling %d templates into %s..." % (len(jobs), module_dir))
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(compileTemplate, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = [(name, error) for (name, error) in results if error is not None]
+    for (name, error) in failures:
+        print("")
+        print("Failed to compile %s:" % name)
+        print(error)
+
+    print("Done: %d compiled, %d failed in %.1fs" % (
+        len(jobs) - len(failures), len(failures), time.time() - start))
+    return len(failures)
+
+
+def _walk(top):
+    for (dirpath, dirnames, filenames) in os.walk(top):
+        for filename in sorted(filenames):
+            if filename.endswith('.mak'):
+                yield os.path.join(dirpath, filename)
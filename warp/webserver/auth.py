@@ -70,7 +70,7 @@ class LoginHandler(LoginBase):
             return False
 
         request.session.setAvatarID(avatar.id)
-        request.avatar = request.session.avatar
+        request.avatar = request.session.getAvatar()
 
         return True
 
@@ -0,0 +1,329 @@
+"""
+Comet delivery across processes.
+
+Comet sessions live in the process serving their browser. To reach
+sessions in other worker processes, every worker connects to a broker
+over a Unix domain socket (C{twistd warp cometBroker}) and tells it which
+channels its sessions subscribe to and which session ids it holds. The
+broker passes published messages on to the workers with subscribers, and
+pushes for a session to the workers holding it.
+
+A session can be subscribed to a channel from any worker, such as the one
+serving a list page while the browser's stream is held by another. The
+subscription goes through the broker to the workers holding the session,
+and is remembered there, so workers which take the session over later,
+or which only get it after the subscription, are told too.
+
+Select it with C{'cometBackplane': 'broker'} in config; C{cometBrokerSocket}
+is the socket path, relative to the site directory. The default is the
+L{LocalBackplane}, which only reaches sessions in the same process.
+
+Frames are netstrings holding a JSON list, C{[op, *args]}; message
+payloads are passed on as the JSON text they were encoded to once.
+"""
+import os
+from collections import OrderedDict
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.application.service import Service
+from twisted.internet import reactor, protocol
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+
+from warp import runtime
+
+
+class LocalBackplane(object):
+    """
+    Backplane for a single process: there is nothing to tell anyone.
+    """
+    def channelAdded(self, channel):
+        pass
+
+    def channelRemoved(self, channel):
+        pass
+
+    def sessionAdded(self, sid):
+        pass
+
+    def sessionRemoved(self, sid):
+        pass
+
+    def subscribe(self, sid, channel):
+        """
+        Subscribe C{sid} to C{channel} in the processes holding it.
+
+        @return: Whether that is taken care of; if not, the session is
+            created in this process
+        """
+        return False
+
+    def publish(self, channel, data, coalesce=None):
+        pass
+
+    def push(self, sid, data, coalesce=None):
+        pass
+
+
+class _FrameProtocol(NetstringReceiver):
+    # Comet messages can be large, but not this large
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def sendFrame(self, *frame):
+        self.sendString(json.dumps(frame))
+
+    def stringReceived(self, string):
+        # An exception here would drop the connection, and with it every
+        # subscription, so a frame that can't be handled is only logged
+        try:
+            frame = json.loads(string)
+            handler = getattr(self, 'frame_' + frame[0])
+            handler(*[_encode(arg) for arg in frame[1:]])
+        except (ValueError, IndexError, AttributeError, TypeError):
+            log.msg("Bad comet backplane frame: %r" % string[:100])
+        except Exception:
+            log.err(None, "Failed to handle comet backplane frame")
+
+
+def _encode(arg):
+    # Channels, session ids and payloads are byte strings everywhere else,
+    # and go straight into responses
+    if isinstance(arg, unicode):
+        return arg.encode("utf-8")
+    return arg
+
+
+# Broker ----------------------------------------------------------------
+
+class BrokerProtocol(_FrameProtocol):
+    """
+    The broker's end of a connection from one worker.
+    """
+    def connectionMade(self):
+        self.channels = set()
+        self.sessions = set()
+
+    def connectionLost(self, reason):
+        for channel in self.channels:
+            self.factory.unsubscribe(self, channel)
+        for sid in self.sessions:
+            self.factory.sessionEnded(self, sid)
+
+    def frame_sub(self, channel):
+        self.channels.add(channel)
+        self.factory.channels.setdefault(channel, set()).add(self)
+
+    def frame_unsub(self, channel):
+        self.channels.discard(channel)
+        self.factory.unsubscribe(self, channel)
+
+    def frame_session(self, sid):
+        self.sessions.add(sid)
+        self.factory.sessions.setdefault(sid, set()).add(self)
+        for channel in self.factory.sessionChannels(sid):
+            self.sendFrame('subscribe', sid, channel)
+
+    def frame_endsession(self, sid):
+        self.sessions.discard(sid)
+        self.factory.sessionEnded(self, sid)
+
+    def frame_subscribe(self, sid, channel):
+        self.factory.addSessionChannel(sid, channel)
+        for worker in self.factory.sessions.get(sid, ()):
+            if worker is not self:
+                worker.sendFrame('subscribe', sid, channel)
+
+    def frame_pub(self, channel, data, coalesce=None):
+        for worker in self.factory.channels.get(channel, ()):
+            if worker is not self:
+                worker.sendFrame('pub', channel, data, coalesce)
+
+    def frame_push(self, sid, data, coalesce=None):
+        for worker in self.factory.sessions.get(sid, ()):
+            if worker is not self:
+                worker.sendFrame('push', sid, data, coalesce)
+
+
+class BrokerFactory(protocol.ServerFactory):
+    protocol = BrokerProtocol
+
+    # Most sessions whose subscriptions are kept while no worker holds them
+    maxWaiting = 10000
+
+    def __init__(self):
+        # Channel -> set of worker connections with subscribers
+        self.channels = {}
+        # Session id -> set of worker connections holding the session
+        self.sessions = {}
+        # Session id -> channels it was subscribed to through the broker
+        self.subscriptions = {}
+        # Session ids with subscriptions but no worker yet, oldest first
+        self.waiting = OrderedDict()
+
+    def sessionChannels(self, sid):
+        self.waiting.pop(sid, None)
+        return self.subscriptions.get(sid, ())
+
+    def addSessionChannel(self, sid, channel):
+        self.subscriptions.setdefault(sid, set()).add(channel)
+        if sid not in self.sessions:
+            self.waiting[sid] = True
+            while len(self.waiting) > self.maxWaiting:
+                self.subscriptions.pop(self.waiting.popitem(last=False)[0], None)
+
+    def sessionEnded(self, worker, sid):
+        workers = self.sessions.get(sid)
+        if workers is None:
+            return
+        workers.discard(worker)
+        if not workers:
+            # Expired everywhere
+            del self.sessions[sid]
+            self.subscriptions.pop(sid, None)
+
+    def unsubscribe(self, worker, channel):
+        workers = self.channels.get(channel)
+        if workers is not None:
+            workers.discard(worker)
+            if not workers:
+                del self.channels[channel]
+
+
+def listenBroker(path):
+    """
+    Start a broker listening on the Unix socket C{path}.
+
+    @return: The listening port
+    """
+    if os.path.exists(path):
+        # Left behind by a broker that didn't shut down cleanly
+        os.unlink(path)
+    return reactor.listenUNIX(path, BrokerFactory())
+
+
+# Worker ----------------------------------------------------------------
+
+class WorkerProtocol(_FrameProtocol):
+    """
+    A worker's connection to the broker.
+    """
+    def connectionMade(self):
+        self.factory.connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.disconnected(self)
+
+    def frame_pub(self, channel, data, coalesce=None):
+        self.factory.backplane.deliver(channel, data, coalesce)
+
+    def frame_push(self, sid, data, coalesce=None):
+        self.factory.backplane.deliverTo(sid, data, coalesce)
+
+    def frame_subscribe(self, sid, channel):
+        self.factory.backplane.subscribeTo(sid, channel)
+
+
+class WorkerFactory(protocol.ReconnectingClientFactory):
+    protocol = WorkerProtocol
+    maxDelay = 5
+
+    def __init__(self, backplane):
+        self.backplane = backplane
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
+    def connected(self, connection):
+        self.backplane.connected(connection)
+
+    def disconnected(self, connection):
+        self.backplane.disconnected(connection)
+
+
+class BrokerBackplane(Service):
+    """
+    Backplane connecting this worker to the broker.
+
+    While the broker is unreachable, messages only reach sessions in this
+    process. On reconnecting, subscriptions and sessions are sent again.
+
+    @param deliver: Called with C{(channel, data, coalesce)} for messages
+        published by other workers
+    @param deliverTo: Called with C{(sid, data, coalesce)} for messages
+        pushed to a session of this worker
+    @param subscribeTo: Called with C{(sid, channel)} when another worker
+        subscribes a session of this worker
+    """
+    def __init__(self, path, deliver, deliverTo, subscribeTo=None):
+        self.path = path
+        self.deliver = deliver
+        self.deliverTo = deliverTo
+        self.subscribeTo = subscribeTo or (lambda sid, channel: None)
+        self.channels = set()
+        self.sessions = set()
+        self.connection = None
+        self.factory = WorkerFactory(self)
+        self.connector = None
+
+    def startService(self):
+        Service.startService(self)
+        self.connector = reactor.connectUNIX(self.path, self.factory)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.factory.stopTrying()
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def connected(self, connection):
+        self.connection = connection
+        for channel in self.channels:
+            connection.sendFrame('sub', channel)
+        for sid in self.sessions:
+            connection.sendFrame('session', sid)
+
+    def disconnected(self, connection):
+        if self.connection is connection:
+            self.connection = None
+
+    def _send(self, *frame):
+        if self.connection is not None:
+            self.connection.sendFrame(*frame)
+
+    def channelAdded(self, channel):
+        self.channels.add(channel)
+        self._send('sub', channel)
+
+    def channelRemoved(self, channel):
+        self.channels.discard(channel)
+        self._send('unsub', channel)
+
+    def sessionAdded(self, sid):
+        self.sessions.add(sid)
+        self._send('session', sid)
+
+    def sessionRemoved(self, sid):
+        self.sessions.discard(sid)
+        self._send('endsession', sid)
+
+    def subscribe(self, sid, channel):
+        if self.connection is None:
+            return False
+        self.connection.sendFrame('subscribe', sid, channel)
+        return True
+
+    def publish(self, channel, data, coalesce=None):
+        self._send('pub', channel, data, coalesce)
+
+    def push(self, sid, data, coalesce=None):
+        self._send('push', sid, data, coalesce)
+
+
+def getBrokerSocket():
+    return os.path.join(runtime.config['siteDir'].path,
+                        runtime.config.get('cometBrokerSocket', 'comet.sock'))
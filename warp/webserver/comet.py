@@ -1,93 +1,389 @@
+"""
+Comet: messages pushed from the server to the browser.
+
+Each browser page has a L{CometSession}, identified by an id it gets from
+C{/_comet/id}. The id is bound to the web session which asked for it, see
+L{ownedBy}. It either keeps a Server-Sent Events stream open on
+C{/_comet/stream}, or long-polls C{/_comet/longpoll} where EventSource
+isn't available. Messages go to one session with L{CometSession.push}, or
+to every session subscribed to a channel with L{publish}.
+
+Messages are JSON-encoded once, when they are pushed or published, and
+buffered as encoded strings, so publishing to many sessions doesn't encode
+the message again for each of them.
+
+Sessions in other processes are reached through the L{backplane}, see
+L{warp.webserver.backplane}.
+
+Session, poll and heartbeat timeouts are kept on one L{TimerWheel} rather
+than as separate reactor calls. A session holds at most C{cometBufferSize}
+unfetched messages; past that, C{cometBufferPolicy} decides what happens:
+C{'drop-oldest'} (the default) discards the oldest message, C{'coalesce'}
+discards new messages and leaves a single C{{"key": "_overflow",
+"dropped": n}} message in the buffer, so the page knows to reload.
+"""
+import hashlib
+import hmac
 import uuid
+from collections import deque, OrderedDict
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
-from twisted.internet import reactor, error
 from twisted.web.server import NOT_DONE_YET
 
 import warp.log as log
+from warp import runtime, metrics
+from warp.webserver.backplane import LocalBackplane, BrokerBackplane, getBrokerSocket
+from warp.webserver.timerwheel import TimerWheel
 
 sessions = {}
 
+# Channel name -> set of subscribed sessions
+channels = {}
+
+# Replaced by installBackplane according to config
+backplane = LocalBackplane()
+
+# All comet timeouts
+wheel = TimerWheel()
+
 SESSION_TIMEOUT = 31
 POLL_TIMEOUT = 10
 
+# Seconds between comments sent on idle streams, to keep proxies from
+# closing them
+HEARTBEAT_INTERVAL = 15
+# Messages kept per session for streams resuming with Last-Event-ID
+REPLAY_SIZE = 100
+# Milliseconds the browser waits before reconnecting a stream
+STREAM_RETRY = 2000
+
+# Defaults for cometBufferSize and cometBufferPolicy
+BUFFER_SIZE = 1000
+BUFFER_POLICY = 'drop-oldest'
+BUFFER_POLICIES = ('drop-oldest', 'coalesce')
+
+# Buffer key of the message left by the 'coalesce' policy
+OVERFLOW = ('overflow',)
+
 
 class CometSession(object):
     def __init__(self, sid):
         self.id = sid
-        self.buffer = []
+        # Encoded messages waiting for the next poll, keyed by their
+        # coalescing key or a sequence number
+        self.buffer = OrderedDict()
+        self.sequence = 0
+        self.dropped = 0
+        self.bufferSize = runtime.config.get('cometBufferSize', BUFFER_SIZE)
+        self.bufferPolicy = runtime.config.get('cometBufferPolicy', BUFFER_POLICY)
+        if self.bufferPolicy not in BUFFER_POLICIES:
+            raise ValueError("Unknown comet buffer policy %r (choose from %s)"
+                             % (self.bufferPolicy, ", ".join(BUFFER_POLICIES)))
+        self.channels = set()
         self.listener = None
         self.pollTimeout = None
 
-        self.sessionTimeout = reactor.callLater(SESSION_TIMEOUT,
-                                                self.cbSessionTimeout)
+        # Open event stream, and recently streamed (id, message) pairs
+        self.stream = None
+        self.heartbeat = None
+        self.lastEventId = 0
+        self.replay = deque(maxlen=REPLAY_SIZE)
+
+        self.sessionTimeout = wheel.callLater(SESSION_TIMEOUT,
+                                              self.cbSessionTimeout)
+        metrics.cometSessions.inc()
 
     def addListener(self, request):
         self.sessionTimeout.reset(SESSION_TIMEOUT)
 
         if self.buffer:
             assert self.listener is None
-            msg = json.dumps(self.buffer)
-            self.buffer[:] = []
-            return msg
+            return "[%s]" % ",".join(self._takeBuffer())
 
         if self.listener is not None:
             self._flushWith([])
 
         self.listener = request
-        self.pollTimeout = reactor.callLater(POLL_TIMEOUT, self.cbPollTimeout)
+        self.pollTimeout = wheel.callLater(POLL_TIMEOUT, self.cbPollTimeout)
 
         request.notifyFinish().addBoth(self._listenerDied)
 
         return NOT_DONE_YET
 
-    def push(self, obj):
+    def push(self, obj, coalesce=None):
+        """
+        Send C{obj} to the browser.
+
+        @param coalesce: If given, a message pushed earlier with the same
+            key which the browser hasn't fetched yet is replaced by this one
+        """
+        self.pushEncoded(json.dumps(obj), coalesce)
+
+    def pushEncoded(self, data, coalesce=None):
+        """
+        Send a message which is already JSON-encoded.
+        """
+        if self.stream is not None:
+            self._sendEvent(data)
+            return
+
         if self.listener is not None:
-            self._flushWith([obj])
+            self._flushWith([data])
+            return
+
+        if coalesce is not None:
+            key = ('coalesce', coalesce)
+            if key in self.buffer:
+                self.buffer[key] = data
+                return
         else:
-            self.buffer.append(obj)
+            self.sequence += 1
+            key = self.sequence
+
+        if len(self.buffer) - (OVERFLOW in self.buffer) >= self.bufferSize:
+            metrics.cometMessagesDropped.labels(self.bufferPolicy).inc()
+            if self.bufferPolicy == 'coalesce':
+                self.dropped += 1
+                self.buffer[OVERFLOW] = json.dumps(
+                    {'key': '_overflow', 'dropped': self.dropped})
+                return
+            self.buffer.popitem(last=False)
+        self.buffer[key] = data
+
+    def buffered(self):
+        """
+        @return: Encoded messages waiting to be fetched, oldest first
+        """
+        return self.buffer.values()
+
+    def addStream(self, request):
+        """
+        Keep C{request} open as an event stream, sending messages as they
+        are pushed.
+        """
+        self.sessionTimeout.reset(SESSION_TIMEOUT)
+
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        # Keep nginx from buffering the stream
+        request.setHeader('x-accel-buffering', 'no')
+
+        if self.stream is not None:
+            self.stream.finish()
+        if self.listener is not None:
+            self._flushWith([])
+
+        self.stream = request
+        request.write("retry: %d\n\n" % STREAM_RETRY)
+
+        # Resend what the browser missed while it was reconnecting
+        try:
+            resumeFrom = int(request.getHeader('last-event-id') or 0)
+        except ValueError:
+            resumeFrom = 0
+        if resumeFrom:
+            for (eventId, data) in self.replay:
+                if eventId > resumeFrom:
+                    request.write(_formatEvent(eventId, data))
+
+        for data in self._takeBuffer():
+            self._sendEvent(data)
+
+        self.heartbeat = wheel.callLater(HEARTBEAT_INTERVAL, self.cbHeartbeat)
+        request.notifyFinish().addBoth(self._streamDied, request)
+
+        return NOT_DONE_YET
+
+    def cbHeartbeat(self):
+        self.sessionTimeout.reset(SESSION_TIMEOUT)
+        self.stream.write(": heartbeat\n\n")
+        self.heartbeat.reset(HEARTBEAT_INTERVAL)
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        subscribers = channels.get(channel)
+        if subscribers is None:
+            subscribers = channels[channel] = set()
+            backplane.channelAdded(channel)
+        subscribers.add(self)
+
+    def unsubscribe(self, channel):
+        self.channels.discard(channel)
+        subscribers = channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del channels[channel]
+                backplane.channelRemoved(channel)
 
     def cbSessionTimeout(self):
-        log.msg("Comet session expired:", self.id)
+        log.msg("Comet session expired: %s" % self.id)
+        for channel in list(self.channels):
+            self.unsubscribe(channel)
         del sessions[self.id]
+        backplane.sessionRemoved(self.id)
+        metrics.cometSessions.dec()
 
     def cbPollTimeout(self):
         self._flushWith([])
 
     def _listenerDied(self, _):
-        try:
-            self.pollTimeout.cancel()
-        except error.AlreadyCalled:
-            pass
-
+        self.pollTimeout.cancel()
         self.listener = None
 
-    def _flushWith(self, stuff):
-        msg = json.dumps(stuff)
-        self.listener.write(msg)
+    def _streamDied(self, _, request):
+        if self.stream is not request:
+            return
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        self.heartbeat = None
+        self.stream = None
+        self.sessionTimeout.reset(SESSION_TIMEOUT)
+
+    def _sendEvent(self, data):
+        self.lastEventId += 1
+        self.replay.append((self.lastEventId, data))
+        self.stream.write(_formatEvent(self.lastEventId, data))
+
+    def _takeBuffer(self):
+        buffered = self.buffered()
+        self.buffer.clear()
+        self.dropped = 0
+        return buffered
+
+    def _flushWith(self, messages):
+        self.listener.write("[%s]" % ",".join(messages))
         self.listener.finish()
 
 
+def _formatEvent(eventId, data):
+    # JSON never contains raw newlines, so the data fits on one line
+    return "id: %d\ndata: %s\n\n" % (eventId, data)
+
+
+def publish(channel, obj, coalesce=None):
+    """
+    Send C{obj} to all sessions subscribed to C{channel}, in this process
+    and, through the backplane, in others.
+
+    @return: Number of sessions in this process the message was sent to
+    """
+    data = json.dumps(obj)
+    backplane.publish(channel, data, coalesce)
+    return deliver(channel, data, coalesce)
+
+def deliver(channel, data, coalesce=None):
+    """
+    Send an encoded message to the sessions in this process subscribed to
+    C{channel}.
+    """
+    subscribers = channels.get(channel)
+    if not subscribers:
+        return 0
+
+    for session in list(subscribers):
+        session.pushEncoded(data, coalesce)
+    return len(subscribers)
+
+def pushTo(sid, obj, coalesce=None):
+    """
+    Send C{obj} to the session C{sid}, whichever process holds it.
+    """
+    session = sessions.get(sid)
+    if session is not None:
+        session.push(obj, coalesce)
+    else:
+        backplane.push(sid, json.dumps(obj), coalesce)
+
+def deliverTo(sid, data, coalesce=None):
+    session = sessions.get(sid)
+    if session is not None:
+        session.pushEncoded(data, coalesce)
+
+def installBackplane():
+    """
+    Set up the backplane selected by C{cometBackplane} in config.
+
+    @return: A service to start with the site, or C{None}
+    """
+    global backplane
+    name = runtime.config.get('cometBackplane', 'local')
+    if name == 'local':
+        backplane = LocalBackplane()
+        return None
+    if name == 'broker':
+        backplane = BrokerBackplane(getBrokerSocket(), deliver, deliverTo, subscribeTo)
+        return backplane
+    raise ValueError("Unknown comet backplane %r (choose from broker, local)" % name)
+
+
+def subscribe(sid, channel):
+    """
+    Subscribe the session C{sid} to C{channel}, wherever it is held. If the
+    backplane can't pass the subscription on and the browser hasn't
+    connected yet, the session is created here.
+    """
+    session = sessions.get(sid)
+    routed = backplane.subscribe(sid, channel)
+    if session is None and not routed:
+        session = _createSession(sid)
+    if session is not None:
+        session.subscribe(channel)
+
+def subscribeTo(sid, channel):
+    """
+    Subscribe the session C{sid} in this process, for another process.
+    """
+    session = sessions.get(sid)
+    if session is not None:
+        session.subscribe(channel)
+
+def _createSession(sid):
+    session = CometSession(sid)
+    sessions[sid] = session
+    backplane.sessionAdded(sid)
+    return session
+
+
 def get_session(request, createIfMissing=False):
     sid = request.args['id'][0]
     try:
         return sessions[sid]
     except KeyError:
         if createIfMissing:
-            session = CometSession(sid)
-            sessions[sid] = session
-            return session
+            return _createSession(sid)
+
+def _ownerTag(nonce, session):
+    return hashlib.sha256("%s:%s" % (session.uid, nonce)).hexdigest()[:32]
+
+def ownedBy(sid, session):
+    """
+    Whether the comet session id C{sid} was given to the web session
+    C{session} by L{render_id}.
+
+    Use this before subscribing an id sent by the browser to anything it
+    shouldn't see.
+    """
+    nonce, _, tag = sid.partition('.')
+    return bool(tag) and hmac.compare_digest(tag, _ownerTag(nonce, session))
 
 def render_id(request):
-    return str(uuid.uuid4())
+    # The web session is stored, so it keeps its uid on later requests
+    session = request.getSession()
+    session.materialize()
+    nonce = uuid.uuid4().hex
+    return "%s.%s" % (nonce, _ownerTag(nonce, session))
 
 def render_longpoll(request):
     return get_session(request, True).addListener(request)
 
+def render_stream(request):
+    return get_session(request, True).addStream(request)
+
 def render_testpush(request):
     session = get_session(request, True)
     session.push({'key': 'value'})
@@ -3,19 +3,30 @@ Resource customizations
 """
 from zope.interface import implements
 
-from twisted.python.filepath import FilePath, InsecurePath
+from twisted.python.filepath import FilePath
 from twisted.web import static
 from twisted.web.resource import IResource, NoResource
 
 from warp import helpers
 from warp.common import access, translate
-from warp.runtime import avatar_store, pool, config, templateLookup
-from warp.webserver import auth, comet
+from warp.runtime import avatar_store, pool, config, templateLookup, routeTable
+from warp.webserver import auth, comet, staticfiles
 import warp.log as log
 
 if '.ico' not in static.File.contentTypes:
     static.File.contentTypes['.ico'] = 'image/vnd.microsoft.icon'
 
+# Resolved render functions: (node name, facet name) -> callable
+facetCache = {}
+
+def reloadFacets():
+    """
+    Forget resolved facets and compiled node templates, e.g. after
+    deploying new templates without a restart.
+    """
+    facetCache.clear()
+    helpers.flushTemplateCache()
+
 class WarpResourceWrapper(object):
     """
     Root Resource for Site
@@ -33,7 +44,19 @@ class WarpResourceWrapper(object):
             config['siteDir'].child('templates').path,
             self.warpTemplatePath.path,
             config['siteDir'].child('nodes').path
-        ], output_encoding='utf-8')
+        ], output_encoding='utf-8',
+           module_directory=helpers.getTemplateModuleDir(),
+           filesystem_checks=bool(config.get('reloadTemplates')))
+
+        # Scan nodes once, so requests resolve with dictionary lookups
+        routeTable.__init__(config['siteDir'].child('nodes'))
+
+        # Likewise static files, so dynamic pages never stat the filesystem
+        reloadStatic = bool(config.get('reloadStatic'))
+        self.siteStatic = staticfiles.StaticIndex(
+            config['siteDir'].child('static').path, reloadStatic)
+        self.warpStatic = staticfiles.StaticIndex(
+            self.warpStaticPath.path, reloadStatic)
 
         # Configure special URLs to point to handlers which may be overridden
         # by app
@@ -56,10 +79,10 @@ class WarpResourceWrapper(object):
         # log.msg("first_segment: %r %r" % (first_segment, request))
         # Serve request for static file
         if first_segment:
-            fp = self.buildFilePath(request)
-            if fp is not None:
+            resource = self.siteStatic.getResource(request.path.lstrip('/'))
+            if resource is not None:
                 del request.postpath[:]
-                return static.File(fp.path)
+                return resource
 
         # Init for everything except static files
         session = request.getSession()
@@ -72,7 +95,7 @@ class WarpResourceWrapper(object):
                 request.store = avatar_store
 
         if not hasattr(request, 'avatar') or not request.avatar:
-            request.avatar = session.avatar
+            request.avatar = session.getAvatar()
 
         if request.avatar is not None:
             get_user = config.get('getRequestUser')
@@ -82,6 +105,9 @@ class WarpResourceWrapper(object):
         if config.get('reloadMessages'):
             translate.loadMessages()
 
+        if config.get('reloadNodes') and routeTable.refresh():
+            facetCache.clear()
+
         lang = getattr(session, 'language', None) or getattr(session, 'lang', None)
         request.translateTerm = translate.getTranslator(lang)
 
@@ -108,20 +134,6 @@ class WarpResourceWrapper(object):
             path = path.lower()
         self.dispatch[path] = lambda r: child
 
-    def buildFilePath(self, request):
-        """
-        Get FilePath for request if static file exists and is valid
-        """
-        file_path = config['siteDir'].child('static')
-        for segment in request.path.split('/'):
-            try:
-                file_path = file_path.child(segment)
-            except InsecurePath:
-                return None
-
-        if file_path.exists() and file_path.isfile():
-            return file_path
-
     def handleLogin(self, request):
         """
         Handler for login requests
@@ -144,16 +156,11 @@ class WarpResourceWrapper(object):
         """
         Handler for static files
         """
-        file_path = self.warpStaticPath
-        for segment in request.path.split('/')[2:]:
-            try:
-                file_path = file_path.child(segment)
-            except InsecurePath:
-                return None
-
-        if file_path.exists() and file_path.isfile():
+        resource = self.warpStatic.getResource(
+            '/'.join(request.path.split('/')[2:]))
+        if resource is not None:
             del request.postpath[:]
-            return static.File(file_path.path)
+            return resource
 
         return NoResource()
 
@@ -215,8 +222,8 @@ class NodeResource(object):
             self.args = [x for x in request.postpath if x]
 
             # Perform an additional check before rendering the response
-            if not access.allowed(request.avatar, self.node, facetName=segment,
-                                  resourceArgs=self.args):
+            if not access.requestAllowed(request, self.node, facetName=segment,
+                                         resourceArgs=self.args):
                 return AccessDenied()
 
             response = self.getResponse(request)
@@ -263,6 +270,16 @@ class NodeResource(object):
         return self.response
 
     def getRenderFunc(self, facet_name):
+        key = (self.node.__name__, facet_name)
+        render_func = facetCache.get(key)
+        if render_func is None:
+            render_func = self.findRenderFunc(facet_name)
+            # Misses aren't cached, so junk URLs can't grow the cache
+            if render_func is not None:
+                facetCache[key] = render_func
+        return render_func
+
+    def findRenderFunc(self, facet_name):
         render_func = getattr(self.node, 'render_%s' % facet_name, None)
         if render_func:
             return render_func
@@ -280,11 +297,25 @@ class NodeResource(object):
         return None
 
     def getTemplate(self, facet_name):
+        route = routeTable.routeFor(self.node)
+        if route is not None:
+            path = route.templates.get(facet_name)
+            if path is not None:
+                return FilePath(path)
+            return None
+
         template_path = FilePath(self.node.__file__).sibling(facet_name + '.mak')
         if template_path.exists():
             return template_path
 
     def getSubNode(self, node_name):
+        route = routeTable.routeFor(self.node)
+        if route is not None:
+            sub_route = route.children.get(node_name)
+            if sub_route is not None:
+                return sub_route.node
+            return None
+
         current_package = self.node.__name__.rsplit('.', 1)[0]
         try:
             return getattr(__import__("%s.%s" % (current_package, node_name),
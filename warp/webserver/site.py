@@ -7,9 +7,51 @@ from twisted.python import log
 from storm.locals import *
 
 from warp.runtime import config, avatar_store
-from warp.common.avatar import Avatar, SessionManager # DBSession
+from warp.common.avatar import Avatar, SessionManager, makeSessionManager # DBSession
 
 class WarpRequest(Request):
+    sessionCookieName = None
+
+    def getSession(self, sessionInterface=None):
+        """
+        Like C{Request.getSession}, but the cookie for a new session is
+        only added once the session materializes (see
+        L{warp.common.avatar.LazySession}), so it must materialize before
+        the response headers are written.
+        """
+        if not self.session:
+            cookiename = self.sessionCookieName = b"_".join(
+                [b'TWISTED_SESSION'] + self.sitepath)
+            sessionCookie = self.getCookie(cookiename)
+            if sessionCookie:
+                try:
+                    self.session = self.site.getSession(sessionCookie)
+                except KeyError:
+                    pass
+            if not self.session:
+                self.session = self.site.makeSession()
+                self.session.notifyMaterialized(self.setSessionCookie)
+        self.session.touch()
+        if sessionInterface:
+            return self.session.getComponent(sessionInterface)
+        return self.session
+
+    def setSessionCookie(self, session):
+        """
+        Set the session cookie, replacing one set earlier in this request.
+        """
+        prefix = self.sessionCookieName + '='
+        self.cookies = [c for c in self.cookies if not c.startswith(prefix)]
+        self.addCookie(self.sessionCookieName, session.cookieValue(), path=b'/')
+        session.dirty = False
+
+    def write(self, data):
+        # Sessions kept in the cookie have to be sent again when they change
+        if (not self.startedWriting and self.session is not None
+                and self.session.dirty):
+            self.setSessionCookie(self.session)
+        return Request.write(self, data)
+
     def finish(self):
         rv = Request.finish(self)
 
@@ -36,6 +78,13 @@ class WarpSite(Site):
     requestFactory = WarpRequest
     sessionManager = SessionManager()
 
+    def __init__(self, resource, *args, **kwargs):
+        Site.__init__(self, resource, *args, **kwargs)
+
+        backend = config.get('sessionBackend')
+        if backend is not None:
+            self.sessionManager = makeSessionManager(backend)
+
     def makeSession(self):
         """
         Create new session.
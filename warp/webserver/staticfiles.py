@@ -0,0 +1,343 @@
+"""
+Static file index.
+
+Static directories are scanned once at startup. Serving a file is then a
+dictionary lookup, and requests for dynamic pages never stat the
+filesystem looking for a matching file.
+"""
+import gzip
+import hashlib
+import os
+from cStringIO import StringIO
+
+from zope.interface import implements
+
+from twisted.python.filepath import FilePath, InsecurePath
+from twisted.web import http, static
+from twisted.web.resource import IResource
+from twisted.web.server import NOT_DONE_YET
+
+# Cache-Control for URLs containing the content hash
+FOREVER = 'public, max-age=31536000, immutable'
+
+# Same default as static.File
+DEFAULT_TYPE = 'text/html'
+
+# Types worth compressing on the fly if there's no .gz file on disk
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/x-javascript',
+                'application/json', 'image/svg+xml')
+
+
+class StaticAsset(object):
+    """
+    Metadata for one static file.
+
+    @ivar name: Path relative to the indexed directory, '/'-separated
+    @ivar hash: SHA-1 of the content (hex)
+    @ivar etag: Strong ETag derived from the content hash
+    @ivar gzipETag: Strong ETag of the gzipped content
+    @ivar gzipPath: Path of a precompressed C{.gz} sibling, if up to date
+    """
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+        st = os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+
+        self.type, self.encoding = static.getTypeAndEncoding(
+            name, static.File.contentTypes, static.File.contentEncodings,
+            DEFAULT_TYPE)
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        self.hash = digest.hexdigest()
+        self.etag = '"%s"' % self.hash[:20]
+        self.gzipETag = '"%s-gz"' % self.hash[:20]
+
+        self.compressible = (self.encoding is None and
+                             self.type.startswith(COMPRESSIBLE))
+        self.gzipPath = None
+        if self.compressible:
+            gz = path + '.gz'
+            if os.path.isfile(gz) and os.stat(gz).st_mtime >= self.mtime:
+                self.gzipPath = gz
+        self._gzipData = None
+
+    @property
+    def fingerprint(self):
+        return self.hash[:10]
+
+    def fingerprintedName(self):
+        """
+        Name including the content hash, e.g. C{js/app.0123456789.js}
+        """
+        base, ext = os.path.splitext(self.name)
+        return "%s.%s%s" % (base, self.fingerprint, ext)
+
+    def gzipData(self):
+        """
+        Gzipped content, read from the C{.gz} file or compressed once.
+        """
+        if self._gzipData is None:
+            if self.gzipPath is not None:
+                with open(self.gzipPath, 'rb') as f:
+                    self._gzipData = f.read()
+            else:
+                buf = StringIO()
+                with open(self.path, 'rb') as f:
+                    gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=self.mtime)
+                    gz.write(f.read())
+                    gz.close()
+                self._gzipData = buf.getvalue()
+        return self._gzipData
+
+    def isStale(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return st.st_mtime != self.mtime or st.st_size != self.size
+
+    def __repr__(self):
+        return "<StaticAsset %s %s>" % (self.name, self.etag)
+
+
+class StaticIndex(object):
+    """
+    All files under one directory, keyed by relative name.
+    """
+    def __init__(self, root, reload=False):
+        """
+        @param root: Directory to index
+        @param reload: Check files on disk on every lookup, for development
+        """
+        self.root = root
+        self.reload = reload
+        self.assets = {}
+        self.fingerprinted = {}
+        self.scan()
+
+    def scan(self):
+        self.assets.clear()
+        self.fingerprinted.clear()
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                self._add(path, name)
+
+    def get(self, name):
+        """
+        Get asset by its plain or fingerprinted name.
+
+        @return: C{(asset, fingerprinted)}, or C{(None, False)}
+        """
+        asset = self.assets.get(name)
+        if asset is not None:
+            if self.reload and asset.isStale():
+                asset = self._refresh(name)
+            return (asset, False)
+
+        asset = self.fingerprinted.get(name)
+        if asset is not None:
+            return (asset, True)
+
+        if self.reload:
+            return (self._refresh(name), False)
+
+        return (None, False)
+
+    def getResource(self, name):
+        """
+        Get a resource serving C{name}, or C{None} if there's no such file.
+        """
+        asset, fingerprinted = self.get(name)
+        if asset is not None:
+            return StaticAssetResource(asset, fingerprinted)
+
+    def url(self, name):
+        """
+        Get the fingerprinted name for C{name}, or C{name} itself if it
+        isn't indexed.
+        """
+        asset = self.assets.get(name)
+        if asset is None:
+            return name
+        return asset.fingerprintedName()
+
+    def _add(self, path, name):
+        try:
+            asset = StaticAsset(path, name)
+        except (IOError, OSError):
+            return None
+        self.assets[name] = asset
+        self.fingerprinted[asset.fingerprintedName()] = asset
+        return asset
+
+    def _refresh(self, name):
+        old = self.assets.pop(name, None)
+        if old is not None:
+            self.fingerprinted.pop(old.fingerprintedName(), None)
+
+        file_path = FilePath(self.root)
+        for segment in name.split('/'):
+            try:
+                file_path = file_path.child(segment)
+            except InsecurePath:
+                return None
+
+        if file_path.isfile():
+            return self._add(file_path.path, name)
+
+
+class StaticAssetResource(object):
+    """
+    Serve an indexed file, with conditional GET, byte ranges and gzip.
+    """
+    implements(IResource)
+
+    isLeaf = True
+
+    def __init__(self, asset, fingerprinted=False):
+        self.asset = asset
+        self.fingerprinted = fingerprinted
+
+    def render(self, request):
+        asset = self.asset
+
+        if request.method not in ('GET', 'HEAD'):
+            request.setResponseCode(http.NOT_ALLOWED)
+            request.setHeader('allow', 'GET, HEAD')
+            return ''
+
+        request.setHeader('content-type', asset.type)
+        request.setHeader('accept-ranges', 'bytes')
+        if asset.encoding:
+            request.setHeader('content-encoding', asset.encoding)
+        if asset.compressible:
+            request.setHeader('vary', 'Accept-Encoding')
+        if self.fingerprinted:
+            request.setHeader('cache-control', FOREVER)
+
+        # Ranges are of the identity body only
+        byteRange = self._getRange(request)
+        useGzip = byteRange is None and asset.compressible and _acceptsGzip(request)
+        # Each encoding is a different entity, with its own tag
+        etag = asset.gzipETag if useGzip else asset.etag
+
+        # If-None-Match takes precedence over If-Modified-Since
+        if request.getHeader('if-none-match') is not None:
+            cached = request.setETag(etag)
+            request.setHeader('last-modified', http.datetimeToString(asset.mtime))
+        else:
+            request.setETag(etag)
+            cached = request.setLastModified(asset.mtime)
+        if cached is http.CACHED:
+            return ''
+
+        if useGzip:
+            data = asset.gzipData()
+            request.setHeader('content-encoding', 'gzip')
+            request.setHeader('content-length', str(len(data)))
+            if request.method == 'HEAD':
+                return ''
+            return data
+
+        if byteRange is None:
+            offset, size = 0, asset.size
+        elif byteRange is False:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader('content-range', 'bytes */%d' % asset.size)
+            return ''
+        else:
+            offset, size = byteRange
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('content-range', 'bytes %d-%d/%d' % (
+                offset, offset + size - 1, asset.size))
+
+        request.setHeader('content-length', str(size))
+        if request.method == 'HEAD':
+            return ''
+
+        try:
+            f = open(asset.path, 'rb')
+        except IOError:
+            request.setResponseCode(http.NOT_FOUND)
+            return ''
+
+        if byteRange is None:
+            static.NoRangeStaticProducer(request, f).start()
+        else:
+            static.SingleRangeStaticProducer(request, f, offset, size).start()
+        return NOT_DONE_YET
+
+    def _getRange(self, request):
+        """
+        Parse a single byte range.
+
+        @return: C{None} to serve the whole file, C{False} if the range
+            can't be satisfied, or C{(offset, size)}
+        """
+        header = request.getHeader('range')
+        if header is None:
+            return None
+
+        ifRange = request.getHeader('if-range')
+        if ifRange is not None and ifRange != self.asset.etag:
+            return None
+
+        unit, _, spec = header.partition('=')
+        # Multiple ranges aren't worth it for static assets: send everything
+        if unit.strip() != 'bytes' or ',' in spec:
+            return None
+
+        start, _, end = spec.strip().partition('-')
+        total = self.asset.size
+        try:
+            if start:
+                start = int(start)
+                end = int(end) if end else total - 1
+            elif end:
+                start = max(total - int(end), 0)
+                end = total - 1
+            else:
+                return None
+        except ValueError:
+            return None
+
+        end = min(end, total - 1)
+        if start > end:
+            return False
+        return (start, end - start + 1)
+
+
+def _acceptsGzip(request):
+    """
+    Whether C{Accept-Encoding} allows gzip, going by its q-values.
+    """
+    accept = request.getHeader('accept-encoding')
+    if accept is None:
+        return False
+
+    qualities = {}
+    for item in accept.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+
+    if 'gzip' in qualities:
+        return qualities['gzip'] > 0
+    return qualities.get('*', 0) > 0
+
@@ -0,0 +1,136 @@
+"""
+Hashed timer wheel.
+
+Comet keeps several timeouts per session which are reset on nearly every
+request and rarely fire. Scheduling each with C{reactor.callLater} puts
+them all in the reactor's heap, where every reset costs O(log n). A timer
+wheel hashes timers into slots by the tick they are due in, so scheduling,
+resetting and cancelling are O(1), and a single reactor call per tick
+fires whatever is due.
+
+Timers fire up to one tick late, never early.
+"""
+import math
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class Timer(object):
+    """
+    A timeout scheduled on a L{TimerWheel}, with the parts of
+    L{twisted.internet.interfaces.IDelayedCall} comet needs.
+    """
+    __slots__ = ('wheel', 'due', 'func', 'args')
+
+    def __init__(self, wheel, func, args):
+        self.wheel = wheel
+        self.func = func
+        self.args = args
+        self.due = None
+
+    def reset(self, delay):
+        """
+        Fire C{delay} seconds from now instead, rescheduling it if it was
+        cancelled or has fired.
+        """
+        self.wheel._reschedule(self, delay)
+
+    def cancel(self):
+        """
+        Stop the timer. Cancelling a timer which isn't active does nothing.
+        """
+        self.wheel._remove(self)
+
+    def active(self):
+        return self.due is not None
+
+
+class TimerWheel(object):
+    """
+    @param tick: Seconds per slot
+    @param size: Number of slots. Timers due further ahead than C{tick *
+        size} seconds share slots with nearer ones, and are skipped until
+        their turn comes round.
+    @param clock: Provider of L{twisted.internet.interfaces.IReactorTime},
+        the reactor by default
+    """
+    def __init__(self, tick=1.0, size=64, clock=None):
+        self.tick = tick
+        self.size = size
+        self.clock = clock if clock is not None else reactor
+        self.slots = [set() for _ in xrange(size)]
+        # Number of ticks processed, and the time of tick 0
+        self.ticks = 0
+        self.origin = None
+        self.count = 0
+        self._call = None
+
+    def __len__(self):
+        return self.count
+
+    def callLater(self, delay, func, *args):
+        """
+        Call C{func(*args)} in C{delay} seconds.
+
+        @rtype: L{Timer}
+        """
+        timer = Timer(self, func, args)
+        self._reschedule(timer, delay)
+        return timer
+
+    def _reschedule(self, timer, delay):
+        now = self.clock.seconds()
+        if self._call is None:
+            # Idle until now: make the current time fall in the current tick
+            self.origin = now - self.ticks * self.tick
+        due = max(int(math.ceil((now + delay - self.origin) / self.tick)),
+                  self.ticks + 1)
+        if due == timer.due:
+            return
+
+        self._remove(timer)
+        timer.due = due
+        self.slots[due % self.size].add(timer)
+        self.count += 1
+        if self._call is None:
+            self._schedule(now)
+
+    def _remove(self, timer):
+        if timer.due is not None:
+            self.slots[timer.due % self.size].discard(timer)
+            timer.due = None
+            self.count -= 1
+
+    def _tickAt(self, when):
+        # Allow for rounding, so a call made for a tick's time sees it
+        return int(math.floor((when - self.origin) / self.tick + 1e-9))
+
+    def _schedule(self, now):
+        delay = self.origin + (self.ticks + 1) * self.tick - now
+        self._call = self.clock.callLater(max(delay, 0), self._advance)
+
+    def _advance(self):
+        now = self.clock.seconds()
+        target = self._tickAt(now)
+
+        while self.ticks < target and self.count:
+            self.ticks += 1
+            slot = self.slots[self.ticks % self.size]
+            due = [timer for timer in slot if timer.due == self.ticks]
+            for timer in due:
+                # An earlier callback may have reset or cancelled it
+                if timer.due != self.ticks:
+                    continue
+                self._remove(timer)
+                try:
+                    timer.func(*timer.args)
+                except Exception:
+                    log.err(None, "Error in timer wheel callback")
+        self.ticks = max(self.ticks, target)
+
+        # Left set while callbacks run, so timers they schedule keep the
+        # current origin
+        self._call = None
+        if self.count:
+            self._schedule(now)